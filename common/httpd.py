@@ -9,11 +9,22 @@ httpd.py
 """
 
 import BaseHTTPServer
+import email.utils
+import errno
 import os
 import posixpath
+import Queue
+import select
 import SimpleHTTPServer
+import socket
 import SocketServer
+import sys
+import tempfile
+import threading
+import time
 import urllib
+import uuid
+import zlib
 
 
 class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
@@ -23,13 +34,14 @@ class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
   sets allow_reuse_address, which prevents the issue where we can't bind the
   same port for a period of time after restarting.
 
-  NOTE: This doesn't use a thread pool or anything.  It will just start a new
-  thread for each request.
-  
-  For webpipe, since every thread will block waiting for the next part of the
-  scroll, you can create a huge number of threads just by having a huge number
-  of clients.  But since this is mainly a single-user server, it doesn't
-  matter.
+  If num_threads is given, connections are served by a fixed pool of threads.
+  Accepted connections queue up when all of them are busy, so a client that
+  opens lots of connections can't make us start lots of threads.  Otherwise a
+  new thread is started for each connection.
+
+  For webpipe, every thread that's waiting for the next part of the scroll is
+  occupied, so the handler limits the number of waiters to less than the pool
+  size (see SequenceWaiter).  (EventLoopHTTPServer avoids the problem.)
 
   TODO: There's a still a Ctrl-C bug here, because I think the request threads
   get blocked on the threading.Event().  Need to setDaemon() all threads,
@@ -38,6 +50,248 @@ class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
   # override class variable in ThreadingMixIn.  This makes it so that Ctrl-C works.
   daemon_threads = True
 
+  # Handlers block instead of calling park().
+  can_park = False
+
+  def __init__(self, server_address, RequestHandlerClass, num_threads=None):
+    BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                       RequestHandlerClass)
+    self.num_threads = num_threads
+    self.requests = Queue.Queue()  # (request, client_address)
+    for _ in xrange(num_threads or 0):
+      t = threading.Thread(target=self._Worker)
+      t.setDaemon(True)
+      t.start()
+
+  def process_request(self, request, client_address):
+    if self.num_threads:
+      self.requests.put((request, client_address))
+    else:
+      SocketServer.ThreadingMixIn.process_request(self, request,
+                                                  client_address)
+
+  def _Worker(self):
+    while True:
+      request, client_address = self.requests.get()
+      if request is None:  # server_close()
+        return
+      # Handles errors and closes the connection.
+      self.process_request_thread(request, client_address)
+
+  def Busy(self):
+    """Are connections waiting for a thread from the pool?"""
+    return self.num_threads and not self.requests.empty()
+
+  def server_close(self):
+    BaseHTTPServer.HTTPServer.server_close(self)
+    for _ in xrange(self.num_threads or 0):
+      self.requests.put((None, None))
+
+
+class EventLoopHTTPServer(BaseHTTPServer.HTTPServer):
+  """
+  Single-threaded server where a hanging GET doesn't occupy a thread.
+
+  Requests are read and answered on the thread that runs serve_forever().  A
+  handler that has to wait for something calls self.park(), and when do_GET()
+  returns, the connection is left open instead of being closed.  Later, any
+  thread can call Resume(handler, func), and func() is run on the loop thread
+  to write the response.
+
+  So a waiting viewer costs a socket and a handler object, not a thread and its
+  stack.
+
+  Between requests, a persistent connection is also watched with select(),
+  rather than a thread blocking on readline().  So is a parked connection, so
+  that when the client goes away, the handler is dropped right away.  A parked
+  handler can also have a deadline (see BaseRequestHandler.park()).
+
+  NOTE: Requests are still read and files are still written synchronously, so
+  a slow client can stall the loop.  That's OK for a localhost server.
+  """
+  can_park = True
+
+  def __init__(self, server_address, RequestHandlerClass):
+    BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                       RequestHandlerClass)
+    self.parked = {}  # handlers waiting for Resume() -> deadline or None
+    # Sockets of parked handlers, to notice when the client disconnects.
+    # socket -> handler
+    self.watched = {}
+    # Persistent connections between requests.
+    # socket -> (client_address, requests handled, idle deadline)
+    self.idle = {}
+    self.pending = Queue.Queue()  # (handler, func) to run on the loop thread
+    # Resume() writes a byte here to wake up select()
+    self.wake_r, self.wake_w = os.pipe()
+    self.stopped = False
+
+  def finish_request(self, request, client_address):
+    # Return the handler so process_request() can tell if it was parked.
+    return self.RequestHandlerClass(request, client_address, self)
+
+  def process_request(self, request, client_address, num_handled=0):
+    # The handler serves one request, then we come back here.
+    handler = self.finish_request(request, client_address)
+    num_handled += 1
+    if handler.parked:
+      self._Park(handler)
+    elif (handler.close_connection or
+          num_handled >= handler.max_requests):
+      self.shutdown_request(request)
+    else:
+      deadline = time.time() + handler.timeout
+      self.idle[request] = (client_address, num_handled, deadline)
+
+  def _Accept(self):
+    try:
+      request, client_address = self.get_request()
+    except socket.error:
+      return
+    # Don't read until the request arrives.  Browsers open connections before
+    # they need them.
+    deadline = time.time() + self.RequestHandlerClass.timeout
+    self.idle[request] = (client_address, 0, deadline)
+
+  def _HandleIdle(self, readable):
+    for request in readable:
+      client_address, num_handled, _ = self.idle.pop(request)
+      try:
+        self.process_request(request, client_address, num_handled)
+      except:
+        self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+    now = time.time()
+    for request, (_, _, deadline) in self.idle.items():
+      if now > deadline:
+        del self.idle[request]
+        self.shutdown_request(request)
+
+  def _Park(self, handler):
+    self.parked[handler] = handler.park_deadline
+    self.watched[handler.request] = handler
+
+  def _Unpark(self, handler):
+    del self.parked[handler]
+    self.watched.pop(handler.request, None)
+    handler.parked = False
+
+  def _Run(self, handler, func):
+    """Run func() for an unparked handler, then finish or re-park it."""
+    try:
+      func()
+    except socket.error:
+      # e.g. the browser went away while we were waiting.
+      handler.parked = False
+    except Exception:
+      handler.parked = False
+      self.handle_error(handler.request, handler.client_address)
+
+    if handler.parked:
+      self._Park(handler)
+      return
+    try:
+      handler.finish()
+    except socket.error:
+      pass
+    self.shutdown_request(handler.request)
+
+  def _HandleParked(self, readable):
+    for request in readable:
+      handler = self.watched.get(request)
+      if handler is None:  # resumed in the meantime
+        continue
+      if PeerClosed(request):
+        self._Unpark(handler)
+        self._Run(handler, lambda: handler.park_ended(False))
+      else:
+        # A pipelined request.  We'll close the connection after responding,
+        # so just stop watching it.
+        del self.watched[request]
+
+    now = time.time()
+    for handler, deadline in self.parked.items():
+      if deadline is not None and now > deadline:
+        self._Unpark(handler)
+        self._Run(handler, lambda: handler.park_ended(True))
+
+  def Resume(self, handler, func):
+    """Finish a parked request by running func() on the loop thread.
+
+    Can be called from any thread.  If func() calls handler.park() again, the
+    connection stays open.
+    """
+    self.pending.put((handler, func))
+    os.write(self.wake_w, 'x')
+
+  def _RunPending(self):
+    os.read(self.wake_r, 4096)
+    while True:
+      try:
+        handler, func = self.pending.get_nowait()
+      except Queue.Empty:
+        break
+      if handler not in self.parked:  # already finished
+        continue
+      self._Unpark(handler)
+      self._Run(handler, func)
+
+  def serve_forever(self, poll_interval=0.5):
+    self.stopped = False
+    while not self.stopped:
+      try:
+        r, _, _ = select.select(
+            [self, self.wake_r] + self.idle.keys() + self.watched.keys(),
+            [], [], poll_interval)
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      # Before anything is parked or unparked in this round
+      parked = [sock for sock in r if sock in self.watched]
+      if self in r:
+        self._Accept()
+      if self.wake_r in r:
+        self._RunPending()
+      self._HandleIdle([sock for sock in r if sock in self.idle])
+      self._HandleParked(parked)
+
+  def shutdown(self):
+    # Unlike BaseServer.shutdown(), this doesn't wait for the loop to exit.
+    self.stopped = True
+
+  def server_close(self):
+    BaseHTTPServer.HTTPServer.server_close(self)
+    for handler in self.parked:
+      self.shutdown_request(handler.request)
+    self.parked.clear()
+    self.watched.clear()
+    for request in self.idle:
+      self.shutdown_request(request)
+    self.idle.clear()
+    os.close(self.wake_r)
+    os.close(self.wake_w)
+
+
+def PeerClosed(sock):
+  """Has the other end of a connection closed it?
+
+  Doesn't block, and doesn't consume any data that was sent.
+  """
+  try:
+    r, _, _ = select.select([sock], [], [], 0)
+    if not r:
+      return False
+    return sock.recv(1, socket.MSG_PEEK) == ''
+  except (select.error, socket.error):
+    return True
+
+
+# How often an idle connection on a pooled thread checks whether it should give
+# the thread up.
+IDLE_POLL_INTERVAL = 0.5
+
 
 class BaseRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
   """
@@ -51,6 +305,86 @@ class BaseRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
   """
   server_version = None
   root_dir = None
+  parked = False
+  park_deadline = None
+  transfer_stats = None  # set below; shared by all handlers
+
+  # Use persistent connections.  Every response needs a Content-Length (or
+  # 'Connection: close').
+  protocol_version = 'HTTP/1.1'
+
+  # Seconds a persistent connection can be idle.  (StreamRequestHandler sets
+  # this as the socket timeout.)
+  timeout = 30
+
+  # Close a persistent connection after this many requests.
+  max_requests = 100
+
+  def handle(self):
+    """Serve requests on a persistent connection.
+
+    With an event loop server, this serves just one request.  The server waits
+    for the next one with select(), so an idle connection doesn't block the
+    loop.
+    """
+    num_handled = 0
+    while True:
+      self.handle_one_request()
+      num_handled += 1
+      if self.close_connection or self.server.can_park:
+        break
+      if num_handled >= self.max_requests:
+        break
+      if getattr(self.server, 'num_threads', None) and not self._WaitIdle():
+        break
+
+  def _WaitIdle(self):
+    """Wait for the next request on a connection served by a thread pool.
+
+    Returns False if the connection should be closed instead, because it timed
+    out or because other connections are waiting for a thread.
+    """
+    deadline = time.time() + self.timeout
+    while not self.server.Busy():
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      r, _, _ = select.select([self.connection], [], [],
+                              min(remaining, IDLE_POLL_INTERVAL))
+      if r:
+        return True
+    return False
+
+  def park(self, timeout=None):
+    """Keep the connection open after the do_*() method returns.
+
+    Only valid when self.server.can_park.  The response is written later, by a
+    function passed to EventLoopHTTPServer.Resume().
+
+    If Resume() isn't called within timeout seconds, or the client
+    disconnects first, park_ended() is called instead.
+    """
+    assert self.server.can_park
+    self.parked = True
+    self.close_connection = 1  # don't read another request on this socket
+    if timeout is None:
+      self.park_deadline = None
+    else:
+      self.park_deadline = time.time() + timeout
+
+  def park_ended(self, timed_out):
+    """Called on the loop thread when a parked request isn't resumed.
+
+    Args:
+      timed_out: True if the park() timeout expired.  The handler can write a
+          response, or park again.  If False, the client went away.
+    """
+    pass
+
+  def finish(self):
+    if self.parked:
+      return  # the server finishes it after Resume()
+    SimpleHTTPServer.SimpleHTTPRequestHandler.finish(self)
 
   def url_to_fs_path(self, url):
     """Translate a URL to a local file system path.
@@ -97,8 +431,10 @@ class BaseRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     # originally had this.
     path = path.split('?',1)[0]
     path = path.split('#',1)[0]
+    url_path = path
     # eliminates double slashes, etc.
     path = posixpath.normpath(urllib.unquote(path))
+    url = path
 
     path = self.url_to_fs_path(path)
     if path is None:
@@ -107,11 +443,10 @@ class BaseRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     f = None
     if os.path.isdir(path):
-        if not self.path.endswith('/'):
-            # redirect browser - doing basically what apache does
-            self.send_response(301)
-            self.send_header("Location", self.path + "/")
-            self.end_headers()
+        if not url_path.endswith('/'):
+            # redirect browser - doing basically what apache does.  Keep the
+            # query string, e.g. /s/foo?events -> /s/foo/?events
+            self.send_redirect(url_path + "/" + self.path[len(url_path):])
             return None
         for index in "index.html", "index.htm":
             index = os.path.join(path, index)
@@ -121,6 +456,12 @@ class BaseRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         else:
             return self.list_directory(path)
     ctype = self.guess_type(path)
+    compressible = _IsCompressible(ctype)
+    range_header = self.headers.getheader('Range')
+    if range_header is None:
+        path, encoding = self.negotiate_encoding(path, ctype)
+    else:
+        encoding = None  # byte ranges are of the original file
     try:
         # Always read in binary mode. Opening files in text mode may cause
         # newline translations, making the actual size of the content
@@ -129,11 +470,550 @@ class BaseRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     except IOError:
         self.send_error(404, "File not found")
         return None
-    self.send_response(200)
-    self.send_header("Content-type", ctype)
     fs = os.fstat(f.fileno())
-    self.send_header("Content-Length", str(fs[6]))
+    etag = MakeETag(fs)
+    cache_control = self.cache_control(url)
+
+    if self.not_modified(etag, fs.st_mtime):
+        f.close()
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        if cache_control:
+            self.send_header("Cache-Control", cache_control)
+        if compressible:
+            self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        return None
+
+    ranges = None
+    if range_header is not None and self.if_range_matches(etag, fs.st_mtime):
+        ranges = ParseRange(range_header, fs.st_size)
+
+    if ranges == []:
+        f.close()
+        self.send_response(416)
+        self.send_header("Content-Range", "bytes */%d" % fs.st_size)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return None
+
+    if ranges:
+        self.send_response(206)
+        f = _ByteRanges(f, ranges, ctype, fs.st_size)
+        self.send_header("Content-type", f.content_type)
+        self.send_header("Content-Length", str(f.length))
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, end, fs.st_size))
+    else:
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        self.send_header("Content-Length", str(fs[6]))
+    self.send_header("Accept-Ranges", "bytes")
     self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+    self.send_header("ETag", etag)
+    if cache_control:
+        self.send_header("Cache-Control", cache_control)
+    if encoding:
+        self.send_header("Content-Encoding", encoding)
+    if compressible:
+        self.send_header("Vary", "Accept-Encoding")
     self.end_headers()
     return f
 
+  def if_range_matches(self, etag, mtime):
+    """Whether a Range request should be honored, given If-Range."""
+    if_range = self.headers.getheader('If-Range')
+    if if_range is None:
+      return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+      return if_range == etag
+    t = email.utils.parsedate_tz(if_range)
+    return t is not None and int(mtime) == email.utils.mktime_tz(t)
+
+  def accepted_encodings(self):
+    """Returns the content codings we can use for this request."""
+    accepted = set()
+    header = self.headers.getheader('Accept-Encoding') or ''
+    for item in header.split(','):
+      parts = [p.strip() for p in item.split(';')]
+      coding = parts[0].lower()
+      q = 1.0
+      for param in parts[1:]:
+        if param.startswith('q='):
+          try:
+            q = float(param[2:])
+          except ValueError:
+            pass
+      if coding and q > 0:
+        accepted.add(coding)
+    return [e for e, _ in ENCODINGS if e in accepted]
+
+  def negotiate_encoding(self, path, ctype):
+    """Choose a compressed variant of a file, if the client accepts one.
+
+    Variants are stored next to the file, e.g. 3.html.gz.  They're created by
+    a background thread (see _Compressor), so a request never waits for one;
+    until it's ready, the file is served uncompressed.
+
+    Returns:
+      (path to serve, Content-Encoding value or None)
+    """
+    if not _IsCompressible(ctype):
+      return path, None
+    try:
+      fs = os.stat(path)
+    except OSError:
+      return path, None  # send_head reports the error
+    if not (MIN_COMPRESS_SIZE <= fs.st_size <= MAX_COMPRESS_SIZE):
+      return path, None
+
+    source_etag = MakeETag(fs)
+    for encoding in self.accepted_encodings():
+      variant = path + _ENCODING_SUFFIX[encoding]
+      if self.compressor.Lookup(variant, source_etag):
+        return variant, encoding
+      self.compressor.Request(path, variant, encoding, source_etag)
+      break  # don't queue a variant per encoding
+
+    return path, None
+
+  def cache_control(self, url):
+    """Returns the Cache-Control header value for a URL path, or None.
+
+    Override this to let browsers cache things that don't change.
+    """
+    return None
+
+  def not_modified(self, etag, mtime=None):
+    """Whether the request's validators match, so we can send a 304."""
+    if_none_match = self.headers.getheader('If-None-Match')
+    if if_none_match is not None:
+      # If-None-Match takes precedence over If-Modified-Since.
+      tags = [t.strip() for t in if_none_match.split(',')]
+      return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+    if_modified_since = self.headers.getheader('If-Modified-Since')
+    if if_modified_since is not None and mtime is not None:
+      t = email.utils.parsedate_tz(if_modified_since)
+      if t is not None:
+        # HTTP dates only have 1 second resolution.
+        return int(mtime) <= email.utils.mktime_tz(t)
+
+    return False
+
+  def send_content(self, content_type, body, etag=None, encoding=None):
+    """Send a complete response from a string.
+
+    Args:
+      etag: If set, it's sent, and a 304 is sent instead of the body if the
+          client already has it.
+      encoding: Content-Encoding of body, if it's already compressed.
+    """
+    cache_control = self.cache_control(self.path.split('?', 1)[0])
+    if etag and self.not_modified(etag):
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      if cache_control:
+        self.send_header('Cache-Control', cache_control)
+      self.end_headers()
+      return
+
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    if etag:
+      self.send_header('ETag', etag)
+    if cache_control:
+      self.send_header('Cache-Control', cache_control)
+    if encoding:
+      self.send_header('Content-Encoding', encoding)
+      self.send_header('Vary', 'Accept-Encoding')
+    self.end_headers()
+    self.wfile.write(body)
+    self.transfer_stats.Add(memory_bytes=len(body))
+
+  def send_redirect(self, location):
+    self.send_response(301)
+    self.send_header("Location", location)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+  def do_HEAD(self):
+    """Like do_GET(), but the body is discarded.
+
+    That way HEAD works for generated pages, not just files from send_head().
+    """
+    wfile = self.wfile
+    self.wfile = _HeadersOnly(wfile)
+    try:
+      self.do_GET()
+    finally:
+      self.wfile = wfile
+
+  def end_headers(self):
+    SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+    if isinstance(self.wfile, _HeadersOnly):
+      self.wfile.discard = True
+
+  def copyfile(self, source, outputfile):
+    """Copy the rest of source to the client.
+
+    Uses sendfile() when we're writing a real file to a plain socket, so the
+    bytes don't pass through Python.  Otherwise it's a buffered copy.
+
+    source may be a _ByteRanges from send_head(), for a 206 response.
+    """
+    if self.command == 'HEAD':
+      return  # don't bother reading the file
+
+    if isinstance(source, _ByteRanges):
+      for prefix, offset, length in source.pieces:
+        outputfile.write(prefix)
+        self._CopyRange(source.f, outputfile, offset, length)
+      outputfile.write(source.suffix)
+      return
+
+    if not hasattr(source, 'fileno'):  # e.g. StringIO from list_directory()
+      self._CopyRange(source, outputfile, 0, None)
+      return
+    offset = source.tell()
+    length = os.fstat(source.fileno()).st_size - offset
+    self._CopyRange(source, outputfile, offset, length)
+
+  def _CopyRange(self, source, outputfile, offset, length):
+    """Copy length bytes of source starting at offset.
+
+    If length is None, copy to EOF.
+    """
+    if (sendfile and length is not None and outputfile is self.wfile and
+        type(self.connection) is socket.socket):  # not SSL, etc.
+      outputfile.flush()  # headers
+      self.transfer_stats.Add(
+          sendfile_bytes=self._SendFile(source, offset, length))
+      return
+
+    source.seek(offset)
+    n = 0
+    while length is None or n < length:
+      size = COPY_BUF_SIZE
+      if length is not None:
+        size = min(size, length - n)
+      buf = source.read(size)
+      if not buf:
+        break
+      outputfile.write(buf)
+      n += len(buf)
+    self.transfer_stats.Add(copied_bytes=n)
+
+  def _SendFile(self, source, offset, remaining):
+    """Send part of a file with sendfile().  Returns bytes sent."""
+    in_fd = source.fileno()
+    out_fd = self.connection.fileno()
+    # A socket with a timeout is non-blocking underneath, so we may have to
+    # wait for it to drain.
+    timeout = self.connection.gettimeout()
+
+    total = 0
+    while remaining > 0:
+      try:
+        sent = sendfile(out_fd, in_fd, offset, min(remaining, 1 << 30))
+      except OSError, e:
+        if e.errno != errno.EAGAIN:
+          raise
+        _, w, _ = select.select([], [out_fd], [], timeout)
+        if not w:
+          raise socket.timeout('sendfile timed out')
+        continue
+      if sent == 0:
+        break  # file was truncated
+      offset += sent
+      remaining -= sent
+      total += sent
+    return total
+
+
+# Don't let a client ask for thousands of little pieces.
+MAX_RANGES = 32
+
+
+def ParseRange(header, size):
+  """Parse a Range header like 'bytes=0-99,200-,-50'.
+
+  Returns:
+    A list of inclusive (start, end) pairs.  [] if no range can be satisfied
+    (416), or None if the header should be ignored (200).
+  """
+  unit, _, spec = header.partition('=')
+  if unit.strip().lower() != 'bytes':
+    return None
+
+  ranges = []
+  for item in spec.split(','):
+    item = item.strip()
+    first, dash, last = item.partition('-')
+    if not dash:
+      return None
+    try:
+      if first:
+        start = int(first)
+        if last:
+          end = int(last)
+          if end < start:
+            return None
+        else:
+          end = size - 1
+      else:  # suffix range: the last N bytes
+        n = int(last)
+        if n == 0:
+          continue
+        start = max(size - n, 0)
+        end = size - 1
+    except ValueError:
+      return None
+    if start < size:
+      ranges.append((start, min(end, size - 1)))
+
+  if len(ranges) > MAX_RANGES:
+    return None
+  return ranges
+
+
+class _ByteRanges(object):
+  """What send_head() returns for a 206 response.
+
+  It's copied by copyfile() like a file, and must be closed.
+  """
+
+  def __init__(self, f, ranges, ctype, size):
+    self.f = f
+    self.pieces = []  # (prefix, offset, length)
+    self.suffix = ''
+
+    if len(ranges) == 1:
+      start, end = ranges[0]
+      self.content_type = ctype
+      self.pieces.append(('', start, end - start + 1))
+    else:
+      boundary = uuid.uuid4().hex
+      self.content_type = 'multipart/byteranges; boundary=' + boundary
+      for start, end in ranges:
+        prefix = ('\r\n--%s\r\nContent-Type: %s\r\n'
+                  'Content-Range: bytes %d-%d/%d\r\n\r\n' %
+                  (boundary, ctype, start, end, size))
+        self.pieces.append((prefix, start, end - start + 1))
+      self.suffix = '\r\n--%s--\r\n' % boundary
+
+    self.length = len(self.suffix) + sum(
+        len(prefix) + length for prefix, _, length in self.pieces)
+
+  def close(self):
+    self.f.close()
+
+
+# os.sendfile() is only in Python 3.  The pysendfile module provides it for
+# Python 2.
+try:
+  from os import sendfile
+except ImportError:
+  try:
+    from sendfile import sendfile
+  except ImportError:
+    sendfile = None
+
+COPY_BUF_SIZE = 64 << 10
+
+
+class TransferStats(object):
+  """Counts bytes sent with sendfile(), by buffered copy, and from memory."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.sendfile_bytes = 0
+    self.copied_bytes = 0
+    self.memory_bytes = 0
+
+  def Add(self, sendfile_bytes=0, copied_bytes=0, memory_bytes=0):
+    with self.lock:
+      self.sendfile_bytes += sendfile_bytes
+      self.copied_bytes += copied_bytes
+      self.memory_bytes += memory_bytes
+
+  def Stats(self):
+    with self.lock:
+      return {
+          'sendfileBytes': self.sendfile_bytes,
+          'copiedBytes': self.copied_bytes,
+          'memoryBytes': self.memory_bytes,
+          'sendfileAvailable': sendfile is not None,
+          }
+
+
+BaseRequestHandler.transfer_stats = TransferStats()
+
+
+# Supported content codings, in order of preference.  brotli is optional.
+ENCODINGS = [('gzip', '.gz')]
+try:
+  import brotli
+  ENCODINGS.insert(0, ('br', '.br'))
+except ImportError:
+  brotli = None
+
+_ENCODING_SUFFIX = dict(ENCODINGS)
+
+# Don't bother with tiny files, and don't stall a request compressing a huge
+# one.
+MIN_COMPRESS_SIZE = 512
+MAX_COMPRESS_SIZE = 64 << 20
+
+# Types that aren't text/* but compress well.  Images, archives, etc. are
+# already compressed.
+_COMPRESSIBLE_TYPES = set([
+    'application/javascript', 'application/json', 'application/xml',
+    'image/svg+xml',
+    ])
+
+
+def _IsCompressible(ctype):
+  ctype = ctype.split(';')[0].strip()
+  return ctype.startswith('text/') or ctype in _COMPRESSIBLE_TYPES
+
+
+def Compress(data, encoding):
+  """Compress a string with the given content coding."""
+  if encoding == 'br':
+    return brotli.compress(data)
+  c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip wrapper
+  return c.compress(data) + c.flush()
+
+
+def _CompressFile(path, out_path, encoding):
+  """Write a compressed copy of path to out_path, atomically."""
+  if encoding == 'br':
+    c = brotli.Compressor()
+    compress, finish = c.process, c.finish
+  else:
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compress, finish = c.compress, c.flush
+
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(out_path),
+                                  prefix='.compress-')
+  try:
+    with os.fdopen(fd, 'wb') as out:
+      with open(path, 'rb') as f:
+        while True:
+          chunk = f.read(1 << 16)
+          if not chunk:
+            break
+          out.write(compress(chunk))
+      out.write(finish())
+    os.chmod(tmp_path, os.stat(path).st_mode & 0777)  # not mkstemp's 0600
+    os.rename(tmp_path, out_path)
+  except:
+    os.unlink(tmp_path)
+    raise
+
+
+class _Compressor(object):
+  """Creates compressed variants of files on a background thread.
+
+  Compressing a big file can take seconds, which would stall the request
+  thread (or with EventLoopHTTPServer, every request).
+
+  A variant is only used if it was made from the current contents of the
+  file, i.e. the file's ETag when it was compressed matches its ETag now.
+  Comparing mtimes isn't enough: a file rewritten within the same clock tick,
+  or renamed into place with an older mtime, would look unchanged.  The index
+  is in memory, so variants left by a previous process are remade.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.index = {}  # variant path -> ETag of the file it was made from
+    self.pending = set()  # variant paths that are queued
+    self.failed = {}  # variant path -> ETag of a file we couldn't compress
+    self.queue = Queue.Queue()
+    self.thread = None
+
+  def Lookup(self, variant, source_etag):
+    """Whether variant is an up-to-date compressed copy."""
+    with self.lock:
+      if self.index.get(variant) != source_etag:
+        return False
+    return os.path.exists(variant)
+
+  def Request(self, path, variant, encoding, source_etag):
+    """Queue path to be compressed to variant, unless it already is."""
+    with self.lock:
+      if variant in self.pending or self.failed.get(variant) == source_etag:
+        return
+      self.pending.add(variant)
+      if self.thread is None:
+        self.thread = threading.Thread(target=self._Loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    self.queue.put((path, variant, encoding, source_etag))
+
+  def Wait(self):
+    """Block until queued variants are done.  For tests."""
+    self.queue.join()
+
+  def _Loop(self):
+    while True:
+      path, variant, encoding, source_etag = self.queue.get()
+      try:
+        self._Compress(path, variant, encoding, source_etag)
+      finally:
+        with self.lock:
+          self.pending.discard(variant)
+        self.queue.task_done()
+
+  def _Compress(self, path, variant, encoding, source_etag):
+    try:
+      _CompressFile(path, variant, encoding)
+      # Make sure the file didn't change while we were reading it.
+      fs = os.stat(path)
+    except (IOError, OSError), e:
+      # e.g. a read-only install dir.  Just serve it uncompressed.
+      print >>sys.stderr, 'httpd: Not compressing %s: %s' % (path, e)
+      with self.lock:
+        self.failed[variant] = source_etag
+      return
+    if MakeETag(fs) == source_etag:
+      with self.lock:
+        self.index[variant] = source_etag
+
+
+BaseRequestHandler.compressor = _Compressor()
+
+
+def MakeETag(fs):
+  """Make a strong ETag from os.stat() output.
+
+  A file that's rewritten gets a new mtime, and usually a new size or inode.
+  """
+  return '"%x-%x-%x"' % (fs.st_ino, fs.st_size, int(fs.st_mtime * 1000))
+
+
+def ContentETag(body):
+  """Make a strong ETag for an in-memory body."""
+  return '"c%08x-%x"' % (zlib.crc32(body) & 0xffffffff, len(body))
+
+
+class _HeadersOnly(object):
+  """Wraps wfile for a HEAD request, dropping writes after the headers."""
+
+  def __init__(self, f):
+    self.f = f
+    self.discard = False
+
+  def write(self, data):
+    if not self.discard:
+      self.f.write(data)
+
+  def flush(self):
+    self.f.flush()
+
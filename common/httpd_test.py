@@ -8,11 +8,58 @@
 httpd_test.py: Tests for httpd.py
 """
 
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import zlib
 
 import httpd  # module under test
 
 
+class ParkingHandler(httpd.BaseRequestHandler):
+  """Parks every request until the test resumes it."""
+  server_version = "test"
+  parked_handlers = []
+
+  def do_GET(self):
+    self.park()
+    self.parked_handlers.append(self)
+
+  def send_ok(self):
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain')
+    self.end_headers()
+    self.wfile.write('resumed')
+
+  def log_message(self, *args):
+    pass
+
+
+class ExpiringHandler(httpd.BaseRequestHandler):
+  """Parks with a timeout, and records how the park ended."""
+  server_version = "test"
+  ended = []
+
+  def do_GET(self):
+    timeout = 0.1 if self.path == '/short' else 30
+    self.park(timeout=timeout)
+
+  def park_ended(self, timed_out):
+    self.ended.append(timed_out)
+    if timed_out:
+      self.send_response(204)
+      self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+
 class HandlerTest(unittest.TestCase):
   def setUp(self):
     pass
@@ -30,5 +77,270 @@ class HandlerTest(unittest.TestCase):
     print handler.translate_path('/')
 
 
+class HelloHandler(httpd.BaseRequestHandler):
+  server_version = "test"
+
+  def do_GET(self):
+    self.send_content('text/plain', 'hello ' + self.path)
+
+  def log_message(self, *args):
+    pass
+
+
+def _StartServer(server_class, handler_class, **kwargs):
+  s = server_class(('localhost', 0), handler_class, **kwargs)
+  t = threading.Thread(target=s.serve_forever, args=(0.05,))
+  t.setDaemon(True)
+  t.start()
+  return s, t
+
+
+class FunctionsTest(unittest.TestCase):
+
+  def testETags(self):
+    fs = os.stat(__file__)
+    self.assertEqual(httpd.MakeETag(fs), httpd.MakeETag(os.stat(__file__)))
+    self.assertNotEqual(httpd.ContentETag('a'), httpd.ContentETag('b'))
+
+  def testCompress(self):
+    data = 'hello ' * 1000
+    self.assertEqual(data, zlib.decompress(httpd.Compress(data, 'gzip'),
+                                           16 + zlib.MAX_WBITS))
+
+    self.assertTrue(httpd._IsCompressible('text/html'))
+    self.assertTrue(httpd._IsCompressible('application/json; charset=utf-8'))
+    self.assertFalse(httpd._IsCompressible('image/png'))
+    self.assertFalse(httpd._IsCompressible('application/octet-stream'))
+
+
+class EventLoopServerTest(unittest.TestCase):
+
+  def testParkAndResume(self):
+    s = httpd.EventLoopHTTPServer(('localhost', 0), ParkingHandler)
+    port = s.server_address[1]
+    t = threading.Thread(target=s.serve_forever, args=(0.05,))
+    t.setDaemon(True)
+    t.start()
+
+    results = []
+    def Fetch():
+      results.append(urllib2.urlopen('http://localhost:%d/' % port).read())
+
+    clients = [threading.Thread(target=Fetch) for _ in range(3)]
+    for c in clients:
+      c.start()
+
+    for _ in range(100):
+      if len(ParkingHandler.parked_handlers) == 3:
+        break
+      threading.Event().wait(0.05)
+    # Three requests are waiting, but there's only the one loop thread.
+    self.assertEqual(3, len(s.parked))
+    self.assertEqual([], results)
+
+    for h in ParkingHandler.parked_handlers:
+      s.Resume(h, h.send_ok)
+    for c in clients:
+      c.join(5)
+
+    self.assertEqual(['resumed'] * 3, results)
+    self.assertEqual(0, len(s.parked))
+
+    s.shutdown()
+    t.join(5)
+    s.server_close()
+
+  def testParkTimeoutAndDisconnect(self):
+    s, t = _StartServer(httpd.EventLoopHTTPServer, ExpiringHandler)
+    port = s.server_address[1]
+
+    conn = httplib.HTTPConnection('localhost', port, timeout=5)
+    conn.request('GET', '/short')
+    self.assertEqual(204, conn.getresponse().status)
+    conn.close()
+    self.assertEqual([True], ExpiringHandler.ended)
+
+    # A client that gives up is noticed long before the timeout.
+    sock = socket.create_connection(('localhost', port))
+    sock.sendall('GET /long HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    for _ in range(100):
+      if s.parked:
+        break
+      time.sleep(0.05)
+    self.assertEqual(1, len(s.parked))
+    sock.close()
+    for _ in range(100):
+      if not s.parked:
+        break
+      time.sleep(0.05)
+    self.assertEqual({}, s.parked)
+    self.assertEqual([True, False], ExpiringHandler.ended)
+
+    s.shutdown()
+    t.join(5)
+    s.server_close()
+
+
+class RangeTest(unittest.TestCase):
+
+  def testParseRange(self):
+    self.assertEqual([(0, 99)], httpd.ParseRange('bytes=0-99', 1000))
+    self.assertEqual([(900, 999)], httpd.ParseRange('bytes=900-', 1000))
+    self.assertEqual([(950, 999)], httpd.ParseRange('bytes=-50', 1000))
+    self.assertEqual([(0, 0), (10, 999)],
+                     httpd.ParseRange('bytes=0-0, 10-5000', 1000))
+    self.assertEqual([(0, 9)], httpd.ParseRange('bytes=-50', 10))
+
+    # Unsatisfiable
+    self.assertEqual([], httpd.ParseRange('bytes=1000-', 1000))
+    self.assertEqual([], httpd.ParseRange('bytes=-0', 1000))
+
+    # Ignored
+    self.assertEqual(None, httpd.ParseRange('lines=1-2', 1000))
+    self.assertEqual(None, httpd.ParseRange('bytes=5-1', 1000))
+    self.assertEqual(None, httpd.ParseRange('bytes=x-', 1000))
+
+
+class StaticHandler(httpd.BaseRequestHandler):
+  server_version = "test"
+  root_dir = os.path.dirname(os.path.abspath(__file__))
+
+  def log_message(self, *args):
+    pass
+
+
+class CopyTest(unittest.TestCase):
+
+  def testCopyFile(self):
+    s, t = _StartServer(httpd.ThreadedHTTPServer, StaticHandler)
+    before = StaticHandler.transfer_stats.Stats()
+
+    conn = httplib.HTTPConnection('localhost', s.server_address[1])
+    conn.request('GET', '/httpd.py')
+    body = conn.getresponse().read()
+    with open(os.path.join(StaticHandler.root_dir, 'httpd.py')) as f:
+      self.assertEqual(f.read(), body)
+
+    # Whichever way it was sent, it was counted.
+    after = StaticHandler.transfer_stats.Stats()
+    sent = ((after['sendfileBytes'] - before['sendfileBytes']) +
+            (after['copiedBytes'] - before['copiedBytes']))
+    self.assertEqual(len(body), sent)
+
+    conn.request('GET', '/httpd.py', headers={'Range': 'bytes=10-19'})
+    resp = conn.getresponse()
+    self.assertEqual(206, resp.status)
+    self.assertEqual(body[10:20], resp.read())
+
+    conn.request('GET', '/httpd.py', headers={'Range': 'bytes=0-1,-3'})
+    resp = conn.getresponse()
+    self.assertEqual(206, resp.status)
+    multi = resp.read()
+    self.assertTrue(multi.startswith('\r\n--'))
+    self.assertTrue(('\r\n\r\n' + body[-3:] + '\r\n') in multi)
+    conn.close()
+
+    s.shutdown()
+    t.join(5)
+    s.server_close()
+
+
+class CompressedHandler(httpd.BaseRequestHandler):
+  server_version = "test"
+  compressor = httpd._Compressor()
+
+  def log_message(self, *args):
+    pass
+
+
+class CompressTest(unittest.TestCase):
+
+  def setUp(self):
+    CompressedHandler.root_dir = tempfile.mkdtemp(prefix='httpd_test')
+    self.path = os.path.join(CompressedHandler.root_dir, 'a.txt')
+
+  def tearDown(self):
+    shutil.rmtree(CompressedHandler.root_dir)
+
+  def _Get(self, conn):
+    conn.request('GET', '/a.txt', headers={'Accept-Encoding': 'gzip'})
+    resp = conn.getresponse()
+    body = resp.read()
+    if resp.getheader('Content-Encoding') == 'gzip':
+      return 'gzip', zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    return None, body
+
+  def testVariantIsMadeInBackground(self):
+    with open(self.path, 'w') as f:
+      f.write('a' * 1000)
+    s, t = _StartServer(httpd.ThreadedHTTPServer, CompressedHandler)
+    conn = httplib.HTTPConnection('localhost', s.server_address[1])
+
+    # The first request doesn't wait for the compressed copy.
+    self.assertEqual((None, 'a' * 1000), self._Get(conn))
+    CompressedHandler.compressor.Wait()
+    self.assertEqual(('gzip', 'a' * 1000), self._Get(conn))
+
+    # Rewrite it with the same size and an older mtime.  The old variant isn't
+    # served.
+    st = os.stat(self.path)
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w') as f:
+      f.write('b' * 1000)
+    os.utime(tmp, (st.st_atime - 10, st.st_mtime - 10))
+    os.rename(tmp, self.path)
+
+    self.assertEqual((None, 'b' * 1000), self._Get(conn))
+    CompressedHandler.compressor.Wait()
+    self.assertEqual(('gzip', 'b' * 1000), self._Get(conn))
+    conn.close()
+
+    s.shutdown()
+    t.join(5)
+    s.server_close()
+
+
+class KeepAliveTest(unittest.TestCase):
+
+  def testKeepAlive(self):
+    for server_class in (httpd.ThreadedHTTPServer, httpd.EventLoopHTTPServer):
+      s, t = _StartServer(server_class, HelloHandler)
+      conn = httplib.HTTPConnection('localhost', s.server_address[1])
+      for path in ('/a', '/b'):
+        conn.request('GET', path)
+        resp = conn.getresponse()
+        self.assertEqual('hello ' + path, resp.read())
+        self.assertFalse(resp.will_close)
+      # Both requests went over the same socket.
+      self.assertTrue(conn.sock is not None)
+      conn.close()
+
+      s.shutdown()
+      t.join(5)
+      s.server_close()
+
+  def testIdleConnectionGivesUpPooledThread(self):
+    s, t = _StartServer(httpd.ThreadedHTTPServer, HelloHandler, num_threads=1)
+    port = s.server_address[1]
+
+    # This connection stays open, on the only thread.
+    conn1 = httplib.HTTPConnection('localhost', port)
+    conn1.request('GET', '/a')
+    self.assertEqual('hello /a', conn1.getresponse().read())
+
+    # But another connection still gets served.
+    start = time.time()
+    conn2 = httplib.HTTPConnection('localhost', port, timeout=5)
+    conn2.request('GET', '/b')
+    self.assertEqual('hello /b', conn2.getresponse().read())
+    self.assertTrue(time.time() - start < 5)
+
+    conn1.close()
+    conn2.close()
+    s.shutdown()
+    t.join(5)
+    s.server_close()
+
+
 if __name__ == '__main__':
   unittest.main()
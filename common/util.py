@@ -28,7 +28,8 @@ class Logger(object):
 
 
 def GetPackageDir():
-  this_dir = os.path.dirname(sys.argv[0])  # webpipe subdir
+  # Absolute, since plugins are run in the session dir.
+  this_dir = os.path.dirname(os.path.abspath(sys.argv[0]))  # webpipe subdir
   return os.path.dirname(this_dir)  # root of package
 
 
@@ -13,8 +13,10 @@ Latch server (based on code from polyweb repo).
 import optparse
 import re
 import os
+import posixpath
 import sys
 import threading
+import urllib
 
 import jsontemplate
 
@@ -161,6 +163,9 @@ HOME_PAGE = jsontemplate.Template("""\
 
 LATCH_PATH_RE = re.compile(r'/-/latch/(\S+)$')
 
+# A POST body bigger than this isn't read; the connection is closed instead.
+MAX_POST_BYTES = 64 << 10
+
 # TODO: Rewrite latch.js using raw XHR, and get rid of jQuery.  This could
 # interfere with pages that have jQuery already.
 LATCH_HEAD = """\
@@ -184,28 +189,39 @@ class LatchRequestHandler(httpd.BaseRequestHandler):
   latch_js = None
 
   def send_index(self):
-    self.send_response(200)
-    self.send_header('Content-Type', 'text/html')
-    self.end_headers()
-    
     pages = os.listdir(self.root_dir)
     pages.sort(reverse=True)
     html = HOME_PAGE.expand({'pages': pages})
-    self.wfile.write(html)
-
-  def send_content(self, content_type, body):
-    self.send_response(200)
-    self.send_header('Content-Type', content_type)
-    self.end_headers()
-
-    self.wfile.write(body)
+    self.send_content('text/html', html)
 
   def send_404(self, msg):
+    body = msg + '\n'
     self.send_response(404)
     self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(body)))
     self.end_headers()
 
-    self.wfile.write(msg + '\n')
+    self.wfile.write(body)
+
+  def send_latched_html(self, path):
+    """Serve an HTML file, replacing the latch placeholders.
+
+    The body is built in memory, because it has a different length than the
+    file.
+    """
+    out = []
+    with open(path) as f:
+      for line in f:
+        stripped = line.strip()
+        if stripped == '<!-- INSERT LATCH JS -->':
+          out.append(LATCH_HEAD)
+          log('replaced %r', stripped)
+        elif stripped == '<!-- INSERT LATCH HTML -->':
+          out.append(LATCH_BODY)
+          log('replaced %r', stripped)
+        else:
+          out.append(line)
+    self.send_content('text/html', ''.join(out))
 
   def do_GET(self):
     """Serve a GET request."""
@@ -234,26 +250,48 @@ class LatchRequestHandler(httpd.BaseRequestHandler):
       self.send_content('text/plain', 'ok')
       return
 
-    # Serve static file.
-    # TODO: if it ends with HTML, search for <!-- INSERT LATCH JS -->
+    # Serve static file.  If it's HTML, search for <!-- INSERT LATCH JS -->.
+
+    url = posixpath.normpath(urllib.unquote(self.path.split('?', 1)[0]))
+    path = self.url_to_fs_path(url)
+    if self.path.endswith('/'):
+      path = os.path.join(path, 'index.html')
+    if path.endswith('.html') and os.path.isfile(path):
+      self.send_latched_html(path)
+      return
 
     f = self.send_head()
     if f:
-      for line in f:
-        stripped = line.strip()
-        if stripped == '<!-- INSERT LATCH JS -->':
-          out = LATCH_HEAD
-          log('replaced %r', stripped)
-        elif stripped == '<!-- INSERT LATCH HTML -->':
-          out = LATCH_BODY
-          log('replaced %r', stripped)
-        else:
-          out = line
-        self.wfile.write(out)
+      self.copyfile(f, self.wfile)
       f.close()
 
+  def discard_body(self):
+    """Read the request body, which we don't use.
+
+    Otherwise it would be parsed as the next request on a persistent
+    connection.  If it can't be read cheaply, the connection is closed.
+    """
+    if self.headers.getheader('Transfer-Encoding'):
+      self.close_connection = 1
+      return
+    try:
+      length = int(self.headers.getheader('Content-Length') or 0)
+    except ValueError:
+      length = -1
+    if not 0 <= length <= MAX_POST_BYTES:
+      self.close_connection = 1
+      return
+    while length > 0:
+      chunk = self.rfile.read(length)
+      if not chunk:
+        self.close_connection = 1
+        return
+      length -= len(chunk)
+
   def do_POST(self):
     """Serve a POST request."""
+    self.discard_body()
+
     m = LATCH_PATH_RE.match(self.path)
     if not m:
       self.send_404('invalid resource %r' % self.path)
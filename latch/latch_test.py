@@ -8,8 +8,12 @@
 latch_test.py: Tests for latch.py
 """
 
+import httplib
+import threading
 import unittest
 
+from common import httpd
+
 import latch  # module under test
 
 
@@ -28,5 +32,34 @@ class LatchTest(unittest.TestCase):
     self.assertEqual(False, success)
 
 
+class _Handler(latch.LatchRequestHandler):
+  latches = latch.Latches()
+
+  def log_message(self, *args):
+    pass
+
+
+class PostTest(unittest.TestCase):
+
+  def testBodyIsRead(self):
+    s = httpd.ThreadedHTTPServer(('localhost', 0), _Handler)
+    t = threading.Thread(target=s.serve_forever, args=(0.05,))
+    t.setDaemon(True)
+    t.start()
+
+    conn = httplib.HTTPConnection('localhost', s.server_address[1], timeout=5)
+    for _ in xrange(2):
+      # The body isn't mistaken for the next request on the connection.
+      conn.request('POST', '/-/latch/foo', body='x=1')
+      resp = conn.getresponse()
+      self.assertEqual(404, resp.status)  # nobody is waiting
+      self.assertEqual("no latch named 'foo'\n", resp.read())
+    conn.close()
+
+    s.shutdown()
+    t.join(5)
+    s.server_close()
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -7,10 +7,20 @@
 """
 csv_plugin.py
 
-This is in process in xrender.py until we work out packaging issues.
+xrender.py calls Render() in process.  Running this file through the 'render'
+wrapper is the fallback, e.g. if jsontemplate can't be imported there.
+
+Only the preview is rendered up front.  The full DataTables page is declared
+in the part's deferred.json, and the server renders it with RenderDeferred()
+when it's first opened (see DeferredRenders in webpipe/xrender.py).
+
+A file that isn't in the small size tier is linked rather than copied, and has
+no full page.  A huge one isn't previewed either.
 """
 
+import collections
 import csv
+import json
 import os
 import shutil
 import sys
@@ -104,7 +114,11 @@ bytes</p>
 
       <tr>
         <td colspan="{num_cols}" style="text-align: center; font-style: italic;">
-          ... <a href="{output}/full.html">{num_omitted|commas} rows omitted</a>
+          {.section full}
+          ... <a href="{output}/{@}">{num_omitted|commas} rows omitted</a>
+          {.or}
+          ... {num_omitted|commas} rows omitted
+          {.end}
         </td>
       </tr>
 
@@ -127,10 +141,19 @@ bytes</p>
 """, default_formatter='html', more_formatters=FORMATTERS)
 
 
+HUGE_TEMPLATE = jsontemplate.Template("""\
+<p><code>{basename}</code> - {num_bytes|commas} bytes.  <i>Too big to
+preview.</i></p>
+
+<p><a href="{output}/{basename}">Download Original CSV</a></p>
+
+""", default_formatter='html', more_formatters=FORMATTERS)
+
+
 # User setting for how many lines of head/tail they want to see.
-wp_num_lines = os.getenv('WP_NUM_LINES', 5)
+wp_num_lines = int(os.getenv('WP_NUM_LINES', 5))
+
 
-# TODO: avoid loading the entire thing in memory?
 def CsvDataDict(f):
   """
   Turn CSV into an HTML table.
@@ -138,64 +161,139 @@ def CsvDataDict(f):
   TODO: maximum number of rows.
   """
   c = csv.reader(f)
-  rows = []
-  d = {'rows': rows}
+  d = {'thead': next(c, [])}
+  d['rows'] = rows = list(c)
+  d['num_rows'] = len(rows)
+  return d
+
+
+def CsvPreviewDict(f):
+  """Like CsvDataDict, but only keeps the rows the preview shows.
 
+  The rows are streamed and counted, so memory use doesn't depend on the size
+  of the file.
+  """
+  n = wp_num_lines
+  c = csv.reader(f)
+  d = {'thead': next(c, [])}
+
+  # If wp_num_lines is 5, then we should show in full anything less than 15
+  # rows.
+  first = []
+  last = collections.deque(maxlen=n)
   num_rows = 0
-  for i, row in enumerate(c):
-    #print 'R', row
-    if i == 0:
-      d['thead'] = row
+  for row in c:
+    if len(first) < n * 3:
+      first.append(row)
     else:
-      rows.append(row)
+      last.append(row)
     num_rows += 1
 
-  # wp_num_lines is 5, then we should show in full anything less than 15 rows
-  if len(rows) >= wp_num_lines * 3:
-    d['num_omitted'] = num_rows - (wp_num_lines * 2)
-    d['head'] = head = rows[ : wp_num_lines]
-    d['tail'] = rows[-wp_num_lines : ]
-
-  d['num_rows'] = num_rows - 1  # omit one that we counted as the header
+  if num_rows < n * 3:
+    d['rows'] = first
+  else:
+    d['num_omitted'] = num_rows - n * 2
+    d['head'] = first[:n]
+    d['tail'] = (first + list(last))[-n:]
 
+  d['num_rows'] = num_rows
   return d
 
 
-def main(argv):
-  """Returns an exit code."""
+# Must match xrender.DEFERRED_NAME
+DEFERRED_NAME = 'deferred.json'
 
-  # Assume we're in the output dir
-  input_path, output = argv[1:]
+# Rendered when it's first requested
+FULL_NAME = 'full.html'
 
-  os.mkdir(output)
-  basename = os.path.basename(input_path)
-  orig = os.path.join(output, basename)
-  
-  num_bytes = os.path.getsize(input_path)
 
-  # Copy the original
-  shutil.copy(input_path, orig)
+def _DataDict(input_path, output, make_dict=CsvDataDict):
+  with open(input_path) as infile:
+    data_dict = make_dict(infile)
+  data_dict['num_bytes'] = os.path.getsize(input_path)
+  data_dict['output'] = output
+  data_dict['basename'] = os.path.basename(input_path)
+  # So we can have a colspan
+  data_dict['num_cols'] = len(data_dict['thead'])
+  return data_dict
 
-  full_html = os.path.join(output, 'full.html')
-  with open(full_html, 'w') as outfile:
-    with open(input_path) as infile:
-      data_dict = CsvDataDict(infile)
-      data_dict['num_bytes'] = num_bytes
-      data_dict['output'] = output
-      data_dict['basename'] = basename
-      # So we can have a colspan
-      data_dict['num_cols'] = len(data_dict['thead'])
 
-    outfile.write(TABLE_TEMPLATE.expand(data_dict))
+def Render(input_path, output, out_dir, tier=None):
+  """Write <output>.html, and the directory <output> with the original CSV.
 
-  print output  # finished the dir
+  This is the in-process plugin entry point.  It must not change the working
+  directory, since xrender may be rendering other parts on other threads.
+
+  Args:
+    tier: The input's size tier from xrender.  Only a small input is copied
+      and gets a full table.
+
+  Returns:
+    The files and directories created, relative to out_dir.
+  """
+  size_tier = tier['sizeTier'] if tier else 'small'
+  out_subdir = os.path.join(out_dir, output)
+  os.mkdir(out_subdir)
+  basename = os.path.basename(input_path)
+  orig = os.path.join(out_subdir, basename)
+
+  if size_tier == 'small':
+    # Copy the original
+    shutil.copy(input_path, orig)
+    with open(os.path.join(out_subdir, DEFERRED_NAME), 'w') as f:
+      json.dump({'fileType': 'csv', 'input': basename, 'files': [FULL_NAME]},
+                f)
+  else:
+    os.symlink(os.path.abspath(input_path), orig)
+
+  if size_tier == 'huge':
+    data_dict = {'num_bytes': os.path.getsize(input_path), 'output': output,
+                 'basename': basename}
+    template = HUGE_TEMPLATE
+  else:
+    data_dict = _DataDict(input_path, output, make_dict=CsvPreviewDict)
+    if size_tier == 'small':
+      data_dict['full'] = FULL_NAME
+    template = PREVIEW_TEMPLATE
 
   html = output + '.html'
-  with open(html, 'w') as f:
-    # TODO: check how many rows, and write head/tail, or full thing.
-    f.write(PREVIEW_TEMPLATE.expand(data_dict))
+  with open(os.path.join(out_dir, html), 'w') as f:
+    f.write(template.expand(data_dict))
+
+  return [output, html]  # the dir is finished before the html
+
 
-  print html  # wrote html
+def RenderDeferred(input_path, name, out_path):
+  """Write the full table for the copy of the CSV in the part directory."""
+  if name != FULL_NAME:
+    raise Error('Unknown deferred file %r' % name)
+  output = os.path.basename(os.path.dirname(os.path.abspath(input_path)))
+  data_dict = _DataDict(input_path, output)
+  with open(out_path, 'w') as f:
+    f.write(TABLE_TEMPLATE.expand(data_dict))
+
+
+def main(argv):
+  """Returns an exit code."""
+
+  if argv[1:2] == ['--deferred']:
+    name, input_path, out_path = argv[2:]
+    RenderDeferred(input_path, name, out_path)
+    return 0
+
+  # Assume we're in the output dir
+  input_path, output = argv[1:]
+  # The same fields that Render() gets in process
+  tier = None
+  if 'WEBPIPE_SIZE_TIER' in os.environ:
+    tier = {
+        'sizeTier': os.environ['WEBPIPE_SIZE_TIER'],
+        'inputBytes': os.environ.get('WEBPIPE_INPUT_BYTES', ''),
+        'previewBytes': os.environ.get('WEBPIPE_PREVIEW_BYTES', ''),
+        }
+
+  for name in Render(input_path, output, '.', tier=tier):
+    print name
 
   return 0
 
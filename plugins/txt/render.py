@@ -0,0 +1,130 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found
+# in the LICENSE file or at https://developers.google.com/open-source/licenses/bsd
+
+"""
+txt/render.py
+
+xrender.py calls Render() in process.  When plugins are run out of process,
+the 'render' script runs this file for big inputs.
+
+A file that's too big to show all of it is memory-mapped, and only a window at
+its head and tail is escaped and shown.  The part directory gets a link to the
+input, and the server pages through the rest of it (see webpipe/textpages.py).
+"""
+
+import cgi
+import mmap
+import os
+import sys
+
+# The head and tail windows have this many lines, but no more than this many
+# bytes, in case the lines are long.
+WINDOW_LINES = 200
+WINDOW_BYTES = 64 << 10
+
+# Must match textpages.INPUT_NAME
+INPUT_NAME = 'input'
+
+PAGED_TEMPLATE = """\
+<p><i>%(size)s bytes.  Showing the first %(num_head)d and last %(num_tail)d
+lines.</i>  <a href="%(output)s/input">Download</a></p>
+<pre>
+%(head)s</pre>
+<p><a href="%(output)s/lines?start=%(next)d">Page through the rest</a></p>
+<pre>
+%(tail)s</pre>
+"""
+
+
+def Commas(n):
+  return '{:,}'.format(n)
+
+
+def _Escape(lines):
+  return ''.join(cgi.escape(line, quote=True) + '\n' for line in lines)
+
+
+def HeadLines(data):
+  """Returns the lines at the start of data, and the number of the next one.
+
+  The last line can be cut off by WINDOW_BYTES, and is then shown in full on
+  the next page.
+  """
+  lines = data[:WINDOW_BYTES].split('\n')
+  if len(lines) > WINDOW_LINES:
+    return lines[:WINDOW_LINES], WINDOW_LINES
+  return lines, len(lines) - 1
+
+
+def TailLines(data):
+  """Returns the lines at the end of data."""
+  start = max(0, len(data) - WINDOW_BYTES)
+  chunk = data[start:]
+  if chunk.endswith('\n'):
+    chunk = chunk[:-1]
+  lines = chunk.split('\n')
+  if start > 0 and len(lines) > 1:
+    lines = lines[1:]  # cut off by the window
+  return lines[-WINDOW_LINES:]
+
+
+def Render(input_path, output, out_dir, tier=None):
+  """Write <output>.html, and for a big input, the directory <output>.
+
+  Args:
+    tier: The input's size tier from xrender.  A small input is shown in full.
+  """
+  html_path = os.path.join(out_dir, output + '.html')
+  size = os.path.getsize(input_path)
+
+  if tier is None or tier['sizeTier'] == 'small':
+    with open(input_path) as f:
+      text = f.read()
+    with open(html_path, 'w') as f:
+      f.write('<pre>\n')
+      f.write(cgi.escape(text, quote=True))
+      f.write('</pre>\n')
+    return [output + '.html']
+
+  with open(input_path) as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    head, next_line = HeadLines(data)
+    tail = TailLines(data)
+  finally:
+    data.close()
+
+  part_dir = os.path.join(out_dir, output)
+  os.mkdir(part_dir)
+  os.symlink(os.path.abspath(input_path), os.path.join(part_dir, INPUT_NAME))
+
+  with open(html_path, 'w') as f:
+    f.write(PAGED_TEMPLATE % {
+        'size': Commas(size), 'output': output, 'next': next_line,
+        'num_head': len(head), 'head': _Escape(head),
+        'num_tail': len(tail), 'tail': _Escape(tail)})
+  return [output, output + '.html']
+
+
+def main(argv):
+  """Returns an exit code."""
+  input_path = argv[1]
+  output = argv[2]
+  # The same fields, from the environment
+  tier = None
+  if 'WEBPIPE_SIZE_TIER' in os.environ:
+    tier = {
+        'sizeTier': os.environ['WEBPIPE_SIZE_TIER'],
+        'inputBytes': os.environ.get('WEBPIPE_INPUT_BYTES', ''),
+        'previewBytes': os.environ.get('WEBPIPE_PREVIEW_BYTES', ''),
+        }
+  for name in Render(input_path, output, '.', tier=tier):
+    print name
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -43,3 +43,32 @@ WP_HtmlEscape() {
   sed 's|&|\&amp;|g; s|<|\&lt;|g; s|>|\&gt;|g; s|"|\&quot;|g'
 }
 
+# xrender tells plugins how big their input is (see SizeTier in xrender.py):
+#
+#   small: render all of it
+#   large: render the first $WEBPIPE_PREVIEW_BYTES
+#   huge: too big to preview
+#
+# When a plugin is run by hand, it renders everything.
+
+# Print the part of a file to render.
+WP_Preview() {
+  local input=$1
+  case ${WEBPIPE_SIZE_TIER:-small} in
+    small) cat $input ;;
+    large) head -c $WEBPIPE_PREVIEW_BYTES $input ;;
+  esac
+}
+
+# Print an HTML note saying how much of the file was rendered, if not all.
+WP_SizeNote() {
+  case ${WEBPIPE_SIZE_TIER:-small} in
+    large)
+      echo "<p><i>Showing the first $WEBPIPE_PREVIEW_BYTES of" \
+           "$WEBPIPE_INPUT_BYTES bytes.</i></p>"
+      ;;
+    huge)
+      echo "<p><i>Too big to preview ($WEBPIPE_INPUT_BYTES bytes).</i></p>"
+      ;;
+  esac
+}
@@ -17,15 +17,22 @@ Blocker()
 
 """
 
+import collections
+import heapq
+import json
 import os
 import re
+import socket
 import sys
 import threading
+import time
+import urlparse
 
 from common import util
 from common import httpd
 
 import jsontemplate
+import textpages
 
 log = util.Logger(util.ANSI_BLUE)
 
@@ -101,9 +108,82 @@ PLUGINS_PAGE = jsontemplate.Template("""\
 """, default_formatter='html')
 
 
+# A page of a big text file; see textpages.py.  The links are relative to
+# /s/<session>/<partnum>/lines.
+LINES_PAGE = jsontemplate.Template("""\
+<html>
+  <head>
+    <title>{name} lines {first}-{last}</title>
+    <link href="/static/webpipe.css" rel="stylesheet">
+  </head>
+  <body>
+    <p>
+      Lines {first}-{last} of {num_lines}
+      {.section prev}<a href="lines?start={@}">previous</a>{.end}
+      {.section next}<a href="lines?start={@}">next</a>{.end}
+    </p>
+<pre>
+{.repeated section lines}{@}
+{.end}</pre>
+  </body>
+</html>
+""", default_formatter='html')
+
+
 # /s//<session>/<partnum>.html
 PATH_RE = re.compile(r'/s/(\S+)/(\d+).html$')
 
+# /s/<session>/events?from=<partnum>
+EVENTS_RE = re.compile(r'/s/(\S+)/events(?:\?from=(\d+))?$')
+
+# /s/<session>/parts?from=<partnum>&to=<partnum>
+PARTS_RE = re.compile(r'/s/(\S+)/parts(?:\?(\S*))?$')
+
+# /s/<session>/<partnum>.html?follow=<offset>, for what was appended to a part
+# that follows a file
+FOLLOW_RE = re.compile(r'/s/(\S+)/(\d+)\.html\?follow=(\d+)$')
+
+# /s/<session>/<partnum>/lines?start=<line>&count=<n>
+LINES_RE = re.compile(r'/s/(\S+)/(\d+)/lines(?:\?(\S*))?$')
+
+# /s/<session>/<partnum>/<file>, which may be rendered on demand
+PART_FILE_RE = re.compile(r'/s/\S+/\d+/[^/?]+$')
+
+def IsSafeSession(session):
+  """Is session a single directory name under s/?
+
+  The session in a URL is joined with user_dir, so it can't be allowed to
+  climb out of it, e.g. /s/../../etc/parts.
+  """
+  return '/' not in session and session not in ('', '.', '..')
+
+
+# Lines on a page of a big text file, by default and at most
+PAGE_LINES = 500
+MAX_PAGE_LINES = 5000
+
+# Maximum number of parts returned by one /parts request.
+MAX_BATCH = 200
+
+# Cache-Control values.  Finished parts never change, so the browser can keep
+# them forever.
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+CACHE_REVALIDATE = 'no-cache'
+
+# When too many requests are waiting for parts, the client is told to retry
+# after this many seconds.
+RETRY_AFTER_SECS = 2
+
+# <partnum>.html or the <partnum> dir
+PART_RE = re.compile(r'(\d+)(?:\.html)?$')
+
+# While a part is being streamed, the file is checked for new output this
+# often.
+STREAM_POLL_SECS = 0.01
+
+# Maximum size of a chunk when streaming a part.
+STREAM_CHUNK_SIZE = 64 << 10
+
 
 def _ListPlugins(root_dir):
   """
@@ -139,12 +219,16 @@ class WaitingRequestHandler(httpd.BaseRequestHandler):
   package_dir = None  # initialize to /<package>/webpipe
   waiters = None
   active_scroll = None
+  part_cache = None  # PartCache instance, or None
+  render_cache = None  # RenderCache, when rendering in this process
+  coprocesses = None  # xrender.Coprocesses, when rendering in this process
+  followers = None  # xrender.Followers, when rendering in this process
+  deferred = None  # xrender.DeferredRenders
+  latency_stats = None  # set below; shared by all handlers
+  # Seconds to wait for a part before answering "nothing yet", or None
+  wait_timeout = None
 
   def send_webpipe_index(self):
-    self.send_response(200)
-    self.send_header('Content-Type', 'text/html')
-    self.end_headers()
-    
     s_root = os.path.join(self.user_dir, 's')
     scrolls = os.listdir(s_root)
     scrolls.sort(reverse=True)
@@ -156,20 +240,16 @@ class WaitingRequestHandler(httpd.BaseRequestHandler):
       pass
 
     h = HOME_PAGE.expand({'scrolls': scrolls, 'active_scroll': self.active_scroll})
-    self.wfile.write(h)
+    self.send_content('text/html', h)
 
   def send_plugins_index(self):
-    self.send_response(200)
-    self.send_header('Content-Type', 'text/html')
-    self.end_headers()
-    
     # Session are saved on disk; allow the user to choose one.
 
     u = _ListPlugins(self.user_dir)
     p = _ListPlugins(self.package_dir)
 
     html = PLUGINS_PAGE.expand({'user': u, 'package': p})
-    self.wfile.write(html)
+    self.send_content('text/html', html)
 
   def url_to_fs_path(self, url):
     """Translate a URL to a local file system path.
@@ -219,32 +299,648 @@ class WaitingRequestHandler(httpd.BaseRequestHandler):
 
     if self.path == '/plugins':
       # As is done in send_head
-      self.send_response(301)
-      self.send_header("Location", self.path + "/")
-      self.end_headers()
+      self.send_redirect(self.path + "/")
       return
 
     if self.path == '/plugins/':
       self.send_plugins_index()
       return
 
+    if self.path == '/-/stats':
+      self.send_stats()
+      return
+
+    m = EVENTS_RE.match(self.path)
+    if m:
+      session, start = m.groups()
+      self.send_events(session, start)
+      return
+
+    m = PARTS_RE.match(self.path)
+    if m:
+      session, query = m.groups()
+      self.send_parts(session, query)
+      return
+
+    m = FOLLOW_RE.match(self.path)
+    if m:
+      session, num, offset = m.groups()
+      self.send_follow(session, int(num), int(offset))
+      return
+
+    m = LINES_RE.match(self.path)
+    if m:
+      session, num, query = m.groups()
+      self.send_lines(session, int(num), query)
+      return
+
     m = PATH_RE.match(self.path)
     if m:
       session, num = m.groups()
       num = int(num)
 
       waiter = self.waiters.get(session)
-      if waiter is not None:
+      # HEAD reports what's there now, without waiting.
+      if waiter is not None and self.command != 'HEAD':
         log('PATH: %s', self.path)
+        if self.maybe_stream_part(waiter, session, num):
+          return
+
+        # With an event loop server, register a callback instead of blocking
+        # this thread.
+        resume = lambda: self.send_waited_part(waiter, session, num)
+        callback = None
+        if self.server.can_park:
+          callback = lambda: self.server.Resume(self, resume)
 
+        waited = waiter.Length() <= num
         log('MaybeWait session %r, part %d', session, num)
-        result = waiter.MaybeWait(num)
+        result = waiter.MaybeWait(num, callback=callback,
+                                  timeout=self.wait_timeout,
+                                  still_wanted=self.client_connected,
+                                  stream=not self.server.can_park)
+        if result == WAIT_PARKED:
+          log('Parked %d', num)
+          self.park_wait(waiter, num, callback, resume, self.send_no_part)
+          return
+        if result == WAIT_TOO_BUSY:
+          self.send_busy()
+          return
+        if result == WAIT_TIMEOUT:
+          self.send_no_part()
+          return
+        if result == WAIT_CANCELLED:
+          self.close_connection = 1
+          return
         log('Done %d', num)
-        # result could be:
-        # 404: too big
-        # 503: 503
+        if result == WAIT_OK and waited:
+          resume()
+          return
+        # WAIT_TOO_BIG falls through to a 404.
 
-    # Serve static file.
+      self.send_part(session, num)
+      return
+
+    if self.deferred and PART_FILE_RE.match(self.path):
+      path = self.url_to_fs_path(self.path)
+      if self.server.can_park and not os.path.exists(path):
+        self.park_deferred(path)
+        return
+      if not self.render_deferred(path):
+        return
+
+    self.send_static()
+
+  def render_deferred(self, path):
+    """Render a file of a part if it's requested for the first time.
+
+    Returns:
+      False if there was an error, and it was sent.
+    """
+    error = self.deferred.Render(path)
+    if error:
+      self.send_error(500, error)
+      return False
+    return True
+
+  def park_deferred(self, path):
+    """Like render_deferred(), but the plugin runs on another thread.
+
+    With an event loop server, running it here would stall every client.  The
+    request is parked, and the file is sent when it's done.
+    """
+    def Render():
+      error = self.deferred.Render(path)
+      self.server.Resume(self, lambda: self.send_deferred(error))
+
+    self.wait_state = None  # not waiting for a part; see park_ended()
+    self.park()
+    t = threading.Thread(target=Render)
+    t.setDaemon(True)
+    t.start()
+
+  def send_deferred(self, error):
+    if error:
+      self.send_error(500, error)
+    else:
+      self.send_static()
+
+  def send_waited_part(self, waiter, session, num):
+    """Send a part the client was waiting for, and record the latency."""
+    if self.maybe_stream_part(waiter, session, num):
+      return
+    self.send_part(session, num)
+    info = waiter.PartInfo(num)
+    if info and info.get('rendered'):
+      self.latency_stats.Record(time.time() - info['rendered'])
+
+  def maybe_stream_part(self, waiter, session, num):
+    """Stream part num if it's still being written.
+
+    Returns:
+      False if it isn't, or if this server can't tie up a thread with it.
+    """
+    if self.server.can_park:
+      return False
+    path = waiter.StreamPath(num)
+    if path is None:
+      return False
+    log('Streaming part %d of session %r from %s', num, session, path)
+    try:
+      self.stream_part(waiter, session, num, path)
+    except socket.error, e:
+      log('Stream of part %d closed: %s', num, e)
+      self.close_connection = 1
+    return True
+
+  def stream_part(self, waiter, session, num, path, offset=0,
+                  still_growing=None, idle_secs=None):
+    """Send the output of a plugin as it writes it.
+
+    The response has chunked transfer encoding, and it ends when the renderer
+    says the part is done.  A HEAD request just gets the headers.
+
+    A stream ties up a thread, so it counts against the waiter limit like a
+    blocked wait does.  If the limit is reached, the client is told to come
+    back later.
+
+    Args:
+      offset: where in the file to start
+      still_growing: function that returns False when the file is done.  By
+        default, the part is done when it's announced.
+      idle_secs: If set, end the response when nothing is written for this
+        long.  The client can ask again for the rest.
+    """
+    if self.command == 'HEAD':
+      self.send_stream_headers()
+      return
+
+    if still_growing is None:
+      still_growing = lambda: waiter.StreamPath(num) is not None
+
+    limit = waiter.limit
+    if limit and not limit.Acquire():
+      log('Too many waiters to stream part %d', num)
+      self.send_busy()
+      return
+    try:
+      self.stream_file(session, num, path, offset, still_growing, idle_secs)
+    finally:
+      if limit:
+        limit.Release()
+
+  def send_stream_headers(self):
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/html')
+    self.send_header('Transfer-Encoding', 'chunked')
+    self.send_header('Cache-Control', CACHE_REVALIDATE)
+    self.end_headers()
+
+  def stream_file(self, session, num, path, offset, still_growing,
+                   idle_secs):
+    fd = None
+    while fd is None:
+      try:
+        fd = os.open(path, os.O_RDONLY)
+      except OSError:
+        # The plugin hasn't created it yet, or it was just moved into place.
+        if not still_growing():
+          self.send_part(session, num)
+          return
+        time.sleep(STREAM_POLL_SECS)
+
+    try:
+      os.lseek(fd, offset, os.SEEK_SET)
+      self.send_stream_headers()
+
+      num_bytes = 0
+      done = False
+      last_write = time.time()
+      last_check = last_write
+      while True:
+        chunk = os.read(fd, STREAM_CHUNK_SIZE)
+        if chunk:
+          self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+          self.wfile.flush()
+          num_bytes += len(chunk)
+          last_write = time.time()
+          continue
+        if done:
+          break
+        # The file stays open when it's moved into place, so after the part is
+        # done, read to the end once more.
+        done = not still_growing()
+        if not done:
+          now = time.time()
+          if idle_secs is not None and now - last_write >= idle_secs:
+            break
+          if now - last_check >= CANCEL_POLL_SECS:
+            if not self.client_connected():
+              break
+            last_check = now
+          time.sleep(STREAM_POLL_SECS)
+      self.wfile.write('0\r\n\r\n')
+      self.transfer_stats.Add(copied_bytes=num_bytes)
+    finally:
+      os.close(fd)
+
+  def send_follow(self, session, num, offset):
+    """Send what was appended to a part after offset.
+
+    While the part is following a file, new output is streamed.  When there's
+    nothing more and the part has stopped growing, the response is a 204.
+    """
+    if not IsSafeSession(session):
+      self.send_error(404, "Part not found")
+      return
+    path = os.path.join(self.user_dir, 's', session, '%d.html' % num)
+    waiter = self.waiters.get(session)
+    following = waiter is not None and waiter.FollowPath(num) is not None
+
+    if following and not self.server.can_park:
+      try:
+        self.stream_part(
+            waiter, session, num, path, offset=offset,
+            still_growing=lambda: waiter.FollowPath(num) is not None,
+            idle_secs=self.wait_timeout)
+      except socket.error, e:
+        log('Stream of part %d closed: %s', num, e)
+        self.close_connection = 1
+      return
+
+    # With an event loop server, the client polls instead.
+    try:
+      with open(path) as f:
+        f.seek(offset)
+        body = f.read()
+    except IOError:
+      self.send_error(404, "Part not found")
+      return
+    if not body and not following:
+      self.send_response(204)
+      self.send_header('Content-Length', '0')
+      self.send_header('Cache-Control', CACHE_REVALIDATE)
+      self.end_headers()
+      return
+    self.send_content('text/html', body)
+
+  def client_connected(self):
+    return not httpd.PeerClosed(self.connection)
+
+  def park_wait(self, waiter, n, callback, resume, on_timeout):
+    """Park until part n exists.
+
+    The waiter calls callback, which calls resume().  If the part doesn't come
+    within wait_timeout, on_timeout() is called instead.
+    """
+    self.wait_state = (waiter, n, callback, resume, on_timeout)
+    self.park(timeout=self.wait_timeout)
+
+  def park_ended(self, timed_out):
+    if self.wait_state is None:
+      return  # the client left during a deferred render
+    waiter, n, callback, resume, on_timeout = self.wait_state
+    if waiter.Cancel(n, callback):
+      if timed_out:
+        on_timeout()
+    elif timed_out:
+      # The part arrived just now, and Resume() came too late.
+      resume()
+
+  def send_no_part(self):
+    """Tell a long-polling client that there's no new part yet."""
+    self.send_response(204)
+    # Try again right away.
+    self.send_header('Retry-After', '0')
+    self.send_header('Content-Length', '0')
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+
+  def send_busy(self):
+    """Tell the client to come back later."""
+    body = 'Too many requests are waiting for parts.\n'
+    self.send_response(503)
+    self.send_header('Retry-After', str(RETRY_AFTER_SECS))
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def send_stats(self):
+    """Send server counters as JSON."""
+    stats = {'transfer': self.transfer_stats.Stats()}
+    stats['waiters'] = dict(
+        (session, waiter.NumWaiters())
+        for session, waiter in self.waiters.iteritems())
+    stats['lastParts'] = dict(
+        (session, waiter.PartInfo(waiter.Length() - 1))
+        for session, waiter in self.waiters.iteritems())
+    stats['renderToBrowser'] = self.latency_stats.Stats()
+    if self.part_cache:
+      stats['partCache'] = self.part_cache.Stats()
+    if self.render_cache:
+      stats['renderCache'] = self.render_cache.Stats()
+    if self.coprocesses:
+      stats['coprocesses'] = self.coprocesses.Stats()
+    if self.followers:
+      stats['followers'] = self.followers.Stats()
+    if self.deferred:
+      stats['deferred'] = self.deferred.Stats()
+    body = json.dumps(stats, indent=2, sort_keys=True)
+    self.send_content('application/json', body)
+
+  def send_part(self, session, num):
+    """Serve <num>.html from the part cache, falling back to disk."""
+    body = None
+    if self.part_cache and not self.is_growing(session, num):
+      body = self.part_cache.Get(session, num)
+    if body is None:
+      self.send_static()
+      return
+
+    etag = httpd.ContentETag(body)
+    if len(body) >= httpd.MIN_COMPRESS_SIZE:
+      for encoding in self.accepted_encodings():
+        # Compress once, and cache that too.
+        compressed = self.part_cache.Get(session, num, encoding=encoding)
+        if compressed is None:
+          compressed = httpd.Compress(body, encoding)
+          self.part_cache.Put(session, num, compressed, encoding=encoding)
+        self.send_content('text/html', compressed,
+                          etag=etag[:-1] + '-' + encoding + '"',
+                          encoding=encoding)
+        return
+
+    self.send_content('text/html', body, etag=etag)
+
+  def cache_control(self, url):
+    """Let browsers keep finished parts and plugin static assets.
+
+    The frontier part, index pages, etc. are revalidated.
+    """
+    parts = [p for p in url.split('/') if p]
+
+    # /plugins/<name>/static/<file>
+    if len(parts) >= 4 and parts[0] == 'plugins' and parts[2] == 'static':
+      return CACHE_IMMUTABLE
+
+    # The file behind a paged text part can change.
+    if len(parts) == 4 and parts[0] == 's' and parts[3] == 'lines':
+      return CACHE_REVALIDATE
+
+    # /s/<session>/<partnum>.html or /s/<session>/<partnum>/...
+    if len(parts) >= 3 and parts[0] == 's':
+      m = PART_RE.match(parts[2])
+      if m:
+        num = int(m.group(1))
+        waiter = self.waiters.get(parts[1])
+        # An old scroll isn't going to change.
+        if waiter is None:
+          return CACHE_IMMUTABLE
+        if num < waiter.counter:
+          # Except that a placeholder is replaced when rendering is done, and
+          # a followed file's part grows.
+          if waiter.IsPlaceholder(num):
+            return CACHE_REVALIDATE
+          if waiter.FollowPath(num) is not None:
+            return CACHE_REVALIDATE
+          return CACHE_IMMUTABLE
+
+    return CACHE_REVALIDATE
+
+  def send_events(self, session, start):
+    """Stream parts as Server-Sent Events over a single connection.
+
+    Each part is an event with id <partnum> and the part's HTML as data.  When
+    the browser reconnects, it sends Last-Event-ID, and we resume after it.
+    """
+    last_id = self.headers.getheader('Last-Event-ID')
+    if last_id and last_id.isdigit():
+      self.next_event = int(last_id) + 1
+    elif start:
+      self.next_event = int(start)
+    else:
+      self.next_event = 1
+
+    self.events_session = session
+    self.events_waiter = self.waiters.get(session)
+    if (not IsSafeSession(session) or
+        not os.path.isdir(os.path.join(self.user_dir, 's', session))):
+      self.send_error(404, "Session not found")
+      return
+
+    log('Streaming events for session %r from part %d', session,
+        self.next_event)
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Cache-Control', 'no-cache')
+    # The stream has no length, so it ends when the connection does.
+    self.send_header('Connection', 'close')
+    self.end_headers()
+    if self.command == 'HEAD':
+      return
+
+    self.push_events()
+
+  def push_events(self):
+    """Write an event for each part that exists, then wait for the next one.
+
+    With a threaded server, this loops until the client goes away.  With an
+    event loop server, it parks the connection and is called again by
+    Notify().
+    """
+    waiter = self.events_waiter
+    try:
+      while True:
+        n = self.next_event
+
+        if waiter is not None:
+          callback = None
+          if self.server.can_park:
+            callback = lambda: self.server.Resume(self, self.push_events)
+
+          result = waiter.MaybeWait(n, callback=callback,
+                                    timeout=self.wait_timeout,
+                                    still_wanted=self.client_connected)
+          if result == WAIT_PARKED:
+            self.park_wait(waiter, n, callback, self.push_events,
+                           self.resume_after_ping)
+            return
+          if result == WAIT_TIMEOUT:
+            self.write_ping()
+            continue
+          if result == WAIT_CANCELLED:
+            return
+          if result == WAIT_TOO_BUSY:
+            # EventSource reconnects after this many milliseconds.
+            self.wfile.write('retry: %d\n\n' % (RETRY_AFTER_SECS * 1000))
+            return
+          if result != WAIT_OK:
+            return
+
+        html = self.read_part(self.events_session, n)
+        if html is None and waiter is None:
+          # Not a live session: we sent what's on disk, so tell the client not
+          # to reconnect.
+          self.wfile.write('event: done\ndata: %d\n\n' % n)
+          return
+
+        if html is not None:
+          # Every line of the payload needs a data: prefix.
+          lines = ['id: %d' % n, 'event: part']
+          lines.extend('data: ' + line for line in (html.splitlines() or ['']))
+          self.wfile.write('\n'.join(lines) + '\n\n')
+          self.wfile.flush()
+        self.next_event = n + 1
+    except socket.error, e:
+      log('Event stream closed: %s', e)
+
+  def write_ping(self):
+    """Write a comment line to an idle event stream.
+
+    If the client is gone without having closed the connection, this is how we
+    find out.
+    """
+    self.wfile.write(': ping\n\n')
+    self.wfile.flush()
+
+  def resume_after_ping(self):
+    self.write_ping()
+    self.push_events()  # parks again
+
+  def send_parts(self, session, query):
+    """Send a batch of existing parts as JSON, so the client can catch up.
+
+    Query params: from=N (default 1), to=M (inclusive, optional).  Stops at
+    the first part that doesn't exist yet, and after MAX_BATCH parts.
+
+    Response: {"parts": [{"num": N, "html": ...}, ...], "next": <partnum>,
+               "more": <bool>}
+    """
+    params = urlparse.parse_qs(query or '')
+    try:
+      start = int(params.get('from', ['1'])[0])
+      end = params.get('to')
+      end = int(end[0]) if end else None
+    except ValueError:
+      self.send_error(400, "Invalid part range")
+      return
+
+    if (not IsSafeSession(session) or
+        not os.path.isdir(os.path.join(self.user_dir, 's', session))):
+      self.send_error(404, "Session not found")
+      return
+
+    # For a live session, only parts below the counter are complete.
+    waiter = self.waiters.get(session)
+    limit = waiter.counter if waiter is not None else None
+
+    parts = []
+    n = start
+    more = False
+    while True:
+      if end is not None and n > end:
+        break
+      if limit is not None and n >= limit:
+        break
+      if len(parts) >= MAX_BATCH:
+        more = True
+        break
+      html = self.read_part(session, n)
+      if html is None:
+        if limit is None:
+          break
+        # A live part that failed to render; skip it like waitForPart would.
+      else:
+        parts.append({'num': n, 'html': html.decode('utf-8', 'replace')})
+      n += 1
+
+    body = json.dumps({'parts': parts, 'next': n, 'more': more})
+    log('Sending parts %d-%d of session %r', start, n - 1, session)
+    self.send_content('application/json', body)
+
+  def send_lines(self, session, num, query):
+    """Send a page of the text file that a part links to.
+
+    Query params: start=N (0-based, default 0), count=M (default PAGE_LINES).
+    """
+    params = urlparse.parse_qs(query or '')
+    try:
+      start = max(0, int(params.get('start', ['0'])[0]))
+      count = int(params.get('count', [str(PAGE_LINES)])[0])
+    except ValueError:
+      self.send_error(400, "Invalid line range")
+      return
+    count = max(1, min(count, MAX_PAGE_LINES))
+
+    if not IsSafeSession(session):
+      self.send_error(404, "No text for this part")
+      return
+    part_dir = os.path.join(self.user_dir, 's', session, str(num))
+    path = os.path.join(part_dir, textpages.INPUT_NAME)
+    try:
+      t = textpages.TextFile(
+          path, index_path=os.path.join(part_dir, textpages.INDEX_NAME))
+    except (IOError, OSError), e:
+      log("Can't page %s: %s", path, e)
+      self.send_error(404, "No text for this part")
+      return
+
+    with t:
+      lines = t.Lines(start, count)
+      num_lines = t.num_lines
+    # Only what's shown is decoded and escaped.
+    lines = [line.decode('utf-8', 'replace') for line in lines]
+
+    end = start + len(lines)
+    data = {
+        'name': '%s/%d' % (session, num),
+        'first': start + 1 if lines else start,
+        'last': end,
+        'num_lines': num_lines,
+        'lines': lines,
+        # Strings, since 0 would be false
+        'prev': str(max(0, start - count)) if start > 0 else None,
+        'next': str(end) if end < num_lines else None,
+        }
+    self.send_content('text/html', LINES_PAGE.expand(data).encode('utf-8'))
+
+  def is_growing(self, session, n):
+    """Is part n following a file?  Then it isn't cached."""
+    waiter = self.waiters.get(session)
+    return waiter is not None and waiter.FollowPath(n) is not None
+
+  def read_part(self, session, n):
+    """Returns the HTML of a part, or None if it doesn't exist."""
+    if not IsSafeSession(session):
+      return None
+
+    if self.is_growing(session, n):
+      try:
+        with open(os.path.join(self.user_dir, 's', session, '%d.html' % n)) as f:
+          return f.read()
+      except IOError:
+        return None
+
+    if self.part_cache:
+      html = self.part_cache.Get(session, n)
+      if html is not None:
+        return html
+
+    path = os.path.join(self.user_dir, 's', session, '%d.html' % n)
+    try:
+      with open(path) as f:
+        html = f.read()
+    except IOError:
+      return None
+
+    if self.part_cache:
+      self.part_cache.Put(session, n, html)
+    return html
+
+  def send_static(self):
+    """Serve a static file."""
 
     # NOTE: url_to_fs_path is called in send_head.
     f = self.send_head()
@@ -256,60 +952,338 @@ class WaitingRequestHandler(httpd.BaseRequestHandler):
 
 
 
-WAIT_OK, WAIT_TOO_BIG, WAIT_TOO_BUSY = range(3)
+(WAIT_OK, WAIT_TOO_BIG, WAIT_TOO_BUSY, WAIT_PARKED, WAIT_TIMEOUT,
+ WAIT_CANCELLED) = range(6)
+
+# How many items SequenceWaiter remembers metadata for
+MAX_PART_INFO = 100
+
+# How far past the counter a request can wait by default.  Further ahead is
+# WAIT_TOO_BIG, so a client can't park on parts that will never come.
+DEFAULT_MAX_AHEAD = 1000
+
+# While a thread waits for a part, it checks this often whether the client is
+# still there.
+CANCEL_POLL_SECS = 1.0
+
+class LatencyStats(object):
+  """Seconds from a part being rendered to a waiting client being sent it."""
+
+  def __init__(self, max_samples=1000):
+    self.lock = threading.Lock()
+    self.samples = collections.deque(maxlen=max_samples)  # most recent
+    self.count = 0
+
+  def Record(self, secs):
+    with self.lock:
+      self.samples.append(secs)
+      self.count += 1
+
+  def Stats(self):
+    with self.lock:
+      samples = sorted(self.samples)
+      count = self.count
+    stats = {'count': count}
+    if samples:
+      ms = lambda secs: round(secs * 1000, 3)
+      stats['meanMs'] = ms(sum(samples) / len(samples))
+      stats['p50Ms'] = ms(samples[len(samples) // 2])
+      stats['p90Ms'] = ms(samples[len(samples) * 9 // 10])
+      stats['maxMs'] = ms(samples[-1])
+    return stats
+
+
+WaitingRequestHandler.latency_stats = LatencyStats()
+
+
+class WaiterLimit(object):
+  """A maximum number of waiters, which can be shared by many sessions."""
+
+  def __init__(self, max_waiters):
+    self.max_waiters = max_waiters
+    self.num_waiters = 0
+    self.lock = threading.Lock()
+
+  def Acquire(self):
+    """Returns False if there are already max_waiters."""
+    with self.lock:
+      if self.num_waiters >= self.max_waiters:
+        return False
+      self.num_waiters += 1
+      return True
+
+  def Release(self, n=1):
+    with self.lock:
+      self.num_waiters -= n
+
+
+class _Blocked(object):
+  """A thread blocked in MaybeWait()."""
+
+  def __init__(self, deadline, still_wanted, stream=False):
+    self.event = threading.Event()
+    self.deadline = deadline
+    self.still_wanted = still_wanted
+    self.stream = stream  # wake up when the item starts streaming
+    self.result = WAIT_OK  # unless the reaper wakes it up
+
 
 class SequenceWaiter(object):
   """
-  Call Notify() for every item.  Then you can call MaybeWait(n) for.
-  """
-  def __init__(self, max_waiters=None):
-    # If this limit it
-    self.max_waiters = max_waiters
+  Call Notify() for every item.  Then you can call MaybeWait(n) for any item,
+  and it returns when item n exists.
+
+  Waiters are grouped by the item they want, and the items are kept in a heap,
+  so Notify() wakes up exactly the waiters whose item has arrived.
 
-    # even, odd scheme.  When one event is notified, the other is reset.
-    self.events = [threading.Event(), threading.Event()]
-    self.lock = threading.Lock()  # protects self.events
+  Blocked threads wait on an Event with no timeout, because in Python 2, a
+  timed wait polls with sleeps of up to 50 ms.  A reaper thread checks their
+  timeouts and still_wanted() instead.
+  """
+  def __init__(self, max_waiters=None, max_ahead=DEFAULT_MAX_AHEAD,
+               limit=None):
+    # If this many requests are already waiting, MaybeWait() returns
+    # WAIT_TOO_BUSY instead of waiting.  With a thread pool, this should be
+    # less than the number of threads, so other requests can still be served.
+    # Pass a WaiterLimit instead to share the maximum with other sessions.
+    if limit is None and max_waiters is not None:
+      limit = WaiterLimit(max_waiters)
+    self.limit = limit
+    # Waiting for an item more than this far ahead of the counter returns
+    # WAIT_TOO_BIG.  None means there's no limit.
+    self.max_ahead = max_ahead
+    self.num_waiters = 0  # blocked threads and registered callbacks
+
+    # n -> list of _Blocked, for threads waiting for item n
+    self.blocked = {}
+    # n -> list of functions to call when item n is added, for requests that
+    # don't block a thread
+    self.callbacks = {}
+    # Heap of the item numbers that are keys of the above dicts
+    self.targets = []
+    # n -> metadata passed to Notify(), for recent items
+    self.part_info = collections.OrderedDict()
+    # Items that are placeholders until they're announced again.  Unlike
+    # part_info, these are never forgotten.
+    self.placeholders = set()
+    # n -> path of the file that item n is being written to, until it's done
+    self.streaming = {}
+    # n -> path of item n, while it grows after it's done
+    self.following = {}
+    # protects everything above, and self.counter
+    self.lock = threading.Lock()
     self.counter = 1
 
+    self.poll_secs = CANCEL_POLL_SECS  # how often the reaper runs
+    self.reaper = None
+
   def SetCounter(self, n):
     # TODO: Make this a constructor param?
     assert self.counter == 1, "Only call before using"
     self.counter = n
 
-  def MaybeWait(self, n):
+  def _AddTarget(self, n):
+    """Call with the lock held."""
+    if n not in self.blocked and n not in self.callbacks:
+      heapq.heappush(self.targets, n)
+
+  def MaybeWait(self, n, callback=None, timeout=None, still_wanted=None,
+                stream=False):
     """
+    Args:
+      n: part number to wait for
+      callback: If set, then instead of blocking, register callback() to be
+        called when part n is ready, and return WAIT_PARKED.
+      timeout: Seconds to block for, or None to block until the part is ready.
+      still_wanted: If set, checked every CANCEL_POLL_SECS while blocking, on
+        another thread.  When it returns False, we stop waiting.
+      stream: If True, also return when part n starts being written (see
+        Start()).  Not for callbacks.
+
     Returns:
-      success.
-      200 it's OK to proceed (we may have waited)
-      404: index is too big?
-      503: maximum waiters exceeded.
+      WAIT_OK: it's OK to proceed (we may have waited)
+      WAIT_TOO_BIG: index is too far ahead (see max_ahead)
+      WAIT_TOO_BUSY: maximum waiters exceeded
+      WAIT_PARKED: callback was registered
+      WAIT_TIMEOUT: the part wasn't ready within the timeout
+      WAIT_CANCELLED: still_wanted() returned False
     """
-    i = self.counter
-
-    # Block for the next item
-    if i > n:
-      #print '%d / %d' % (i, n)
-      #print self.items
-      return WAIT_OK
-    elif i == n:
-      log('Waiting for event %d (%d)', i, i % 2)
-      self.events[i % 2].wait()  # wait for it to be added
-      return WAIT_OK
-    else:
-      return WAIT_TOO_BIG
+    with self.lock:
+      if self.counter > n:
+        return WAIT_OK
+      if stream and n in self.streaming:
+        return WAIT_OK
+      if self.max_ahead is not None and n - self.counter > self.max_ahead:
+        return WAIT_TOO_BIG
+      if self.limit and not self.limit.Acquire():
+        log('Too many waiters (%d) for %d', self.limit.num_waiters, n)
+        return WAIT_TOO_BUSY
+      self.num_waiters += 1
+      self._AddTarget(n)
+      if callback:
+        self.callbacks.setdefault(n, []).append(callback)
+      else:
+        deadline = None
+        if timeout is not None:
+          deadline = time.time() + timeout
+        blocked = _Blocked(deadline, still_wanted, stream=stream)
+        self.blocked.setdefault(n, []).append(blocked)
+        if (timeout is not None or still_wanted) and not self.reaper:
+          self.reaper = threading.Thread(target=self._Reap)
+          self.reaper.setDaemon(True)
+          self.reaper.start()
+
+    if callback:
+      log('Parked callback for %d', n)
+      return WAIT_PARKED
+
+    log('Waiting for event %d', n)
+    try:
+      blocked.event.wait()
+      return blocked.result
+    finally:
+      with self.lock:
+        self.num_waiters -= 1
+      if self.limit:
+        self.limit.Release()
+
+  def _Reap(self):
+    """Wake up blocked threads that timed out or aren't wanted anymore."""
+    while True:
+      time.sleep(self.poll_secs)
+      with self.lock:
+        waiting = [(n, b) for n, bs in self.blocked.iteritems() for b in bs]
+
+      # Call still_wanted() without the lock, since it might be slow.
+      now = time.time()
+      done = []
+      for n, b in waiting:
+        if b.deadline is not None and now >= b.deadline:
+          done.append((n, b, WAIT_TIMEOUT))
+        elif b.still_wanted and not b.still_wanted():
+          done.append((n, b, WAIT_CANCELLED))
+
+      with self.lock:
+        for n, b, result in done:
+          blocked = self.blocked.get(n, [])
+          if b in blocked:  # not notified in the meantime
+            # Leave the list, so n isn't pushed on the heap again.
+            blocked.remove(b)
+            b.result = result
+            b.event.set()
+
+        if not any(self.blocked.itervalues()):
+          self.reaper = None  # MaybeWait() starts another one
+          return
+
+  def Cancel(self, n, callback):
+    """Unregister a callback passed to MaybeWait(n).
+
+    Returns:
+      False if it was already called (or is about to be).
+    """
+    with self.lock:
+      try:
+        self.callbacks.get(n, []).remove(callback)
+      except ValueError:
+        return False
+      # Leave the empty list, so n isn't pushed on the heap again.
+      self.num_waiters -= 1
+    if self.limit:
+      self.limit.Release()
+    return True
+
+  def Start(self, n, path):
+    """Item n is being written to path.
+
+    Threads that wait for it with stream=True are woken up, so they can send
+    it as it grows.  It's still not added until Notify(n).
+    """
+    with self.lock:
+      self.streaming[n] = path
+      blocked = self.blocked.get(n, [])
+      woken = [b for b in blocked if b.stream]
+      # Leave the list, so n isn't pushed on the heap again.
+      blocked[:] = [b for b in blocked if not b.stream]
+    for b in woken:
+      b.event.set()
+
+  def Follow(self, n, path):
+    """Item n keeps growing, at path.  If path is None, it stopped."""
+    with self.lock:
+      if path is None:
+        self.following.pop(n, None)
+      else:
+        self.following[n] = path
+
+  def FollowPath(self, n):
+    """Returns the path of item n if it's still growing, or None."""
+    with self.lock:
+      return self.following.get(n)
 
-  def Notify(self):
-    # *Atomically* increment counter and add event event N+1.
+  def StreamPath(self, n):
+    """Returns the path item n is being written to, or None if it's done."""
     with self.lock:
-      n = self.counter
-      self.counter += 1
+      return self.streaming.get(n)
+
+  def Notify(self, n=None, info=None):
+    """Item n was added.  By default, it's the next one.
+
+    If n is past the next one, the items in between are considered added too.
 
-      # instantiate a new event in the other space
-      self.events[self.counter % 2] = threading.Event()
+    Args:
+      info: optional dict of metadata about the item, returned by PartInfo(n)
+    """
+    # *Atomically* increment counter and collect the waiters for item N.
+    with self.lock:
+      if n is None:
+        n = self.counter
+
+      if info is not None:
+        self.part_info[n] = info
+        while len(self.part_info) > MAX_PART_INFO:
+          self.part_info.popitem(last=False)
+
+      # Keep streaming past a placeholder, until the real part is done.
+      if info and info.get('placeholder'):
+        self.placeholders.add(n)
+      else:
+        self.placeholders.discard(n)
+        self.streaming.pop(n, None)
+
+      if n < self.counter:
+        return  # already notified
+      self.counter = n + 1
+
+      blocked = []
+      callbacks = []
+      while self.targets and self.targets[0] < self.counter:
+        n = heapq.heappop(self.targets)
+        blocked.extend(self.blocked.pop(n, []))
+        callbacks.extend(self.callbacks.pop(n, []))
+      self.num_waiters -= len(callbacks)
+    if self.limit:
+      self.limit.Release(len(callbacks))
 
     # unblock all MaybeWait() calls
-    self.events[n % 2].set()
+    for b in blocked:
+      b.event.set()
+    for callback in callbacks:
+      callback()
+
+  def PartInfo(self, n):
+    """Returns the metadata for a recent item, or None."""
+    with self.lock:
+      return self.part_info.get(n)
+
+  def IsPlaceholder(self, n):
+    """Whether item n is a placeholder that will be replaced."""
+    with self.lock:
+      return n in self.placeholders
+
+  def NumWaiters(self):
+    with self.lock:
+      return self.num_waiters
 
   def Length(self):
     return self.counter
-
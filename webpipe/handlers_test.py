@@ -8,22 +8,461 @@
 handlers_test.py: Tests for handlers.py
 """
 
+import httplib
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
+from common import httpd
+
 import handlers  # module under test
 
 
+class _FakeHandler(handlers.WaitingRequestHandler):
+  def __init__(self):
+    pass  # Don't need a socket to test the policy.
+
+
+class _Headers(dict):
+  getheader = dict.get
+
+
+class _RecordingHandler(_FakeHandler):
+  """Records what would be sent."""
+
+  def __init__(self, user_dir):
+    self.user_dir = user_dir
+    self.waiters = {}
+    self.part_cache = None
+    self.headers = _Headers()
+    self.sent = []
+
+  def send_error(self, code, message=None):
+    self.sent.append(code)
+
+  def send_content(self, content_type, body, **kwargs):
+    self.sent.append(body)
+
+
 class WaitTest(unittest.TestCase):
 
   def testSequenceWaiter(self):
-    s = handlers.SequenceWaiter()
-    result = s.MaybeWait(2)
+    s = handlers.SequenceWaiter(max_ahead=5)
+    result = s.MaybeWait(7)
     self.assertEqual(handlers.WAIT_TOO_BIG, result)
 
+  def testFarAheadIsRejectedByDefault(self):
+    s = handlers.SequenceWaiter()
+    n = 1 + handlers.DEFAULT_MAX_AHEAD
+    self.assertEqual(handlers.WAIT_PARKED, s.MaybeWait(n, callback=lambda: 0))
+    self.assertEqual(handlers.WAIT_TOO_BIG,
+                     s.MaybeWait(n + 1, callback=lambda: 0))
+    self.assertEqual(1, s.NumWaiters())
+
+    s = handlers.SequenceWaiter(max_ahead=None)  # no limit
+    self.assertEqual(handlers.WAIT_PARKED,
+                     s.MaybeWait(10 ** 9, callback=lambda: 0))
+
+  def testOutOfOrder(self):
+    s = handlers.SequenceWaiter()
+    called = []
+    for n in (3, 1, 4, 2, 3):
+      result = s.MaybeWait(n, callback=lambda n=n: called.append(n))
+      self.assertEqual(handlers.WAIT_PARKED, result)
+
+    # Each Notify() wakes up exactly the waiters for that part.
+    s.Notify()
+    self.assertEqual([1], called)
+    s.Notify()
+    self.assertEqual([1, 2], called)
+    s.Notify()
+    self.assertEqual([1, 2, 3, 3], called)
+    self.assertEqual(1, s.NumWaiters())
+    s.Notify()
+    self.assertEqual([1, 2, 3, 3, 4], called)
+    self.assertEqual(0, s.NumWaiters())
+
+  def testManyWaiters(self):
+    s = handlers.SequenceWaiter()
+    called = []
+    for n in xrange(1000, 0, -1):
+      s.MaybeWait(n, callback=lambda n=n: called.append(n))
+
+    # Blocked threads for a future part.
+    threads = [threading.Thread(target=s.MaybeWait, args=(3,))
+               for _ in xrange(5)]
+    for t in threads:
+      t.start()
+    while s.NumWaiters() < 1005:
+      time.sleep(0.01)
+
+    for i in xrange(3):
+      s.Notify()
+    for t in threads:
+      t.join(5)
+      self.assertFalse(t.isAlive())
+    self.assertEqual([1, 2, 3], called)
+    self.assertEqual(997, s.NumWaiters())
+
+    for i in xrange(997):
+      s.Notify()
+    self.assertEqual(range(1, 1001), called)
+    self.assertEqual([], s.targets)
+
+  def testCallback(self):
+    s = handlers.SequenceWaiter()
+    called = []
+    result = s.MaybeWait(1, callback=lambda: called.append(1))
+    self.assertEqual(handlers.WAIT_PARKED, result)
+    self.assertEqual([], called)
+
+    s.Notify()
+    self.assertEqual([1], called)
+
+    # Part 1 exists now, so the callback isn't needed.
+    result = s.MaybeWait(1, callback=lambda: called.append(2))
+    self.assertEqual(handlers.WAIT_OK, result)
+    self.assertEqual([1], called)
+
+  def testTooBusy(self):
+    s = handlers.SequenceWaiter(max_waiters=2)
+    called = []
+    for i in xrange(2):
+      result = s.MaybeWait(1, callback=lambda: called.append(1))
+      self.assertEqual(handlers.WAIT_PARKED, result)
+    result = s.MaybeWait(1, callback=lambda: called.append(1))
+    self.assertEqual(handlers.WAIT_TOO_BUSY, result)
+    self.assertEqual(2, s.NumWaiters())
+
+    # Parts that exist don't need a slot.
+    s.Notify()
+    self.assertEqual([1, 1], called)
+    self.assertEqual(0, s.NumWaiters())
+    self.assertEqual(handlers.WAIT_OK, s.MaybeWait(1))
+
+    # Blocked threads count too.
+    t = threading.Thread(target=s.MaybeWait, args=(2,))
+    t.start()
+    while s.NumWaiters() == 0:
+      time.sleep(0.01)
+    s.MaybeWait(2, callback=lambda: called.append(2))
+    self.assertEqual(handlers.WAIT_TOO_BUSY,
+                     s.MaybeWait(2, callback=lambda: None))
+    s.Notify()
+    t.join(5)
+    self.assertEqual(0, s.NumWaiters())
+
+  def testSharedLimit(self):
+    limit = handlers.WaiterLimit(2)
+    a = handlers.SequenceWaiter(limit=limit)
+    b = handlers.SequenceWaiter(limit=limit)
+    self.assertEqual(handlers.WAIT_PARKED, a.MaybeWait(1, callback=lambda: 0))
+    self.assertEqual(handlers.WAIT_PARKED, b.MaybeWait(1, callback=lambda: 0))
+    self.assertEqual(handlers.WAIT_TOO_BUSY,
+                     a.MaybeWait(2, callback=lambda: 0))
+    b.Notify()
+    self.assertEqual(1, limit.num_waiters)
+    self.assertEqual(handlers.WAIT_PARKED, a.MaybeWait(2, callback=lambda: 0))
+
+  def testNotifySkipsAhead(self):
+    s = handlers.SequenceWaiter()
+    called = []
+    for n in (2, 5):
+      s.MaybeWait(n, callback=lambda n=n: called.append(n))
+    s.Notify(3)
+    self.assertEqual([2], called)
+    self.assertEqual(4, s.Length())
+    s.Notify(3)  # again
+    self.assertEqual(4, s.Length())
+
+  def testTimeoutAndCancel(self):
+    s = handlers.SequenceWaiter(max_waiters=1)
+    s.poll_secs = 0.01
+    self.assertEqual(handlers.WAIT_TIMEOUT, s.MaybeWait(1, timeout=0.01))
+    self.assertEqual(handlers.WAIT_CANCELLED,
+                     s.MaybeWait(1, still_wanted=lambda: False))
+    self.assertEqual(0, s.NumWaiters())
+
+    called = []
+    callback = lambda: called.append(1)
+    self.assertEqual(handlers.WAIT_PARKED, s.MaybeWait(1, callback=callback))
+    self.assertTrue(s.Cancel(1, callback))
+    self.assertEqual(0, s.NumWaiters())
+    s.Notify()
+    self.assertEqual([], called)
+    self.assertFalse(s.Cancel(1, callback))
+
+  def testStart(self):
+    s = handlers.SequenceWaiter()
+    results = []
+    def Wait(stream):
+      results.append((stream, s.MaybeWait(1, stream=stream)))
+    threads = [threading.Thread(target=Wait, args=(stream,))
+               for stream in (True, False)]
+    for t in threads:
+      t.start()
+    while s.NumWaiters() < 2:
+      time.sleep(0.01)
+
+    # Only the thread that can stream wakes up.
+    s.Start(1, '/tmp/1.html')
+    threads[0].join(5)
+    self.assertEqual([(True, handlers.WAIT_OK)], results)
+    self.assertEqual(1, s.NumWaiters())
+    self.assertEqual('/tmp/1.html', s.StreamPath(1))
+    self.assertEqual(handlers.WAIT_OK, s.MaybeWait(1, stream=True))
+
+    # A placeholder doesn't end the stream.
+    s.Notify(1, info={'placeholder': True})
+    threads[1].join(5)
+    self.assertEqual('/tmp/1.html', s.StreamPath(1))
+    s.Notify(1, info={})
+    self.assertEqual(None, s.StreamPath(1))
+
+  def testFollow(self):
+    s = handlers.SequenceWaiter()
+    s.Notify(1)
+    self.assertEqual(None, s.FollowPath(1))
+    s.Follow(1, '/tmp/1.html')
+    self.assertEqual('/tmp/1.html', s.FollowPath(1))
+    s.Notify(2)  # later parts don't stop it
+    self.assertEqual('/tmp/1.html', s.FollowPath(1))
+    s.Follow(1, None)
+    self.assertEqual(None, s.FollowPath(1))
+
+  def testFollowRegex(self):
+    m = handlers.FOLLOW_RE.match('/s/2014-04-03/12.html?follow=345')
+    self.assertEqual(('2014-04-03', '12', '345'), m.groups())
+    self.assertEqual(None, handlers.FOLLOW_RE.match('/s/2014-04-03/12.html'))
+
+  def testPartFileRegex(self):
+    self.assertTrue(handlers.PART_FILE_RE.match('/s/2014-04-03/12/full.html'))
+    self.assertFalse(handlers.PART_FILE_RE.match('/s/2014-04-03/12.html'))
+    self.assertFalse(handlers.PART_FILE_RE.match('/s/2014-04-03/12/a/b.png'))
+
+  def testEventsRegex(self):
+    m = handlers.EVENTS_RE.match('/s/2014-04-03/events')
+    self.assertEqual(('2014-04-03', None), m.groups())
+    m = handlers.EVENTS_RE.match('/s/2014-04-03/events?from=12')
+    self.assertEqual(('2014-04-03', '12'), m.groups())
+    self.assertEqual(None, handlers.EVENTS_RE.match('/s/2014-04-03/1.html'))
+
+  def testPartsRegex(self):
+    m = handlers.PARTS_RE.match('/s/2014-04-03/parts?from=3&to=9')
+    self.assertEqual(('2014-04-03', 'from=3&to=9'), m.groups())
+    m = handlers.PARTS_RE.match('/s/2014-04-03/parts')
+    self.assertEqual(('2014-04-03', None), m.groups())
+
+  def testCacheControl(self):
+    h = _FakeHandler()
+    waiter = handlers.SequenceWaiter()
+    waiter.SetCounter(3)
+    h.waiters = {'live': waiter}
+
+    self.assertEqual(handlers.CACHE_IMMUTABLE, h.cache_control('/s/live/2.html'))
+    self.assertEqual(handlers.CACHE_IMMUTABLE,
+                     h.cache_control('/s/live/2/full.html'))
+    self.assertEqual(handlers.CACHE_REVALIDATE,
+                     h.cache_control('/s/live/3.html'))
+    self.assertEqual(handlers.CACHE_REVALIDATE, h.cache_control('/s/live/'))
+    self.assertEqual(handlers.CACHE_IMMUTABLE, h.cache_control('/s/old/9.html'))
+
+    # A placeholder is revalidated, even after lots of later parts.
+    waiter.Notify(3, info={'placeholder': True})
+    for _ in xrange(handlers.MAX_PART_INFO + 1):
+      waiter.Notify(info={})
+    self.assertEqual(handlers.CACHE_REVALIDATE, h.cache_control('/s/live/3.html'))
+    waiter.Notify(3, info={})  # the real part
+    self.assertEqual(handlers.CACHE_IMMUTABLE, h.cache_control('/s/live/3.html'))
+
+    waiter.Follow(2, '/tmp/2.html')  # growing
+    self.assertEqual(handlers.CACHE_REVALIDATE, h.cache_control('/s/live/2.html'))
+    self.assertEqual(handlers.CACHE_IMMUTABLE,
+                     h.cache_control('/plugins/csv/static/bar.txt'))
+    self.assertEqual(handlers.CACHE_REVALIDATE,
+                     h.cache_control('/plugins/csv/static'))
+
   def testListPlugins(self):
     # This takes the place of the package dir.
     print handlers._ListPlugins('.')
 
 
+class SessionPathTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.user_dir = os.path.join(self.tmp, 'webpipe')
+    for d in ('webpipe/s/ok', 'secret'):
+      os.makedirs(os.path.join(self.tmp, d))
+      with open(os.path.join(self.tmp, d, '1.html'), 'w') as f:
+        f.write('<p>%s</p>' % d)
+    self.h = _RecordingHandler(self.user_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def testIsSafeSession(self):
+    self.assertTrue(handlers.IsSafeSession('2014-04-03'))
+    for bad in ('..', '.', '', '../../secret', 'a/b'):
+      self.assertFalse(handlers.IsSafeSession(bad), bad)
+
+  def testParts(self):
+    self.h.send_parts('ok', 'from=1')
+    self.assertTrue('webpipe/s/ok' in self.h.sent[0])
+
+    self.h.sent = []
+    self.h.send_parts('../../secret', 'from=1')
+    self.assertEqual([404], self.h.sent)
+    self.assertEqual(None, self.h.read_part('../../secret', 1))
+
+  def testFollow(self):
+    self.h.send_follow('ok', 1, 0)
+    self.assertEqual(['<p>webpipe/s/ok</p>'], self.h.sent)
+
+    self.h.sent = []
+    self.h.send_follow('../../secret', 1, 0)
+    self.assertEqual([404], self.h.sent)
+
+  def testLines(self):
+    os.mkdir(os.path.join(self.tmp, 'secret', '1'))
+    with open(os.path.join(self.tmp, 'secret', '1', 'input'), 'w') as f:
+      f.write('password\n')
+    self.h.send_lines('../../secret', 1, 'start=0')
+    self.assertEqual([404], self.h.sent)
+
+  def testEvents(self):
+    self.h.send_events('../../secret', '1')
+    self.assertEqual([404], self.h.sent)
+
+
+class _SlowDeferred(object):
+  """Renders a deferred file slowly."""
+
+  def Render(self, path):
+    time.sleep(0.5)
+    with open(path, 'w') as f:
+      f.write('full')
+    return None
+
+
+class _DeferredHandler(handlers.WaitingRequestHandler):
+  deferred = _SlowDeferred()
+  waiters = {}
+
+  def log_message(self, *args):
+    pass
+
+
+class DeferredTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.tmp, 's/live/1'))
+    with open(os.path.join(self.tmp, 's/live/a.txt'), 'w') as f:
+      f.write('a')
+    _DeferredHandler.user_dir = self.tmp
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _Get(self, port, path):
+    conn = httplib.HTTPConnection('localhost', port, timeout=5)
+    conn.request('GET', path)
+    body = conn.getresponse().read()
+    conn.close()
+    return body
+
+  def testEventLoopIsNotBlocked(self):
+    s = httpd.EventLoopHTTPServer(('localhost', 0), _DeferredHandler)
+    port = s.server_address[1]
+    t = threading.Thread(target=s.serve_forever, args=(0.05,))
+    t.setDaemon(True)
+    t.start()
+
+    results = []
+    fetch = threading.Thread(
+        target=lambda: results.append(self._Get(port, '/s/live/1/full.html')))
+    fetch.start()
+    time.sleep(0.1)  # it's rendering
+
+    start = time.time()
+    self.assertEqual('a', self._Get(port, '/s/live/a.txt'))
+    self.assertTrue(time.time() - start < 0.3)
+
+    fetch.join(5)
+    self.assertEqual(['full'], results)
+    s.shutdown()
+    t.join(5)
+    s.server_close()
+
+
+class _StreamHandler(handlers.WaitingRequestHandler):
+  wait_timeout = 5
+
+  def log_message(self, *args):
+    pass
+
+
+class StreamTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.tmp, 's/live'))
+    with open(os.path.join(self.tmp, 's/live/1.html'), 'w') as f:
+      f.write('<p>growing</p>')
+    self.waiter = handlers.SequenceWaiter(max_waiters=1)
+    self.waiter.Notify(1)
+    self.waiter.Follow(1, os.path.join(self.tmp, 's/live/1.html'))
+    _StreamHandler.user_dir = self.tmp
+    _StreamHandler.waiters = {'live': self.waiter}
+
+    self.server = httpd.ThreadedHTTPServer(('localhost', 0), _StreamHandler)
+    self.port = self.server.server_address[1]
+    self.thread = threading.Thread(target=self.server.serve_forever,
+                                   args=(0.05,))
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def tearDown(self):
+    self.waiter.Follow(1, None)
+    self.server.shutdown()
+    self.thread.join(5)
+    self.server.server_close()
+    shutil.rmtree(self.tmp)
+
+  def _Request(self, method):
+    conn = httplib.HTTPConnection('localhost', self.port, timeout=5)
+    conn.request(method, '/s/live/1.html?follow=0')
+    return conn, conn.getresponse()
+
+  def testHeadDoesNotStream(self):
+    conn, resp = self._Request('HEAD')
+    self.assertEqual(200, resp.status)
+    self.assertEqual('', resp.read())
+    # The response is over, so the connection can be used again.
+    conn.sock.settimeout(1.0)
+    conn.request('HEAD', '/s/live/1.html?follow=0')
+    self.assertEqual(200, conn.getresponse().status)
+    conn.close()
+
+  def testStreamsCountAsWaiters(self):
+    conn1, resp1 = self._Request('GET')
+    self.assertEqual(200, resp1.status)
+    self.assertEqual('<p>growing</p>', resp1.read(14))  # still streaming
+
+    conn2, resp2 = self._Request('GET')
+    self.assertEqual(503, resp2.status)  # the only slot is taken
+    resp2.read()
+    conn2.close()
+
+    self.waiter.Follow(1, None)  # ends the first stream
+    resp1.read()
+    conn1.close()
+    self.assertEqual(0, self.waiter.limit.num_waiters)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found
+# in the LICENSE file or at https://developers.google.com/open-source/licenses/bsd
+
+"""
+partcache.py
+
+In-memory LRU cache of rendered scroll parts.
+
+serve.py fills it when xrender announces a new part, so when Notify() wakes up
+all the viewers waiting on that part, they're answered from memory, rather than
+each one doing stat/open/read on the same file.
+"""
+
+import collections
+import threading
+
+from common import util
+
+log = util.Logger(util.ANSI_BLUE)
+
+
+def _MemAvailable():
+  """Returns the bytes of memory available on the machine, or None.
+
+  Only works on Linux.
+  """
+  try:
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024  # kB
+  except (IOError, ValueError, IndexError):
+    pass
+  return None
+
+
+class PartCache(object):
+  """Bounded cache of part bodies, keyed by (session, part number).
+
+  Compressed copies of a body are cached separately, with an encoding like
+  'gzip'.
+
+  One cache is shared by all the sessions a server has, so max_bytes is a
+  global budget.  max_session_bytes keeps one busy session from evicting
+  everything else.
+  """
+
+  def __init__(self, max_bytes, min_free_bytes=64 << 20,
+               mem_available=_MemAvailable, max_session_bytes=None):
+    """
+    Args:
+      max_bytes: Budget for the sum of the cached bodies.
+      min_free_bytes: When the machine has less memory available than this,
+          half of the cache is dropped.
+      mem_available: Function that returns available memory, for testing.
+      max_session_bytes: Budget for the bodies of a single session, or None.
+    """
+    self.max_bytes = max_bytes
+    self.min_free_bytes = min_free_bytes
+    self.mem_available = mem_available
+    self.max_session_bytes = max_session_bytes
+
+    # (session, num, encoding) -> body.  Least recently used first.
+    self.entries = collections.OrderedDict()
+    self.num_bytes = 0
+    self.session_bytes = collections.defaultdict(int)  # session -> bytes
+    self.lock = threading.Lock()  # protects everything above
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def Get(self, session, num, encoding=None):
+    """Returns the body of a part, or None if it's not cached."""
+    key = (session, num, encoding)
+    with self.lock:
+      body = self.entries.pop(key, None)
+      if body is None:
+        self.misses += 1
+        return None
+      self.entries[key] = body  # now most recently used
+      self.hits += 1
+      return body
+
+  def Put(self, session, num, body, encoding=None):
+    limit = self.max_bytes
+    if self.max_session_bytes is not None:
+      limit = min(limit, self.max_session_bytes)
+    if len(body) > limit:
+      return  # would evict everything else
+
+    key = (session, num, encoding)
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self._Removed(key, old)
+      self.entries[key] = body
+      self.num_bytes += len(body)
+      self.session_bytes[session] += len(body)
+      if self.max_session_bytes is not None:
+        self._EvictSession(session)
+      self._EvictTo(self.max_bytes)
+
+    self._CheckMemory()
+
+  def Remove(self, session, num):
+    """Drop a part and its compressed copies, e.g. when it's replaced."""
+    with self.lock:
+      for key in self.entries.keys():  # a copy
+        if key[0] == session and key[1] == num:
+          self._Removed(key, self.entries.pop(key))
+
+  def _Removed(self, key, body):
+    """Update counters for a removed entry.  Call with the lock held."""
+    session = key[0]
+    self.num_bytes -= len(body)
+    self.session_bytes[session] -= len(body)
+    if not self.session_bytes[session]:
+      del self.session_bytes[session]
+
+  def _EvictTo(self, max_bytes):
+    """Drop least recently used entries.  Call with the lock held."""
+    while self.num_bytes > max_bytes:
+      key, body = self.entries.popitem(last=False)
+      self._Removed(key, body)
+      self.evictions += 1
+
+  def _EvictSession(self, session):
+    """Drop a session's oldest entries.  Call with the lock held."""
+    if self.session_bytes[session] <= self.max_session_bytes:
+      return
+    for key in self.entries.keys():  # a copy, oldest first
+      if key[0] != session:
+        continue
+      self._Removed(key, self.entries.pop(key))
+      self.evictions += 1
+      if self.session_bytes.get(session, 0) <= self.max_session_bytes:
+        break
+
+  def _CheckMemory(self):
+    avail = self.mem_available()
+    if avail is None or avail >= self.min_free_bytes:
+      return
+    with self.lock:
+      log('Memory low (%d bytes available); shrinking part cache', avail)
+      self._EvictTo(self.num_bytes // 2)
+
+  def Stats(self):
+    with self.lock:
+      return {
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+          'entries': len(self.entries),
+          'bytes': self.num_bytes,
+          'maxBytes': self.max_bytes,
+          'sessionBytes': dict(self.session_bytes),
+          }
@@ -0,0 +1,92 @@
+#!/usr/bin/python -S
+#
+# Copyright 2014 Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found
+# in the LICENSE file or at https://developers.google.com/open-source/licenses/bsd
+
+"""
+partcache_test.py: Tests for partcache.py
+"""
+
+import unittest
+
+import partcache  # module under test
+
+
+class PartCacheTest(unittest.TestCase):
+
+  def testGetPut(self):
+    c = partcache.PartCache(100)
+    self.assertEqual(None, c.Get('s', 1))
+    c.Put('s', 1, 'one')
+    self.assertEqual('one', c.Get('s', 1))
+    self.assertEqual(None, c.Get('other', 1))
+
+    stats = c.Stats()
+    self.assertEqual(1, stats['hits'])
+    self.assertEqual(2, stats['misses'])
+    self.assertEqual(3, stats['bytes'])
+
+  def testEvictsLeastRecentlyUsed(self):
+    c = partcache.PartCache(10)
+    c.Put('s', 1, 'aaaa')
+    c.Put('s', 2, 'bbbb')
+    c.Get('s', 1)  # 2 is now the oldest
+    c.Put('s', 3, 'cccc')
+
+    self.assertEqual(None, c.Get('s', 2))
+    self.assertEqual('aaaa', c.Get('s', 1))
+    self.assertEqual('cccc', c.Get('s', 3))
+    self.assertEqual(1, c.Stats()['evictions'])
+
+    # Too big to cache at all
+    c.Put('s', 4, 'x' * 11)
+    self.assertEqual(None, c.Get('s', 4))
+    self.assertEqual(8, c.Stats()['bytes'])
+
+  def testSessionLimit(self):
+    c = partcache.PartCache(100, max_session_bytes=10)
+    c.Put('other', 1, 'x' * 10)
+    c.Put('busy', 1, 'aaaa')
+    c.Put('busy', 2, 'bbbb')
+    c.Put('busy', 3, 'cccc')  # evicts busy/1, not other/1
+
+    self.assertEqual(None, c.Get('busy', 1))
+    self.assertEqual('bbbb', c.Get('busy', 2))
+    self.assertEqual('x' * 10, c.Get('other', 1))
+    stats = c.Stats()
+    self.assertEqual({'busy': 8, 'other': 10}, stats['sessionBytes'])
+    self.assertEqual(18, stats['bytes'])
+
+    # Too big for a session
+    c.Put('other', 2, 'x' * 11)
+    self.assertEqual(None, c.Get('other', 2))
+
+  def testRemove(self):
+    c = partcache.PartCache(100)
+    c.Put('s', 1, 'one')
+    c.Put('s', 1, 'o', encoding='gzip')
+    c.Put('s', 2, 'two')
+    c.Remove('s', 1)
+
+    self.assertEqual(None, c.Get('s', 1))
+    self.assertEqual(None, c.Get('s', 1, encoding='gzip'))
+    self.assertEqual('two', c.Get('s', 2))
+    self.assertEqual(3, c.Stats()['bytes'])
+
+  def testMemoryPressure(self):
+    avail = [1 << 30]
+    c = partcache.PartCache(100, min_free_bytes=1000,
+                            mem_available=lambda: avail[0])
+    for i in xrange(10):
+      c.Put('s', i, 'x' * 10)
+    self.assertEqual(100, c.Stats()['bytes'])
+
+    avail[0] = 10
+    c.Put('s', 10, 'x' * 10)
+    self.assertEqual(50, c.Stats()['bytes'])
+    self.assertEqual('x' * 10, c.Get('s', 10))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -17,6 +17,8 @@ import sys
 
 from common import util
 
+import xrender
+
 class Error(Exception):
   pass
 
@@ -77,6 +79,15 @@ class Publisher(object):
     return None
 
   def Run(self, plugin_path, rel_path):
+    # The destination is static, so first render the files that the server
+    # would render when they're requested.
+    entry_dir = os.path.join(self.user_dir, rel_path)
+    if os.path.exists(entry_dir):
+      try:
+        xrender.DeferredRenders().RenderAll(entry_dir)
+      except xrender.Error, e:
+        raise Error(str(e))
+
     static_deps = ScanForStaticDeps(self.user_dir, rel_path)
 
     # Now find the root, using the same logic that the server uses (in
@@ -98,7 +109,6 @@ class Publisher(object):
     # Send the .html file, and the dir.
     argv = [plugin_path, self.user_dir, rel_path + '.html']
 
-    entry_dir = os.path.join(self.user_dir, rel_path)
     if os.path.exists(entry_dir):
       argv.extend([self.user_dir, rel_path])
 
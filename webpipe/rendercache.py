@@ -0,0 +1,272 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found
+# in the LICENSE file or at https://developers.google.com/open-source/licenses/bsd
+
+"""
+rendercache.py
+
+Content-addressed cache of plugin output, so showing the same file again
+doesn't run the plugin again.
+
+An entry is keyed by the hash of the input, its basename (plugins like csv put
+it in their output), and the plugin's path and modification time.  It holds a
+copy of <n>.html and the <n>/ directory.  On a hit, they're linked into the
+session under the new part number, and references like "3/full.html" in the
+HTML are rewritten.
+
+Layout:
+
+  ~/webpipe/render-cache/
+    <key>/
+      meta.json    # {"num": 3, "size": 1234}
+      part.html
+      part/        # if the plugin created a directory
+"""
+
+import collections
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from common import util
+
+log = util.Logger(util.ANSI_GREEN)
+
+
+def HashFile(path):
+  """Returns the hex SHA-1 of a file's contents."""
+  h = hashlib.sha1()
+  with open(path) as f:
+    while True:
+      chunk = f.read(64 << 10)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def PluginVersion(plugin_bin):
+  """Returns the newest modification time of the files in a plugin's dir.
+
+  e.g. plugins/csv/render is a wrapper around render.py.
+  """
+  plugin_dir = os.path.dirname(plugin_bin)
+  mtimes = [os.path.getmtime(plugin_bin)]
+  for name in os.listdir(plugin_dir):
+    path = os.path.join(plugin_dir, name)
+    if os.path.isfile(path):
+      mtimes.append(os.path.getmtime(path))
+  return max(mtimes)
+
+
+def MakeKey(input_path, plugin_bin):
+  h = hashlib.sha1()
+  h.update(HashFile(input_path))
+  h.update('\0' + os.path.basename(input_path))
+  h.update('\0' + os.path.realpath(plugin_bin))
+  h.update('\0%r' % PluginVersion(plugin_bin))
+  return h.hexdigest()
+
+
+def _TreeSize(path):
+  if not os.path.isdir(path):
+    return os.path.getsize(path)
+  total = 0
+  for dirpath, _, filenames in os.walk(path):
+    for name in filenames:
+      # Not what a link points to, e.g. the input of a paged text part
+      total += os.lstat(os.path.join(dirpath, name)).st_size
+  return total
+
+
+def _LinkOrCopy(src, dest):
+  """Hard link a file, or copy it if we can't (e.g. across devices)."""
+  try:
+    os.link(src, dest)
+  except OSError:
+    shutil.copy2(src, dest)
+
+
+def _LinkTree(src, dest):
+  os.mkdir(dest)
+  for name in os.listdir(src):
+    s = os.path.join(src, name)
+    d = os.path.join(dest, name)
+    if os.path.islink(s):
+      os.symlink(os.readlink(s), d)
+    elif os.path.isdir(s):
+      _LinkTree(s, d)
+    else:
+      _LinkOrCopy(s, d)
+
+
+def RewritePartNum(html, old_num, new_num):
+  """Change references to the directory old_num/ to new_num/."""
+  if old_num == new_num:
+    return html
+  pat = re.compile(r'''(["'])%d/''' % old_num)
+  return pat.sub(r'\g<1>%d/' % new_num, html)
+
+
+class RenderCache(object):
+  """Size-bounded store of rendered parts, with LRU eviction."""
+
+  def __init__(self, cache_dir, max_bytes):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+
+    # key -> size.  Least recently used first.
+    self.entries = collections.OrderedDict()
+    self.num_bytes = 0
+    self.lock = threading.Lock()  # protects everything above
+
+    self.hits = 0
+    self.misses = 0
+    self.stores = 0
+    self.evictions = 0
+
+    self._Load()
+
+  def _Load(self):
+    """Index the entries already on disk, oldest first."""
+    try:
+      names = os.listdir(self.cache_dir)
+    except OSError:
+      os.makedirs(self.cache_dir)
+      names = []
+
+    found = []
+    for key in names:
+      entry_dir = os.path.join(self.cache_dir, key)
+      try:
+        with open(os.path.join(entry_dir, 'meta.json')) as f:
+          meta = json.load(f)
+        found.append((os.path.getmtime(entry_dir), key, meta['size']))
+      except (IOError, OSError, ValueError, KeyError):
+        # Partially written, e.g. a temp dir.  Clean it up.
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    for _, key, size in sorted(found):
+      self.entries[key] = size
+      self.num_bytes += size
+    log('Render cache has %d entries (%d bytes)', len(self.entries),
+        self.num_bytes)
+
+  def Get(self, key, out_dir, num):
+    """Materialize a cached part as <num>.html and <num>/ in out_dir.
+
+    Returns:
+      True on a hit.
+    """
+    with self.lock:
+      size = self.entries.pop(key, None)
+      if size is None:
+        self.misses += 1
+        return False
+      self.entries[key] = size  # now most recently used
+      self.hits += 1
+
+    entry_dir = os.path.join(self.cache_dir, key)
+    try:
+      with open(os.path.join(entry_dir, 'meta.json')) as f:
+        meta = json.load(f)
+      os.utime(entry_dir, None)  # so LRU order survives a restart
+
+      src_dir = os.path.join(entry_dir, 'part')
+      if os.path.isdir(src_dir):
+        _LinkTree(src_dir, os.path.join(out_dir, str(num)))
+
+      src_html = os.path.join(entry_dir, 'part.html')
+      dest_html = os.path.join(out_dir, '%d.html' % num)
+      if meta['num'] == num:
+        _LinkOrCopy(src_html, dest_html)
+      else:
+        with open(src_html) as f:
+          html = f.read()
+        with open(dest_html, 'w') as f:
+          f.write(RewritePartNum(html, meta['num'], num))
+    except (IOError, OSError, ValueError, KeyError), e:
+      log('Render cache entry %s is broken: %s', key, e)
+      self._Remove(key)
+      shutil.rmtree(os.path.join(out_dir, str(num)), ignore_errors=True)
+      with self.lock:
+        self.hits -= 1
+        self.misses += 1
+      return False
+
+    return True
+
+  def Put(self, key, out_dir, num):
+    """Store the part <num> that a plugin wrote in out_dir.
+
+    The cache is only an optimization, so errors are logged, and the part
+    isn't stored.
+    """
+    src_html = os.path.join(out_dir, '%d.html' % num)
+    src_dir = os.path.join(out_dir, str(num))
+
+    tmp_dir = None
+    try:
+      size = _TreeSize(src_html)
+      if os.path.isdir(src_dir):
+        size += _TreeSize(src_dir)
+      if size > self.max_bytes:
+        return
+
+      # Build it in a temp dir, then rename, so readers never see half of it.
+      tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='tmp-')
+      _LinkOrCopy(src_html, os.path.join(tmp_dir, 'part.html'))
+      if os.path.isdir(src_dir):
+        _LinkTree(src_dir, os.path.join(tmp_dir, 'part'))
+      with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'num': num, 'size': size}, f)
+      os.rename(tmp_dir, os.path.join(self.cache_dir, key))
+    except (IOError, OSError), e:
+      # e.g. another process stored the same key first, or the disk is full
+      if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+        log('Error storing %s in render cache: %s', src_html, e)
+      if tmp_dir:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+      return
+
+    with self.lock:
+      self.entries[key] = size
+      self.num_bytes += size
+      self.stores += 1
+      evicted = []
+      while self.num_bytes > self.max_bytes:
+        old_key, old_size = self.entries.popitem(last=False)
+        self.num_bytes -= old_size
+        self.evictions += 1
+        evicted.append(old_key)
+
+    for old_key in evicted:
+      shutil.rmtree(os.path.join(self.cache_dir, old_key), ignore_errors=True)
+
+  def _Remove(self, key):
+    with self.lock:
+      size = self.entries.pop(key, None)
+      if size is not None:
+        self.num_bytes -= size
+    shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+  def Stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+          'hits': self.hits,
+          'misses': self.misses,
+          'hitRate': round(float(self.hits) / lookups, 3) if lookups else None,
+          'stores': self.stores,
+          'evictions': self.evictions,
+          'entries': len(self.entries),
+          'bytes': self.num_bytes,
+          'maxBytes': self.max_bytes,
+          }
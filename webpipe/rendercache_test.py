@@ -0,0 +1,137 @@
+#!/usr/bin/python -S
+#
+# Copyright 2014 Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found
+# in the LICENSE file or at https://developers.google.com/open-source/licenses/bsd
+
+"""
+rendercache_test.py: Tests for rendercache.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rendercache  # module under test
+
+
+def _Write(path, contents):
+  with open(path, 'w') as f:
+    f.write(contents)
+
+
+def _Read(path):
+  with open(path) as f:
+    return f.read()
+
+
+class RenderCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.cache_dir = os.path.join(self.tmp, 'cache')
+    self.out_dir = os.path.join(self.tmp, 'out')
+    os.mkdir(self.out_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _MakePart(self, num, html, files=None):
+    _Write(os.path.join(self.out_dir, '%d.html' % num), html)
+    if files:
+      part_dir = os.path.join(self.out_dir, str(num))
+      os.mkdir(part_dir)
+      for name, contents in files.iteritems():
+        _Write(os.path.join(part_dir, name), contents)
+
+  def testMakeKey(self):
+    plugin_dir = os.path.join(self.tmp, 'plugin')
+    os.mkdir(plugin_dir)
+    plugin_bin = os.path.join(plugin_dir, 'render')
+    _Write(plugin_bin, 'v1')
+
+    a = os.path.join(self.tmp, 'a.csv')
+    b = os.path.join(self.out_dir, 'a.csv')
+    _Write(a, 'x,y\n')
+    _Write(b, 'x,y\n')
+    key = rendercache.MakeKey(a, plugin_bin)
+    # Same contents and name in a different dir
+    self.assertEqual(key, rendercache.MakeKey(b, plugin_bin))
+
+    _Write(b, 'x,z\n')
+    self.assertNotEqual(key, rendercache.MakeKey(b, plugin_bin))
+
+    # Plugin changed
+    os.utime(plugin_bin, (0, 12345))
+    self.assertNotEqual(key, rendercache.MakeKey(a, plugin_bin))
+
+  def testRewritePartNum(self):
+    html = '<a href="3/full.html">3 rows</a> <img src=\'3/a.png\'>'
+    self.assertEqual(
+        '<a href="7/full.html">3 rows</a> <img src=\'7/a.png\'>',
+        rendercache.RewritePartNum(html, 3, 7))
+
+  def testGetPut(self):
+    c = rendercache.RenderCache(self.cache_dir, 1000)
+    self.assertEqual(False, c.Get('k', self.out_dir, 1))
+
+    self._MakePart(1, '<a href="1/full.html">x</a>', {'full.html': 'FULL'})
+    c.Put('k', self.out_dir, 1)
+
+    self.assertEqual(True, c.Get('k', self.out_dir, 2))
+    self.assertEqual('<a href="2/full.html">x</a>',
+                     _Read(os.path.join(self.out_dir, '2.html')))
+    self.assertEqual('FULL', _Read(os.path.join(self.out_dir, '2/full.html')))
+
+    stats = c.Stats()
+    self.assertEqual(1, stats['hits'])
+    self.assertEqual(1, stats['misses'])
+    self.assertEqual(0.5, stats['hitRate'])
+    self.assertEqual(1, stats['entries'])
+
+    # Entries survive a restart.
+    c = rendercache.RenderCache(self.cache_dir, 1000)
+    self.assertEqual(True, c.Get('k', self.out_dir, 3))
+    self.assertEqual('FULL', _Read(os.path.join(self.out_dir, '3/full.html')))
+
+  def testPutErrorsAreIgnored(self):
+    c = rendercache.RenderCache(self.cache_dir, 1000)
+    self._MakePart(1, 'one')
+
+    shutil.rmtree(self.cache_dir)  # e.g. removed by hand
+    c.Put('k', self.out_dir, 1)
+    c.Put('k', self.out_dir, 2)  # the part is missing
+    self.assertEqual(0, c.Stats()['entries'])
+
+  def testSymlink(self):
+    c = rendercache.RenderCache(self.cache_dir, 1000)
+    big = os.path.join(self.tmp, 'big.txt')
+    _Write(big, 'x' * 5000)
+    self._MakePart(1, 'paged')
+    os.mkdir(os.path.join(self.out_dir, '1'))
+    os.symlink(big, os.path.join(self.out_dir, '1/input'))
+
+    # The link is stored, not what it points to.
+    c.Put('k', self.out_dir, 1)
+    self.assertEqual(1, c.Stats()['entries'])
+    self.assertEqual(True, c.Get('k', self.out_dir, 2))
+    self.assertEqual(big, os.readlink(os.path.join(self.out_dir, '2/input')))
+
+  def testEvictsLeastRecentlyUsed(self):
+    c = rendercache.RenderCache(self.cache_dir, 10)
+    self._MakePart(1, 'aaaa')
+    self._MakePart(2, 'bbbb')
+    self._MakePart(3, 'cccc')
+    c.Put('a', self.out_dir, 1)
+    c.Put('b', self.out_dir, 2)
+    c.Get('a', self.out_dir, 4)  # b is now the oldest
+    c.Put('c', self.out_dir, 3)
+
+    self.assertEqual(1, c.Stats()['evictions'])
+    self.assertEqual(['a', 'c'], sorted(os.listdir(self.cache_dir)))
+    self.assertEqual(False, c.Get('b', self.out_dir, 5))
+
+
+if __name__ == '__main__':
+  unittest.main()
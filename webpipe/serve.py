@@ -9,7 +9,10 @@ webpipe.py
 
 Server that receives content from a pipe, and serves it "interactively" to the
 browser.  It relies on a "hanging GET" -- jQuery on the client and
-threading.Event on the server.
+threading.Event on the server (or a parked callback with --event-loop).
+
+'serve.py daemon' also runs the rendering plugins itself (see xrender.py), so
+new parts are announced with a function call rather than through a pipe.
 """
 
 import datetime
@@ -19,7 +22,9 @@ import json
 import optparse
 import os
 import Queue
+import re
 import threading
+import time
 import string  # for lower case letters
 import sys
 
@@ -28,6 +33,9 @@ from common import util
 from common import spy
 
 import handlers
+import partcache
+import rendercache
+import xrender
 
 # outside
 import tnet
@@ -39,6 +47,14 @@ class Error(Exception):
   pass
 
 
+# What xrender prints for a new part, e.g. 3.html
+PART_NAME_RE = re.compile(r'(\d+)\.html$')
+
+# A header line, e.g. 2:{}.  A stream starts with one, but several streams can
+# be merged into one.  xrender also prints one when a part starts streaming.
+HEADER_RE = re.compile(r'\d+:\{')
+
+
 _verbose = False
 
 def debug(msg, *args):
@@ -61,40 +77,228 @@ class ReadStdin(object):
       # must be unbuffered
       line = sys.stdin.readline()
       if not line:
+        self.q.put(None)  # tell Notify we're done
         break
 
       line = line.rstrip()
       self.q.put(line)
 
 
+def SplitAnnouncement(line, default_session):
+  """Split a line of xrender output into (session, name).
+
+  Lines can be tagged with a session, e.g. 2014-03-30/3.html.  Untagged lines
+  like 3.html or 3/full.html are for the default session.
+  """
+  first, slash, rest = line.partition('/')
+  if slash and not first.isdigit():
+    return first, rest
+  return default_session, line
+
+
+def CounterFromDisk(scroll_path):
+  """Returns the number of the next part, based on what's in the dir."""
+  nums = [0]
+  try:
+    entries = os.listdir(scroll_path)
+  except OSError:
+    entries = []
+  for e in entries:
+    m = PART_NAME_RE.match(e)
+    if m:
+      nums.append(int(m.group(1)))
+  return max(nums) + 1
+
+
+class Sessions(object):
+  """The live sessions in a server, each with a SequenceWaiter.
+
+  A session becomes live when an announcement for it arrives.
+  """
+
+  def __init__(self, sessions_dir, waiters, limit=None, part_cache=None,
+               max_ahead=handlers.DEFAULT_MAX_AHEAD):
+    """
+    Args:
+      sessions_dir: directory with a subdirectory for each session
+      waiters: dict of session name -> SequenceWaiter, shared with the request
+          handlers
+      limit: WaiterLimit shared by all sessions, or None
+      part_cache: PartCache to fill before notifying, or None
+      max_ahead: how far past the next part a request can wait (see
+          SequenceWaiter)
+    """
+    self.sessions_dir = sessions_dir
+    self.waiters = waiters
+    self.limit = limit
+    self.part_cache = part_cache
+    self.max_ahead = max_ahead
+    self.lock = threading.Lock()
+
+  def Get(self, session, next_part=None):
+    """Returns the waiter for a session, creating it if necessary.
+
+    Args:
+      next_part: The counter for a new waiter.  By default, it's initialized
+          from the parts on disk.
+    """
+    with self.lock:
+      waiter = self.waiters.get(session)
+      if waiter is not None:
+        return waiter
+
+      waiter = handlers.SequenceWaiter(limit=self.limit,
+                                       max_ahead=self.max_ahead)
+      if next_part is None:
+        next_part = CounterFromDisk(os.path.join(self.sessions_dir, session))
+      waiter.SetCounter(next_part)
+      log('Session %r is live, next part %d', session, next_part)
+      # Assign last, so handlers don't see it before the counter is set.
+      self.waiters[session] = waiter
+      return waiter
+
+  def Announce(self, session, num, info=None):
+    """Part num of a session was written; wake up whoever is waiting for it.
+
+    A part that was announced before, like a placeholder for a slow render,
+    has been replaced.
+
+    Args:
+      info: dict of metadata from the renderer.  If it's not given, we find
+        the size and the time it was written from the file.
+    """
+    info = dict(info or {}, num=num)
+    waiter = self.Get(session)
+    if num < waiter.Length():
+      log('Part %d of session %r was replaced', num, session)
+      if self.part_cache:
+        self.part_cache.Remove(session, num)
+
+    path = os.path.join(self.sessions_dir, session, '%d.html' % num)
+    try:
+      with open(path) as f:
+        if 'rendered' not in info or 'size' not in info:
+          st = os.fstat(f.fileno())
+          info.setdefault('rendered', st.st_mtime)
+          info.setdefault('size', st.st_size)
+        # Read the new part once, so all the waiters get it from memory.  But
+        # not one that's still growing.
+        if self.part_cache and waiter.FollowPath(num) is None:
+          body = f.read()
+          self.part_cache.Put(session, num, body)
+        else:
+          body = f.read(len(xrender.PLACEHOLDER_PREFIX))
+      # xrender's stdout doesn't say, so look.
+      if body.startswith(xrender.PLACEHOLDER_PREFIX):
+        info['placeholder'] = True
+    except (IOError, OSError), e:
+      log("Couldn't read %s: %s", path, e)
+    info['announced'] = time.time()
+
+    waiter.Notify(num, info=info)
+
+  def Follow(self, session, num, path):
+    """Part num of a session grows with the file it shows.
+
+    Viewers can ask for what's appended to it.
+
+    Args:
+      path: the part's file, relative to the session dir, or None when it
+        stops growing
+    """
+    waiter = self.Get(session)
+    if path is None:
+      log('Part %d of session %r stopped growing', num, session)
+      waiter.Follow(num, None)
+      return
+    full_path = os.path.normpath(os.path.join(self.sessions_dir, session, path))
+    log('Part %d of session %r is following a file', num, session)
+    waiter.Follow(num, full_path)
+
+  def Start(self, session, num, path):
+    """A plugin started writing part num of a session.
+
+    Viewers waiting for it are sent the file as it grows, until the part is
+    announced.
+
+    Args:
+      path: the file the plugin is writing, relative to the session dir
+    """
+    full_path = os.path.normpath(os.path.join(self.sessions_dir, session, path))
+    log('Part %d of session %r started: %s', num, session, full_path)
+    self.Get(session).Start(num, full_path)
+
+
 class Notify(object):
-  """Thread to read from queue and notify waiter."""
+  """Thread to read from queue and notify waiters."""
 
-  def __init__(self, q, waiter):
+  def __init__(self, q, sessions, default_session):
     """
     Args:
       q: Queue
-      waiter: SequenceWaiter object
+      sessions: Sessions object
+      default_session: session name for untagged lines
     """
     self.q = q
-    self.waiter = waiter
+    self.sessions = sessions
+    self.default_session = default_session
 
   def __call__(self):
-    # take care of index.html ?  Is this the right way to do it?
-    #unused = self.q.get()
-    i = 0
     while True:
-      name = self.q.get()
-      log('notify: %s', name)
+      line = self.q.get()
+      if line is None:
+        break
+      log('notify: %s', line)
 
-      # TODO: do a better check
-      if not name.endswith('.html'):
-        log('skipped: %s', name)
+      if HEADER_RE.match(line):
+        self._HandleHeader(line)
         continue
 
-      self.waiter.Notify()
+      session, name = SplitAnnouncement(line, self.default_session)
+      m = PART_NAME_RE.match(name)
+      if not m:  # e.g. the directory 3 or 3/full.html
+        log('skipped: %s', line)
+        continue
 
-      i += 1
+      self.sessions.Announce(session, int(m.group(1)))
+
+  def _HandleHeader(self, line):
+    header = json.loads(line[line.index(':')+1:])
+    log('received header %r', header)
+    session = header.get('session', self.default_session)
+
+    # Not a new stream, but a part that's being streamed.
+    started = header.get('started')
+    if started is not None:
+      path = header.get('path')
+      if not isinstance(started, int) or not isinstance(path, basestring):
+        log('Ignored invalid start of part %r', started)
+        return
+      self.sessions.Start(session, started, path)
+      return
+
+    # Or a part that follows a file.
+    following = header.get('following')
+    if following is not None:
+      path = header.get('path')
+      if not isinstance(following, int) or not isinstance(path, basestring):
+        log('Ignored invalid following part %r', following)
+        return
+      self.sessions.Follow(session, following, path)
+      return
+    unfollowed = header.get('unfollowed')
+    if unfollowed is not None:
+      if not isinstance(unfollowed, int):
+        log('Ignored invalid unfollowed part %r', unfollowed)
+        return
+      self.sessions.Follow(session, unfollowed, None)
+      return
+
+    next_part = header.get('nextPart')
+    if next_part is not None and not isinstance(next_part, int):
+      log('Ignored invalid nextPart %r', next_part)
+      next_part = None
+    self.sessions.Get(session, next_part=next_part)
 
 
 def SuffixGen():
@@ -130,9 +334,13 @@ def MakeSession(out_dir):
   return session, full_path
 
 
-def Serve(opts, scroll_path, waiter, package_dir):
+def Serve(opts, scroll_path, sessions, package_dir):
   # Pipeline:
   # Read stdin messages -> notify server
+  #
+  # scroll_path is the default session, for lines that aren't tagged with one.
+  # Other sessions are in the same dir.
+  scroll_name = os.path.basename(scroll_path)
 
   header_line = sys.stdin.readline()
   # skip over length prefix
@@ -146,10 +354,11 @@ def Serve(opts, scroll_path, waiter, package_dir):
   next_part = header.get('nextPart')
   if next_part is not None:
     if isinstance(next_part, int):
-      waiter.SetCounter(next_part)
       log('received counter state in header: %d', next_part)
     else:
       log('Ignored invalid nextPart %r', next_part)
+      next_part = None
+  sessions.Get(scroll_name, next_part=next_part)
 
   q = Queue.Queue()
 
@@ -158,20 +367,104 @@ def Serve(opts, scroll_path, waiter, package_dir):
   t1.setDaemon(True)  # So Ctrl-C works
   t1.start()
 
-  n = Notify(q, waiter)
+  n = Notify(q, sessions, scroll_name)
   t2 = threading.Thread(target=n)
   t2.setDaemon(True)  # So Ctrl-C works
   t2.start()
 
+  ServeHttp(opts, sessions, scroll_name, package_dir)
+
+
+def Daemon(opts, scroll_path, sessions, package_dir):
+  """Render and serve in one process.
+
+  Instead of xrender printing part names to stdout, and us parsing them,
+  PluginDispatchLoop runs on a thread here and announces parts with a function
+  call.
+  """
   scroll_name = os.path.basename(scroll_path)
+  sessions.Get(scroll_name)  # counter from disk, like PluginDispatchLoop
+
+  def Announce(info):
+    sessions.Announce(scroll_name, info['num'], info=info)
+
+  def AnnounceStart(num, path):
+    sessions.Start(scroll_name, num, path)
+
+  def AnnounceFollow(num, path):
+    sessions.Follow(scroll_name, num, path)
+
+  limits = {}
+  for spec in opts.render_limits:
+    plugin, _, limit = spec.partition('=')
+    try:
+      limits[plugin] = int(limit)
+    except ValueError:
+      raise Error('Invalid --render-limit %r (expected e.g. dot=1)' % spec)
+  # Even with one job, so later files can get past a slow one.
+  pool = xrender.RenderPool(opts.render_jobs, limits=limits)
+
+  try:
+    timeout_secs, timeouts = xrender.ParseTimeouts(opts.render_timeouts)
+  except xrender.Error, e:
+    raise Error(str(e))
+  budget = xrender.TimeBudget(placeholder_secs=opts.placeholder_secs or None,
+                              timeout_secs=timeout_secs, timeouts=timeouts)
+
+  render_cache = None
+  if opts.render_cache_mb > 0:
+    render_cache = rendercache.RenderCache(
+        os.path.join(opts.user_dir, 'render-cache'),
+        opts.render_cache_mb << 20)
+    handlers.WaitingRequestHandler.render_cache = render_cache
+
+  coprocesses = None
+  if opts.max_coprocesses > 0:
+    coprocesses = xrender.Coprocesses(max_live=opts.max_coprocesses)
+    handlers.WaitingRequestHandler.coprocesses = coprocesses
+
+  followers = None
+  if opts.max_followed > 0:
+    followers = xrender.Followers(max_followed=opts.max_followed)
+    handlers.WaitingRequestHandler.followers = followers
+
+  in_dir = opts.input_dir or os.path.join(opts.user_dir, 'input')
+  loop = xrender.PluginDispatchLoop(in_dir, scroll_path, announce=Announce,
+                                    pool=pool, render_cache=render_cache,
+                                    coprocesses=coprocesses, budget=budget,
+                                    announce_start=AnnounceStart,
+                                    followers=followers,
+                                    announce_follow=AnnounceFollow)
+  if opts.listen_port:
+    # Bind now, so a port that's in use is an error before we serve.
+    target = xrender.IngestServer(opts.listen_port, loop,
+                                  in_dir=in_dir).Serve
+  else:
+    target = lambda: xrender.Lines(sys.stdin, loop)
+  t = threading.Thread(target=target)
+  t.setDaemon(True)  # So Ctrl-C works
+  t.start()
+
+  ServeHttp(opts, sessions, scroll_name, package_dir)
+
 
+def ServeHttp(opts, sessions, scroll_name, package_dir):
   handler_class = handlers.WaitingRequestHandler
   handler_class.user_dir = opts.user_dir
   handler_class.package_dir = package_dir
-  handler_class.waiters = {scroll_name: waiter}
+  handler_class.waiters = sessions.waiters
   handler_class.active_scroll = scroll_name
-
-  s = httpd.ThreadedHTTPServer(('', opts.port), handler_class)
+  handler_class.part_cache = sessions.part_cache
+  handler_class.wait_timeout = opts.wait_timeout or None
+  # Expensive files of parts are rendered when they're first requested.
+  handler_class.deferred = xrender.DeferredRenders()
+
+  if opts.event_loop:
+    # Waiting requests are parked callbacks rather than blocked threads.
+    s = httpd.EventLoopHTTPServer(('', opts.port), handler_class)
+  else:
+    s = httpd.ThreadedHTTPServer(('', opts.port), handler_class,
+                                 num_threads=opts.num_threads)
 
   # TODO: add opts.hostname?
   log('Serving at http://localhost:%d/s/%s  (Ctrl-C to quit)', opts.port,
@@ -198,8 +491,72 @@ def CreateOptionsParser():
       '--length', dest='length', type='int', default=1000,
       help='Length of the scroll, i.e. amount of history to keep.')
   parser.add_option(
-      '--num-threads', dest='num_threads', type='int', default=5,
+      '--num-threads', dest='num_threads', type='int', default=20,
       help='Number of server threads, i.e. simultaneous connections.')
+  parser.add_option(
+      '--max-waiters', dest='max_waiters', type='int', default=None,
+      help='Maximum number of requests waiting for parts, in all sessions.  '
+           'Others get a 503.  (default: 3/4 of --num-threads, or 1000 with '
+           '--event-loop)')
+  parser.add_option(
+      '--max-ahead', dest='max_ahead', type='int',
+      default=handlers.DEFAULT_MAX_AHEAD,
+      help='Requests for parts more than this far past the next one get a '
+           '404 instead of waiting.')
+  parser.add_option(
+      '--wait-timeout', dest='wait_timeout', type='float', default=60,
+      help='Seconds a request waits for the next part before the server '
+           'answers "nothing yet" (0 to wait forever).')
+  parser.add_option(
+      '--cache-mb', dest='cache_mb', type='int', default=64,
+      help='Memory budget in MB for caching rendered parts.')
+  parser.add_option(
+      '--session-cache-mb', dest='session_cache_mb', type='int', default=32,
+      help='Part of --cache-mb that a single session can use.')
+  parser.add_option(
+      '--event-loop', dest='event_loop', default=False, action='store_true',
+      help='Serve from a single thread; waiting requests are parked '
+           'instead of blocking a thread each.')
+
+  # For the daemon action
+  parser.add_option(
+      '--input-dir', dest='input_dir', type='str', default=None,
+      help='Directory that filenames to render are relative to (default: '
+           'input/ in --user-dir)')
+  parser.add_option(
+      '--render-jobs', dest='render_jobs', type='int', default=1,
+      help='Number of files to render at once')
+  parser.add_option(
+      '--render-limit', dest='render_limits', action='append', default=[],
+      help='Limit the renders of one plugin at once, e.g. dot=1.  Can be '
+           'repeated.')
+  parser.add_option(
+      '--render-cache-mb', dest='render_cache_mb', type='int',
+      default=xrender.DEFAULT_RENDER_CACHE_MB,
+      help='Disk budget in MB for reusing the output of files rendered '
+           'before (0 to disable)')
+  parser.add_option(
+      '--max-coprocesses', dest='max_coprocesses', type='int',
+      default=xrender.DEFAULT_MAX_COPROCESSES,
+      help='Max number of persistent plugin processes to keep running (0 to '
+           'always run plugins once per file)')
+  parser.add_option(
+      '--placeholder-secs', dest='placeholder_secs', type='float',
+      default=xrender.DEFAULT_PLACEHOLDER_SECS,
+      help='Show a placeholder for parts that take longer than this to '
+           'render, and replace it when they are done (0 to disable)')
+  parser.add_option(
+      '--render-timeout', dest='render_timeouts', action='append', default=[],
+      help='Kill renders after this many seconds, e.g. 30, or dot=120 for '
+           'one plugin.  0 means no limit.  Can be repeated.')
+  parser.add_option(
+      '--max-followed', dest='max_followed', type='int',
+      default=xrender.DEFAULT_MAX_FOLLOWED,
+      help='Max number of growing files, like logs, to follow at once (0 to '
+           'always show files once)')
+  parser.add_option(
+      '--listen-port', dest='listen_port', type='int', default=None,
+      help='Port to receive filenames to render on (default: read stdin)')
 
   # scrolls go in the 's' dir, plugins in the 'plugins' dir
   parser.add_option(
@@ -227,7 +584,7 @@ def AppMain(argv):
   # serve-rendered (or servehtml)
   # refresh
 
-  if action == 'serve':  # TODO: rename to 'serve'
+  if action in ('serve', 'daemon'):  # TODO: rename to 'serve'
     scroll_path = argv[2]
 
     # Write index.html in the session dir.
@@ -240,12 +597,28 @@ def AppMain(argv):
     with open(out_path, 'w') as f:
       f.write(index_html)
 
-    waiter = handlers.SequenceWaiter()
+    max_waiters = opts.max_waiters
+    if max_waiters is None:
+      if opts.event_loop:
+        max_waiters = 1000  # each one is a file descriptor
+      else:
+        # Leave threads for static files, plugin assets, etc.
+        max_waiters = max(1, opts.num_threads * 3 // 4)
+    # The limit is shared by all sessions.
+    limit = handlers.WaiterLimit(max_waiters)
+    # One memory budget for all sessions
+    part_cache = partcache.PartCache(
+        opts.cache_mb << 20, max_session_bytes=opts.session_cache_mb << 20)
+    sessions = Sessions(os.path.dirname(scroll_path), {}, limit=limit,
+                        part_cache=part_cache, max_ahead=opts.max_ahead)
     try:
-      Serve(opts, scroll_path, waiter, package_dir)
+      if action == 'daemon':
+        Daemon(opts, scroll_path, sessions, package_dir)
+      else:
+        Serve(opts, scroll_path, sessions, package_dir)
     except KeyboardInterrupt:
       log('Stopped')
-      return waiter.Length()
+      return sessions.Get(os.path.basename(scroll_path)).Length()
 
   elif action == 'noop':
     # For testing latency
@@ -10,9 +10,13 @@ serve_test.py: Tests for serve.py
 
 import os
 import Queue
+import shutil
+import tempfile
 import unittest
 
+import partcache
 import serve
+import xrender
 
 
 class StagesTest(unittest.TestCase):
@@ -30,10 +34,121 @@ class FunctionsTest(unittest.TestCase):
     print suffixes
     print sorted(suffixes)
 
+  def testSplitAnnouncement(self):
+    self.assertEqual(('d', '3.html'), serve.SplitAnnouncement('3.html', 'd'))
+    self.assertEqual(('d', '3/full.html'),
+                     serve.SplitAnnouncement('3/full.html', 'd'))
+    self.assertEqual(('2014-03-30', '3.html'),
+                     serve.SplitAnnouncement('2014-03-30/3.html', 'd'))
+
   def testMakeSession(self):
     s = serve.MakeSession(os.path.expanduser('~/serve/s'))
     print s
 
 
+class SessionsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.tmp, 'old'))
+    for name in ('1.html', '2.html', '2'):
+      open(os.path.join(self.tmp, 'old', name), 'w').close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def testLazyWaiters(self):
+    waiters = {}
+    sessions = serve.Sessions(self.tmp, waiters)
+    self.assertEqual({}, waiters)
+
+    w = sessions.Get('old')
+    self.assertEqual(3, w.Length())  # counter from disk
+    self.assertTrue(w is sessions.Get('old', next_part=10))
+
+    w = sessions.Get('new', next_part=5)
+    self.assertEqual(5, w.Length())
+    self.assertEqual(['new', 'old'], sorted(waiters))
+
+  def testNotify(self):
+    q = Queue.Queue()
+    sessions = serve.Sessions(self.tmp, {})
+    n = serve.Notify(q, sessions, 'default')
+    for line in ['2:{}', 'old/3', 'old/3.html',
+                 '2:{"session": "x", "nextPart": 7}', '1.html']:
+      q.put(line)
+    q.put(None)  # end of input
+    n()
+
+    self.assertEqual(4, sessions.Get('old').Length())
+    self.assertEqual(7, sessions.Get('x').Length())
+    self.assertEqual(2, sessions.Get('default').Length())
+
+  def testNotifyStart(self):
+    q = Queue.Queue()
+    sessions = serve.Sessions(self.tmp, {})
+    n = serve.Notify(q, sessions, 'default')
+    for line in ['52:{"session": "old", "started": 3, "path": "3.html"}',
+                 '27:{"started": 3, "path": 3}']:
+      q.put(line)
+    q.put(None)
+    n()
+
+    w = sessions.Get('old')
+    self.assertEqual(os.path.join(self.tmp, 'old', '3.html'), w.StreamPath(3))
+    self.assertEqual(3, w.Length())  # not done yet
+    self.assertEqual(None, sessions.Get('default').StreamPath(3))  # invalid
+
+  def testNotifyFollow(self):
+    q = Queue.Queue()
+    sessions = serve.Sessions(self.tmp, {})
+    n = serve.Notify(q, sessions, 'default')
+    for line in ['52:{"session": "old", "following": 1, "path": "1.html"}',
+                 '52:{"session": "old", "following": 2, "path": "2.html"}',
+                 '35:{"session": "old", "unfollowed": 2}',
+                 '29:{"following": "x", "path": 3}']:
+      q.put(line)
+    q.put(None)
+    n()
+
+    w = sessions.Get('old')
+    self.assertEqual(os.path.join(self.tmp, 'old', '1.html'), w.FollowPath(1))
+    self.assertEqual(None, w.FollowPath(2))
+    self.assertEqual(None, sessions.Get('default').FollowPath(3))  # invalid
+
+  def testAnnounce(self):
+    sessions = serve.Sessions(self.tmp, {})
+    with open(os.path.join(self.tmp, 'old', '3.html'), 'w') as f:
+      f.write('three')
+    sessions.Announce('old', 3, info={'fileType': 'txt'})
+
+    w = sessions.Get('old')
+    self.assertEqual(4, w.Length())
+    info = w.PartInfo(3)
+    self.assertEqual('txt', info['fileType'])
+    self.assertEqual(5, info['size'])
+    self.assertTrue(info['announced'] >= info['rendered'])
+
+  def testAnnounceUpgrade(self):
+    c = partcache.PartCache(1000)
+    sessions = serve.Sessions(self.tmp, {}, part_cache=c)
+    path = os.path.join(self.tmp, 'old', '3.html')
+    with open(path, 'w') as f:
+      f.write(xrender.PLACEHOLDER_HTML % 'big.dot')
+    sessions.Announce('old', 3)
+    c.Put('old', 3, 'compressed', encoding='gzip')
+
+    w = sessions.Get('old')
+    self.assertEqual(True, w.PartInfo(3)['placeholder'])
+
+    with open(path, 'w') as f:
+      f.write('real')
+    sessions.Announce('old', 3)
+    self.assertEqual(4, w.Length())
+    self.assertEqual(None, w.PartInfo(3).get('placeholder'))
+    self.assertEqual('real', c.Get('old', 3))
+    self.assertEqual(None, c.Get('old', 3, encoding='gzip'))
+
+
 if __name__ == '__main__':
   unittest.main()
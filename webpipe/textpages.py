@@ -0,0 +1,151 @@
+#!/usr/bin/python
+#
+# Copyright 2014 Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found
+# in the LICENSE file or at https://developers.google.com/open-source/licenses/bsd
+
+"""
+textpages.py
+
+Pages of lines from a big text file, for the txt plugin's paged viewer.
+
+The plugin shows the head and tail of the file, and links its part directory
+to the input.  The server then reads further pages from that link.  The file is
+memory-mapped, and the number of lines before each block of it is counted once
+and saved next to the link, so finding a page doesn't scan the whole file
+again.
+"""
+
+import array
+import bisect
+import mmap
+import os
+
+from common import util
+
+log = util.Logger(util.ANSI_BLUE)
+
+
+# What the txt plugin names the link to its input, in the part directory
+INPUT_NAME = 'input'
+# The index that's saved next to it
+INDEX_NAME = 'lines.idx'
+
+# The index has a line count for each block of this many bytes.
+BLOCK_SIZE = 64 << 10
+
+# So a page of very long lines doesn't make a huge response
+MAX_PAGE_BYTES = 1 << 20
+
+
+def BuildIndex(data):
+  """Returns an array with the number of newlines before each block of data."""
+  counts = array.array('l')
+  n = 0
+  for start in xrange(0, len(data), BLOCK_SIZE):
+    counts.append(n)
+    n += data[start:start + BLOCK_SIZE].count('\n')
+  counts.append(n)  # the total
+  return counts
+
+
+def _Stamp(st):
+  """Identifies the version of a file that an index was built for."""
+  return [st.st_size, int(st.st_mtime)]
+
+
+def _LoadIndex(index_path, stamp):
+  """Returns the saved index, or None if it's missing or out of date."""
+  try:
+    with open(index_path, 'rb') as f:
+      a = array.array('l')
+      a.fromstring(f.read())
+  except IOError:
+    return None
+  if a[:2].tolist() != stamp:
+    return None
+  return a[2:]
+
+
+def _SaveIndex(index_path, stamp, counts):
+  a = array.array('l', stamp)
+  a.extend(counts)
+  tmp = '%s.%d.tmp' % (index_path, os.getpid())
+  try:
+    with open(tmp, 'wb') as f:
+      a.tofile(f)
+    os.rename(tmp, index_path)
+  except (IOError, OSError), e:
+    # e.g. a read-only session; we'll just count again next time.
+    log("Couldn't save %s: %s", index_path, e)
+
+
+class TextFile(object):
+  """A text file that pages of lines can be read from."""
+
+  def __init__(self, path, index_path=None):
+    """
+    Args:
+      path: the file
+      index_path: where to save the index, or None to count every time.
+
+    Raises:
+      IOError, OSError if it can't be opened.
+    """
+    with open(path, 'rb') as f:
+      st = os.fstat(f.fileno())
+      if st.st_size:
+        self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      else:
+        self.data = ''  # can't map an empty file
+
+    stamp = _Stamp(st)
+    counts = _LoadIndex(index_path, stamp) if index_path else None
+    if counts is None:
+      log('Indexing lines of %s (%d bytes)', path, st.st_size)
+      counts = BuildIndex(self.data)
+      if index_path:
+        _SaveIndex(index_path, stamp, counts)
+    self.counts = counts
+
+    self.num_lines = counts[-1]
+    if self.data and self.data[-1] != '\n':
+      self.num_lines += 1  # the last line has no newline
+
+  def Close(self):
+    if self.data:
+      self.data.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Close()
+
+  def LineOffset(self, line):
+    """Returns the offset of the start of a (0-based) line."""
+    if line <= 0:
+      return 0
+    if line >= self.num_lines:
+      return len(self.data)
+    # The line starts after newline number <line>.  Find the last block that
+    # starts before it, and count from there.
+    block = bisect.bisect_left(self.counts, line) - 1
+    pos = block * BLOCK_SIZE
+    for _ in xrange(line - self.counts[block]):
+      pos = self.data.find('\n', pos) + 1
+    return pos
+
+  def Lines(self, start, count):
+    """Returns a list of up to count lines from start, without newlines.
+
+    At most MAX_PAGE_BYTES are read; the last line can be cut off.
+    """
+    begin = self.LineOffset(start)
+    end = self.LineOffset(start + count)
+    chunk = self.data[begin:min(end, begin + MAX_PAGE_BYTES)]
+    if not chunk:
+      return []
+    if chunk.endswith('\n'):
+      chunk = chunk[:-1]
+    return chunk.split('\n')
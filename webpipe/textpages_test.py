@@ -0,0 +1,75 @@
+#!/usr/bin/python -S
+#
+# Copyright 2014 Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found
+# in the LICENSE file or at https://developers.google.com/open-source/licenses/bsd
+
+"""
+textpages_test.py: Tests for textpages.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import textpages  # module under test
+
+
+class TextFileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, 'log.txt')
+    self.index_path = os.path.join(self.tmp, 'lines.idx')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _Write(self, text):
+    with open(self.path, 'w') as f:
+      f.write(text)
+
+  def testLines(self):
+    self._Write(''.join('line %d\n' % i for i in xrange(50000)))
+    with textpages.TextFile(self.path) as t:
+      self.assertTrue(len(t.counts) > 3)  # more than one block
+      self.assertEqual(50000, t.num_lines)
+      self.assertEqual(['line 0', 'line 1'], t.Lines(0, 2))
+      self.assertEqual(['line 12345', 'line 12346'], t.Lines(12345, 2))
+      self.assertEqual(['line 49999'], t.Lines(49999, 10))
+      self.assertEqual([], t.Lines(50000, 10))
+
+      # Every block boundary
+      for i in xrange(1, len(t.counts) - 1):
+        n = t.counts[i]
+        self.assertEqual(['line %d' % n], t.Lines(n, 1))
+
+  def testNoTrailingNewline(self):
+    self._Write('a\nb')
+    with textpages.TextFile(self.path) as t:
+      self.assertEqual(2, t.num_lines)
+      self.assertEqual(['a', 'b'], t.Lines(0, 5))
+
+  def testEmpty(self):
+    self._Write('')
+    with textpages.TextFile(self.path) as t:
+      self.assertEqual(0, t.num_lines)
+      self.assertEqual([], t.Lines(0, 5))
+
+  def testSavedIndex(self):
+    self._Write('a\nb\n')
+    with textpages.TextFile(self.path, self.index_path) as t:
+      self.assertEqual(2, t.num_lines)
+    self.assertTrue(os.path.exists(self.index_path))
+
+    # Counted again when the file changes
+    self._Write('a\nb\nc\n')
+    with textpages.TextFile(self.path, self.index_path) as t:
+      self.assertEqual(3, t.num_lines)
+    with textpages.TextFile(self.path, self.index_path) as t:
+      self.assertEqual(['c'], t.Lines(2, 1))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -10,8 +10,9 @@ xrender.py
 A filter that reads filenames from stdin, and prints HTML directories on
 stdout.
 
-TODO: Make this usable as a library too?  So in the common case you can have a
-single process.
+It's also usable as a library: serve.py daemon runs PluginDispatchLoop in the
+same process as the web server, and is told about new parts with a function
+call rather than a line on stdout.
 
 File types:
 
@@ -50,13 +51,21 @@ See comments below for the interface.
     - maybe you have to dereference the link.
 """
 
+import cgi
+import collections
+import cStringIO
 import getopt
+import heapq
+import imp
 import json
 import os
 import re
+import shutil
+import signal
 import socket
 import subprocess
 import sys
+import threading
 import time
 
 import tnet
@@ -64,11 +73,17 @@ import tnet
 from common import util
 from common import spy
 
+import rendercache
+
 
 class Error(Exception):
   pass
 
 
+class Timeout(Error):
+  pass
+
+
 log = util.Logger(util.ANSI_GREEN)
 
 
@@ -143,9 +158,1338 @@ class Resources(object):
     return None
 
 
-def PluginDispatchLoop(in_dir, out_dir):
+class PythonPlugins(object):
+  """Plugins that are called in this process, rather than forked.
+
+  A plugin can have a render.py next to its render executable, defining:
+
+    Render(input_path, output, out_dir, tier=None) -> list of files created
+
+  It follows the same protocol as the executable, except that paths are
+  relative to out_dir rather than the working directory, and the list is
+  returned rather than printed.  tier is the size tier that the executable
+  gets in its environment, as a dict like {"sizeTier": "large", "inputBytes":
+  "5000000", "previewBytes": "1048576"} (see _TierFields), or None.
+
+  It can also define RenderDeferred() (see DeferredRenders).  Modules are
+  loaded once, and reloaded when they change.
+  """
+
+  def __init__(self):
+    # plugin_bin -> (mtime, module or None if it can't be imported).  Keep the
+    # module alive; Python 2 clears its globals when it's freed.
+    self.modules = {}
+    self.lock = threading.Lock()
+
+  def Get(self, plugin_bin, func_name='Render'):
+    """Returns a function of the plugin, or None to run the executable."""
+    module = self._Load(plugin_bin)
+    return getattr(module, func_name, None) if module else None
+
+  def _Load(self, plugin_bin):
+    py_path = plugin_bin + '.py'
+    try:
+      mtime = os.path.getmtime(py_path)
+    except OSError:
+      return None  # e.g. a shell plugin
+
+    with self.lock:
+      cached = self.modules.get(plugin_bin)
+      if cached and cached[0] == mtime:
+        return cached[1]
+
+      # Unique per plugin, e.g. user plugins can shadow package plugins.
+      module = imp.new_module('webpipe_plugin_%d' % len(self.modules))
+      module.__file__ = py_path
+      try:
+        # Not imp.load_source(), which writes render.pyc into the plugin dir
+        # and so changes its version for the render cache.
+        with open(py_path) as f:
+          code = compile(f.read(), py_path, 'exec')
+        exec code in module.__dict__
+      except Exception, e:
+        # e.g. a missing dependency.  The executable might still work.
+        log('Running %s out of process; importing %s failed: %s', plugin_bin,
+            py_path, e)
+        module = None
+      self.modules[plugin_bin] = (mtime, module)
+      return module
+
+
+# A plugin dir with an executable of this name is a persistent plugin.
+COPROCESS_NAME = 'coprocess'
+
+DEFAULT_MAX_COPROCESSES = 4
+COPROCESS_IDLE_SECS = 60.0
+
+
+def TnetString(s):
+  return '%d:%s,' % (len(s), s)
+
+
+def TnetDict(d):
+  """Minimal tnet encoder for a dict of byte strings.
+
+  Like tnetEncodeFile in wp-stub.sh; we only need to read with tnet.
+  """
+  payload = ''.join(TnetString(k) + TnetString(v)
+                    for k, v in sorted(d.iteritems()))
+  return '%d:%s}' % (len(payload), payload)
+
+
+class _Coprocess(object):
+  """A running persistent plugin."""
+
+  def __init__(self, coproc_bin):
+    self.coproc_bin = coproc_bin
+    self.p = subprocess.Popen(
+        [coproc_bin], cwd=os.path.dirname(coproc_bin), stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, close_fds=True)
+    self.last_used = time.time()
+    self.killed = False
+
+  def Render(self, input_path, output, out_dir, extra=None):
+    """Send one request and read the reply.
+
+    Raises:
+      IOError, ValueError, EOFError if the process died or misbehaved.
+    """
+    request = {'input': input_path, 'output': output, 'outDir': out_dir}
+    request.update(extra or {})
+    self.p.stdin.write(TnetDict(request))
+    self.p.stdin.flush()
+    reply = tnet.load(self.p.stdout)
+    if not isinstance(reply, dict):
+      raise ValueError('Expected a dict, got %r' % reply)
+    return reply
+
+  def Kill(self):
+    """Called by the watchdog when a render takes too long."""
+    self.killed = True
+    try:
+      self.p.kill()
+    except OSError:
+      pass  # already exited
+
+  def Stop(self):
+    try:
+      self.p.stdin.close()
+    except IOError:
+      pass
+    if self.p.poll() is None:
+      self.p.kill()
+    self.p.wait()
+
+
+class Coprocesses(object):
+  """Persistent plugins, so expensive startup (e.g. R) is paid once.
+
+  A plugin advertises that it's persistent with an executable named
+  'coprocess' next to 'render'.  It's started in the plugin dir, and reads
+  requests from stdin, each a tnet dict:
+
+    {"input": "/abs/path/foo.R", "output": "3", "outDir": "/abs/session",
+     "sizeTier": "small", "inputBytes": "1234", "previewBytes": "1234"}
+
+  For each one, it writes <outDir>/<output>.html and optionally the directory
+  <outDir>/<output>, like 'render', and then replies on stdout with a tnet dict:
+
+    {"files": ["3", "3.html"]}  or  {"error": "message"}
+
+  Stdin is closed when xrender is done with it.
+
+  A plugin can have more than one process if files are rendered concurrently,
+  but there are at most max_live processes in total.  Processes that crash are
+  restarted, and ones that are idle for idle_secs are stopped.
+  """
+
+  def __init__(self, max_live=DEFAULT_MAX_COPROCESSES,
+               idle_secs=COPROCESS_IDLE_SECS):
+    self.max_live = max_live
+    self.idle_secs = idle_secs
+
+    self.cond = threading.Condition()
+    self.idle = []  # _Coprocess instances, least recently used first
+    self.num_live = 0  # idle or rendering
+    self.reaper = None  # thread that stops idle processes, started lazily
+
+    self.starts = 0
+    self.crashes = 0
+    self.idle_stops = 0
+
+  def GetBin(self, plugin_bin):
+    """Returns the coprocess executable for a plugin, or None."""
+    path = os.path.join(os.path.dirname(plugin_bin), COPROCESS_NAME)
+    if os.access(path, os.X_OK):
+      return path
+    return None
+
+  def _Acquire(self, coproc_bin):
+    """Returns an idle process for the plugin, or a new one."""
+    victim = None
+    with self.cond:
+      while True:
+        for i, c in enumerate(self.idle):
+          if c.coproc_bin == coproc_bin:
+            del self.idle[i]
+            return c
+        if self.num_live < self.max_live:
+          break
+        if self.idle:
+          # Make room by stopping the least recently used one.
+          victim = self.idle.pop(0)
+          self.num_live -= 1
+          break
+        self.cond.wait()
+      self.num_live += 1
+      self.starts += 1
+
+    if victim:
+      victim.Stop()
+    try:
+      return _Coprocess(coproc_bin)
+    except OSError:
+      with self.cond:
+        self.num_live -= 1
+        self.cond.notify_all()
+      raise
+
+  def _Release(self, c, ok):
+    with self.cond:
+      if ok:
+        c.last_used = time.time()
+        self.idle.append(c)
+        if not self.reaper:
+          self.reaper = threading.Thread(target=self._Reap)
+          self.reaper.setDaemon(True)
+          self.reaper.start()
+      else:
+        self.num_live -= 1
+        self.crashes += 1
+      self.cond.notify_all()
+    if not ok:
+      c.Stop()
+
+  def _Reap(self):
+    """Stop processes that have been idle too long.
+
+    Exits when nothing is idle, so it doesn't outlive its work.
+    """
+    while True:
+      with self.cond:
+        now = time.time()
+        expired = [c for c in self.idle
+                   if now - c.last_used >= self.idle_secs]
+        for c in expired:
+          self.idle.remove(c)
+        self.num_live -= len(expired)
+        self.idle_stops += len(expired)
+        if expired:
+          self.cond.notify_all()
+
+        done = not self.idle
+        if done:
+          self.reaper = None
+        else:
+          secs = self.idle[0].last_used + self.idle_secs - now
+
+      for c in expired:
+        log('Stopping idle coprocess %s', c.coproc_bin)
+        c.Stop()
+      if done:
+        return
+      time.sleep(max(secs, 0.01))
+
+  def Render(self, coproc_bin, input_path, output, out_dir, timeout=None,
+             watchdog=None, extra=None):
+    """Render a file with a persistent plugin.
+
+    Args:
+      timeout: If set, the process is killed after this many seconds, using
+        watchdog.
+      extra: dict of more string fields for the request, e.g. the size tier
+
+    Returns:
+      The reply dict.
+
+    Raises:
+      Timeout if the process was killed.
+      Error if the process can't be started, or dies on the file twice.
+    """
+    for _ in xrange(2):
+      try:
+        c = self._Acquire(coproc_bin)
+      except OSError, e:
+        raise Error('Error starting %s: %s' % (coproc_bin, e))
+      watch = None
+      if timeout is not None:
+        watch = watchdog.Add(timeout, c.Kill)
+      failure = None
+      try:
+        reply = c.Render(input_path, output, out_dir, extra=extra)
+      except (IOError, ValueError, EOFError), e:
+        failure = e
+      if watch:
+        watchdog.Cancel(watch)
+
+      # If it was killed just after replying, don't reuse it.
+      self._Release(c, failure is None and not c.killed)
+      if failure is None:
+        return reply
+      if c.killed:
+        raise Timeout('%s timed out after %s seconds on %s' %
+                      (coproc_bin, timeout, input_path))
+      log('Coprocess %s failed (%s); restarting', coproc_bin, failure)
+    raise Error('Coprocess %s failed twice on %s' % (coproc_bin, input_path))
+
+  def Close(self):
+    """Stop the idle processes, e.g. at exit."""
+    with self.cond:
+      idle, self.idle = self.idle, []
+      self.num_live -= len(idle)
+      self.cond.notify_all()
+    for c in idle:
+      c.Stop()
+
+  def Stats(self):
+    with self.cond:
+      return {
+          'live': self.num_live,
+          'idle': len(self.idle),
+          'starts': self.starts,
+          'crashes': self.crashes,
+          'idleStops': self.idle_stops,
+          }
+
+
+DEFAULT_PLACEHOLDER_SECS = 1.0
+DEFAULT_TIMEOUT_SECS = 60.0
+
+# serve.py recognizes placeholders by this prefix.
+PLACEHOLDER_PREFIX = '<p class="wp-placeholder">'
+PLACEHOLDER_HTML = PLACEHOLDER_PREFIX + '<i>Rendering <code>%s</code> ...</i></p>\n'
+
+
+class Watchdog(object):
+  """Calls functions when their deadlines pass, on one thread.
+
+  The thread is started when needed, and exits when there's nothing left to
+  watch.  In Python 2, a timed wait polls every 50 ms or so, which is precise
+  enough for render budgets.
+  """
+
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.heap = []  # [deadline, seq, func], with func None if cancelled
+    self.seq = 0
+    self.thread = None
+
+  def Add(self, secs, func):
+    """Call func() in secs seconds.  Returns a handle for Cancel()."""
+    with self.cond:
+      self.seq += 1
+      entry = [time.time() + secs, self.seq, func]
+      heapq.heappush(self.heap, entry)
+      if not self.thread:
+        self.thread = threading.Thread(target=self._Run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+      self.cond.notify()
+    return entry
+
+  def Cancel(self, entry):
+    with self.cond:
+      entry[2] = None
+
+  def _Run(self):
+    while True:
+      with self.cond:
+        now = time.time()
+        due = []
+        while self.heap and (self.heap[0][2] is None or
+                             self.heap[0][0] <= now):
+          _, _, func = heapq.heappop(self.heap)
+          if func:
+            due.append(func)
+        if not self.heap and not due:
+          self.thread = None  # Add() starts another one
+          return
+        if not due:
+          self.cond.wait(self.heap[0][0] - now)
+          continue
+
+      for func in due:
+        try:
+          func()
+        except Exception, e:
+          log('Error in watchdog: %s', e)
+
+
+class TimeBudget(object):
+  """How long plugins are allowed to take.
+
+  After placeholder_secs, a placeholder part is published, so the parts after
+  a slow one aren't held up.  The real part replaces it when it's done.  A
+  render that takes longer than its plugin's timeout is killed.
+  """
+
+  def __init__(self, placeholder_secs=DEFAULT_PLACEHOLDER_SECS,
+               timeout_secs=DEFAULT_TIMEOUT_SECS, timeouts=None):
+    """
+    Args:
+      placeholder_secs: seconds before a placeholder, or None for none
+      timeout_secs: default seconds before a render is killed, or None
+      timeouts: dict of plugin name (e.g. 'dot') -> seconds, or None
+    """
+    self.placeholder_secs = placeholder_secs
+    self.timeout_secs = timeout_secs
+    self.timeouts = timeouts or {}
+    self.watchdog = Watchdog()
+
+  def Timeout(self, plugin_name):
+    return self.timeouts.get(plugin_name, self.timeout_secs)
+
+
+def ParseTimeouts(specs):
+  """Parse flags like '30' (the default) and 'dot=120' (one plugin).
+
+  0 means no limit.
+
+  Returns:
+    (default seconds, dict of plugin name -> seconds)
+  """
+  default = DEFAULT_TIMEOUT_SECS
+  timeouts = {}
+  for spec in specs:
+    plugin, _, secs = spec.rpartition('=')
+    try:
+      secs = float(secs) or None
+    except ValueError:
+      raise Error('Invalid timeout %r (expected e.g. 30 or dot=120)' % spec)
+    if plugin:
+      timeouts[plugin] = secs
+    else:
+      default = secs
+  return default, timeouts
+
+
+# Jobs that can wait for a render thread before submitting more blocks
+DEFAULT_MAX_QUEUED = 1000
+
+
+class _Job(object):
+  """A function submitted to a RenderPool."""
+
+  def __init__(self):
+    self.plugin = None
+    self.func = None
+    # Whether it's running and counts against its plugin's limit.  Protected
+    # by the pool's lock.
+    self.counted = False
+
+
+class RenderPool(object):
+  """Threads that run rendering plugins concurrently.
+
+  Jobs start in the order they're submitted, except that a plugin can only
+  have so many running at once.  So a slow renderer like dot or R can't occupy
+  every thread while cheap ones wait behind it.
+  """
+
+  def __init__(self, num_workers, limits=None, max_queued=DEFAULT_MAX_QUEUED):
+    """
+    Args:
+      num_workers: number of threads
+      limits: dict of plugin name (e.g. 'dot') -> max concurrent renders.  By
+        default, a plugin can use all threads but one.
+      max_queued: Submit() blocks while this many jobs are waiting to start,
+        so whoever is sending files is slowed down instead.
+    """
+    self.limits = limits or {}
+    self.default_limit = max(1, num_workers - 1)
+    self.max_queued = max_queued
+
+    self.cond = threading.Condition()
+    self.queue = []  # _Job instances, in submission order
+    self.running = collections.defaultdict(int)  # plugin name -> count
+    self.num_busy = 0  # queued or running
+    self.num_extra = 0  # workers to retire; see AddWorker()
+
+    for _ in xrange(num_workers):
+      self._StartWorker()
+
+  def _StartWorker(self):
+    t = threading.Thread(target=self._Worker)
+    t.setDaemon(True)
+    t.start()
+
+  def AddWorker(self, job=None):
+    """Start a worker to stand in for one that's stuck on a slow file.
+
+    The next worker to finish a job exits, so the pool shrinks back.
+
+    Args:
+      job: the stuck job, from Submit().  It stops counting against its
+        plugin's limit, so the next file for the same plugin can start.
+    """
+    with self.cond:
+      self.num_extra += 1
+      if job and job.counted:
+        self.running[job.plugin] -= 1
+        job.counted = False
+        self.cond.notify_all()
+    self._StartWorker()
+
+  def Submit(self, plugin, func, job=None):
+    """Call func() on a worker thread.
+
+    Args:
+      job: a _Job to pass to AddWorker() while func() runs, or None
+    """
+    job = job or _Job()
+    job.plugin = plugin
+    job.func = func
+    with self.cond:
+      while len(self.queue) >= self.max_queued:
+        self.cond.wait()
+      self.queue.append(job)
+      self.num_busy += 1
+      self.cond.notify_all()
+
+  def Wait(self):
+    """Block until everything submitted is done."""
+    with self.cond:
+      while self.num_busy:
+        self.cond.wait()
+
+  def _Next(self):
+    """Returns the first job whose plugin is under its limit.
+
+    Call with the lock held.
+    """
+    for i, job in enumerate(self.queue):
+      plugin = job.plugin
+      if self.running[plugin] < self.limits.get(plugin, self.default_limit):
+        del self.queue[i]
+        self.cond.notify_all()  # room for Submit()
+        return job
+    return None
+
+  def _Worker(self):
+    while True:
+      with self.cond:
+        while True:
+          job = self._Next()
+          if job:
+            break
+          self.cond.wait()
+        self.running[job.plugin] += 1
+        job.counted = True
+
+      try:
+        job.func()
+      except Exception, e:
+        log('Error rendering with %s: %s', job.plugin, e)
+
+      with self.cond:
+        if job.counted:  # AddWorker() didn't release it
+          self.running[job.plugin] -= 1
+          job.counted = False
+        self.num_busy -= 1
+        self.cond.notify_all()
+        if self.num_extra:
+          self.num_extra -= 1
+          return
+
+
+class _InOrder(object):
+  """Calls emit() for finished parts in counter order.
+
+  When parts are rendered concurrently, they can finish out of order.  But
+  when serve hears about part n, it assumes the ones before it exist.
+  """
+
+  def __init__(self, next_num, emit):
+    self.next_num = next_num
+    self.emit = emit
+    self.finished = {}  # num -> result
+    self.lock = threading.Lock()
+
+  def Done(self, num, result):
+    with self.lock:
+      self.finished[num] = result
+      while self.next_num in self.finished:
+        self.emit(self.finished.pop(self.next_num))
+        self.next_num += 1
+
+  def Replace(self, num, result):
+    """Replace a result passed to Done(), e.g. a placeholder with the real part.
+
+    If the old one was already emitted, the new one is emitted right away.
+    """
+    with self.lock:
+      if num in self.finished:
+        self.finished[num] = result
+      else:
+        self.emit(result)
+
+
+def _FromCache(render_cache, key, num, out_dir, info):
+  """Materialize a cached part instead of running the plugin.
+
+  Returns:
+    The stdout the plugin would have printed, or None on a miss.
+  """
+  start_time = time.time()
+  if not render_cache.Get(key, out_dir, num):
+    return None
+
+  info['cacheHit'] = True
+  info['elapsed'] = time.time() - start_time
+  info['rendered'] = time.time()
+  out_html_path = os.path.join(out_dir, '%d.html' % num)
+  info['size'] = os.path.getsize(out_html_path)
+
+  stdout = ''
+  if os.path.isdir(os.path.join(out_dir, str(num))):
+    stdout += '%d\n' % num
+  stdout += '%d.html\n' % num
+  return stdout
+
+
+def _WriteFile(path, contents):
+  """Write a file atomically, so readers never see half of it."""
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    f.write(contents)
+  os.rename(tmp, path)
+
+
+def _ErrorPart(num, file_type, out_dir, error):
+  """Write an error as part num.  Returns the part's metadata and stdout."""
+  out_html_path = os.path.join(out_dir, '%d.html' % num)
+  try:
+    _WriteFile(out_html_path, cgi.escape(error))
+  except (IOError, OSError), e:
+    log("Couldn't write %s: %s", out_html_path, e)
+  info = {'num': num, 'fileType': file_type, 'error': error,
+          'rendered': time.time()}
+  try:
+    info['size'] = os.path.getsize(out_html_path)
+  except OSError:
+    info['size'] = None
+  return info, '%d.html\n' % num
+
+
+def _MoveOutputs(work_dir, out_dir):
+  """Move what a plugin wrote in its staging dir into the session dir."""
+  for name in os.listdir(work_dir):
+    dest = os.path.join(out_dir, name)
+    if os.path.isdir(dest):
+      shutil.rmtree(dest)  # left over from a crash
+    os.rename(os.path.join(work_dir, name), dest)
+  os.rmdir(work_dir)
+
+
+class _Progress(object):
+  """Publishes a placeholder for a slow render, unless it finishes first."""
+
+  def __init__(self, info, input_path, out_dir, on_placeholder):
+    self.info = info
+    self.input_path = input_path
+    self.out_dir = out_dir
+    self.on_placeholder = on_placeholder
+
+    self.lock = threading.Lock()
+    self.published = False
+    self.done = False
+
+  def Publish(self):
+    """Called by the watchdog when the placeholder deadline passes."""
+    num = self.info['num']
+    with self.lock:
+      if self.done:
+        return
+      html = PLACEHOLDER_HTML % cgi.escape(os.path.basename(self.input_path))
+      _WriteFile(os.path.join(self.out_dir, '%d.html' % num), html)
+      log('Published placeholder for part %d', num)
+
+      info = dict(self.info, placeholder=True, rendered=time.time(),
+                  size=len(html))
+      # With the lock held, so the real part can't be announced first.
+      self.on_placeholder(info, '%d.html\n' % num)
+      self.published = True
+
+  def Finish(self):
+    """Returns whether a placeholder was published."""
+    with self.lock:
+      self.done = True
+      return self.published
+
+
+def _KillGroup(p, killed):
+  """Kill a plugin and anything it started, like a shell script's dot."""
+  killed.append(True)
+  try:
+    os.killpg(p.pid, signal.SIGKILL)
+  except OSError:
+    pass  # already exited
+
+
+# Inputs are classified by size, so plugins can show a bounded preview of a big
+# file rather than converting all of it (see the "Style Guide" above).
+SMALL_MAX_BYTES = 1 << 20  # rendered in full
+LARGE_MAX_BYTES = 1 << 30  # the first SMALL_MAX_BYTES are rendered
+
+
+def SizeTier(num_bytes):
+  """Returns the tier of an input, and how many bytes of it to render.
+
+  A huge input isn't previewed at all.
+  """
+  if num_bytes <= SMALL_MAX_BYTES:
+    return 'small', num_bytes
+  if num_bytes <= LARGE_MAX_BYTES:
+    return 'large', SMALL_MAX_BYTES
+  return 'huge', 0
+
+
+def _TierFields(input_size):
+  """Fields that tell a plugin how much of its input to render."""
+  tier, preview_bytes = SizeTier(input_size)
+  return {'sizeTier': tier, 'inputBytes': str(input_size),
+          'previewBytes': str(preview_bytes)}
+
+
+def _TierEnv(fields):
+  """The same, as environment variables for a plugin executable."""
+  return {
+      'WEBPIPE_SIZE_TIER': fields['sizeTier'],
+      'WEBPIPE_INPUT_BYTES': fields['inputBytes'],
+      'WEBPIPE_PREVIEW_BYTES': fields['previewBytes'],
+      }
+
+
+# A plugin that appends to <num>.html as it goes, rather than writing it all
+# at the end, has a file with this name next to 'render'.  Viewers are sent its
+# output while it's still running.
+STREAMING_NAME = 'streaming'
+
+def _Streams(plugin_bin):
+  return os.path.exists(
+      os.path.join(os.path.dirname(plugin_bin), STREAMING_NAME))
+
+
+def _RenderPart(plugin_bin, input_path, file_type, num, out_dir, spy_client,
+                render_cache=None, python_plugins=None, coprocesses=None,
+                budget=None, on_placeholder=None, on_start=None,
+                input_size=None):
+  """Run a plugin to write <num>.html and optionally the directory <num>.
+
+  Args:
+    input_size: If set, the size of the input in bytes.  The plugin is told
+      its SizeTier(), so it can render a preview of a big file.
+    budget: If set, a TimeBudget.  The plugin writes into a staging dir, and
+      what it wrote is moved into out_dir when it's done.
+    on_placeholder: Called with (info, stdout) for a placeholder part, when
+      the plugin takes longer than the budget's placeholder_secs.
+    on_start: Called with the path of the plugin's <num>.html, relative to
+      out_dir, before a plugin that streams its output is run.
+
+  Returns:
+    A dict of metadata about the part, and the plugin's stdout.  If a
+    placeholder was published, info['upgrade'] is True.
+  """
+  out_html_path = os.path.join(out_dir, '%d.html' % num)
+  info = {'num': num, 'fileType': file_type, 'plugin': plugin_bin}
+  stdout = ''
+
+  tier_fields = None
+  if input_size is not None:
+    tier_fields = _TierFields(input_size)
+    info['sizeTier'] = tier_fields['sizeTier']
+
+  key = None
+  # Hashing a big input would read all of it, which is what its tier avoids.
+  # Its part is small and quick to render anyway.
+  if render_cache and info.get('sizeTier', 'small') == 'small':
+    try:
+      key = rendercache.MakeKey(input_path, plugin_bin)
+    except (IOError, OSError), e:
+      log('Not caching %s: %s', input_path, e)
+    if key:
+      stdout = _FromCache(render_cache, key, num, out_dir, info)
+      if stdout is not None:
+        log('Render cache hit for %s', input_path)
+        return info, stdout
+      stdout = ''
+
+  # protocol is:
+  # render <input> <output>
+  #
+  # output is just "3".  You are allowed to create the file 3.html, and
+  # optionally the *directory* 3.
+  #
+  # You must print all the files you create to stdout, and output nothing
+  # else.
+  #
+  # Other tools may output stuff on stdout.  You should redirect them to
+  # stderr with: 1>&2.  stderr could show up in debug output on the web
+  # page (probably only if the exit code is 1?)
+  #
+  # In the error case, xrender.py should write 3.html, along with a log
+  # file?  The html should preview it, but only if it's long.  Use the .log
+  # viewer.
+  #
+  # The environment has $WEBPIPE_SIZE_TIER (small, large, or huge),
+  # $WEBPIPE_INPUT_BYTES, and $WEBPIPE_PREVIEW_BYTES, the number of bytes of
+  # the input to render.  See SizeTier().
+  #
+  # NOTE: In the future, we could pass $WEBPIPE_ACTION if we want a
+  # different type of rendering?
+
+  work_dir = out_dir
+  timeout = None
+  watchdog = None
+  progress = None
+  watches = []
+  if budget:
+    # Render off to the side, so a placeholder can be put at <num>.html
+    # without the plugin appending to it.
+    work_dir = os.path.join(out_dir, '.rendering-%d' % num)
+    shutil.rmtree(work_dir, ignore_errors=True)  # left over from a crash
+    os.mkdir(work_dir)
+    timeout = budget.Timeout(os.path.basename(os.path.dirname(plugin_bin)))
+    watchdog = budget.watchdog
+    if budget.placeholder_secs is not None and on_placeholder:
+      progress = _Progress(info, input_path, out_dir, on_placeholder)
+      watches.append(watchdog.Add(budget.placeholder_secs, progress.Publish))
+
+  if on_start and _Streams(plugin_bin):
+    on_start(os.path.relpath(os.path.join(work_dir, '%d.html' % num), out_dir))
+
+  argv = [plugin_bin, input_path, str(num)]
+  log('argv: %s cwd %s', argv, work_dir)
+
+  render_func = python_plugins.Get(plugin_bin) if python_plugins else None
+  coproc_bin = None
+  if not render_func and coprocesses:
+    coproc_bin = coprocesses.GetBin(plugin_bin)
+
+  error = None
+  start_time = time.time()
+  if render_func:
+    # NOTE: This can't be killed, so there's only a placeholder.
+    info['inProcess'] = True
+    try:
+      created = render_func(input_path, str(num), work_dir, tier=tier_fields)
+      stdout = ''.join('%s\n' % name for name in created)
+      exit_code = 0
+    except Exception, e:
+      log('ERROR: %s.py raised %s', plugin_bin, e)
+      exit_code = None
+      error = 'ERROR: %s.py: %s' % (plugin_bin, e)
+
+  elif coproc_bin:
+    try:
+      reply = coprocesses.Render(coproc_bin, input_path, str(num), work_dir,
+                                 timeout=timeout, watchdog=watchdog,
+                                 extra=tier_fields)
+    except Timeout, e:
+      log('%s', e)
+      exit_code = None
+      error = 'ERROR: %s' % e
+      info['error'] = 'timeout'
+    except Error, e:
+      # Fall back to running 'render' below.
+      log('%s; running %s instead', e, plugin_bin)
+      coproc_bin = None
+    else:
+      info['coprocess'] = True
+      exit_code = 0
+      if 'error' in reply:
+        log('ERROR: %s: %s', coproc_bin, reply['error'])
+        exit_code = None
+        error = 'ERROR: %s: %s' % (coproc_bin, reply['error'])
+        info['error'] = str(reply['error'])
+      stdout = ''.join('%s\n' % name for name in reply.get('files', []))
+
+  if not render_func and not coproc_bin:
+    killed = []
+    try:
+      # Capture stdout, so it can be printed in counter order.  With a
+      # budget, the plugin gets its own process group, so it can be killed
+      # along with its children.
+      env = None
+      if tier_fields:
+        env = dict(os.environ, **_TierEnv(tier_fields))
+      p = subprocess.Popen(argv, cwd=work_dir, stdout=subprocess.PIPE, env=env,
+                           preexec_fn=os.setsid if budget else None)
+      if timeout is not None:
+        watches.append(watchdog.Add(timeout, lambda: _KillGroup(p, killed)))
+      stdout, _ = p.communicate()
+      exit_code = p.returncode
+    except OSError, e:
+      log('%s', e)
+      exit_code = None
+      error = 'ERROR: %s: %s' % (argv, e)
+    if killed:
+      log('ERROR: %s timed out after %s seconds', argv, timeout)
+      exit_code = None
+      error = 'ERROR: %s timed out after %s seconds' % (argv, timeout)
+      info['error'] = 'timeout'
+
+  elapsed = time.time() - start_time
+  info['elapsed'] = elapsed
+
+  if exit_code is not None:
+    # Record how long rendering plugin takes.
+    # BUG: These aren't sent in the OSError case!  Fix that.
+    d = {'pluginPath': plugin_bin, 'exitCode': exit_code, 'elapsed': elapsed}
+    spy_client.SendRecord('xrender-plugin', d)
+
+  if exit_code is not None and exit_code != 0:
+    log('ERROR: %s exited with code %d', argv, exit_code)
+    # TODO:
+    # - make a nicer template.
+    # - show stderr
+    error = 'ERROR: %s exited with code %d' % (argv, exit_code)
+    info['error'] = 'exit code %d' % exit_code
+
+  # Check that the plugin actually create the file.
+  elif error is None and not os.path.exists(
+      os.path.join(work_dir, '%d.html' % num)):
+    log('Plugin error: %r not created', out_html_path)
+    error = 'Plugin error: %r not created' % out_html_path
+    info['error'] = 'not created'
+
+  if budget:
+    for w in watches:
+      watchdog.Cancel(w)
+    if progress and progress.Finish():
+      info['upgrade'] = True
+    if error:
+      shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+      _MoveOutputs(work_dir, out_dir)
+
+  if error:
+    # The part number is taken, so there has to be something there.
+    info.setdefault('error', str(error))
+    _WriteFile(out_html_path, error)
+    stdout = '%d.html\n' % num
+  elif key:
+    render_cache.Put(key, out_dir, num)
+
+  info['rendered'] = time.time()
+  try:
+    info['size'] = os.path.getsize(out_html_path)
+  except OSError:
+    info['size'] = None
+  return info, stdout
+
+
+# A followed file's part starts with this, so the browser knows to ask for what
+# is appended to it.
+FOLLOW_PREFIX = '<p class="wp-follow">'
+
+DEFAULT_MAX_FOLLOWED = 4
+FOLLOW_POLL_SECS = 0.5
+# Of a file that's already big, only the end is shown.
+FOLLOW_START_BYTES = 64 << 10
+# Read at most this much at a time.  A line longer than this is shown anyway.
+FOLLOW_MAX_READ = 1 << 20
+
+# Each update is appended as a block like this.  It ends with '</pre>\n', so a
+# reader can tell where it ends.
+FOLLOW_CHUNK = '<pre class="wp-follow-chunk" style="margin: 0">%s</pre>\n'
+
+
+def _FollowChunk(data, ansi):
+  """Render lines of a followed file.
+
+  The HTML is ASCII, so that its length in a browser is its length in bytes.
+  """
+  html = None
+  if ansi:
+    try:
+      p = subprocess.Popen(['aha', '--no-header'], stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE)
+      html, _ = p.communicate(data)
+    except OSError, e:
+      log('Showing escape codes as text: %s', e)
+  if html is None:
+    html = cgi.escape(data, quote=True)
+  html = html.decode('utf-8', 'replace').encode('ascii', 'xmlcharrefreplace')
+  return FOLLOW_CHUNK % html
+
+
+class _Followed(object):
+  """A file being followed."""
+
+  def __init__(self, f, num, html_path, offset, ansi, on_stop):
+    self.f = f
+    self.ino = os.fstat(f.fileno()).st_ino
+    self.num = num
+    self.html_path = html_path
+    self.offset = offset  # what's been shown, always after a newline
+    self.ansi = ansi
+    self.on_stop = on_stop
+    # Held while appending to the part, so appends don't interleave.
+    self.lock = threading.Lock()
+    self.stopped = False
+
+
+class Followers(object):
+  """Followed files, whose parts grow when the files do, e.g. logs.
+
+  Each file has a read offset, and only complete lines after it are rendered
+  and appended to the part, so an update costs O(new bytes).  Following more
+  than max_followed files stops the one that was followed first.  A file that's
+  truncated, replaced or removed stops being followed.
+  """
+
+  def __init__(self, max_followed=DEFAULT_MAX_FOLLOWED,
+               poll_secs=FOLLOW_POLL_SECS):
+    self.max_followed = max_followed
+    self.poll_secs = poll_secs
+    # real path -> _Followed, followed first first
+    self.followed = collections.OrderedDict()
+    self.lock = threading.Lock()  # protects everything here
+    self.thread = None
+
+    self.appends = 0
+    self.bytes_read = 0
+    self.stops = 0
+
+  def IsFollowing(self, input_path):
+    with self.lock:
+      return os.path.realpath(input_path) in self.followed
+
+  def Follow(self, input_path, file_type, num, out_dir, on_stop):
+    """Write the start of a followed part, and keep appending to it.
+
+    Args:
+      on_stop: Called with num when the file isn't followed anymore.
+
+    Returns:
+      A dict of metadata about the part, and the part name for stdout.
+
+    Raises:
+      IOError if the file can't be read.
+    """
+    f = open(input_path, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    start = max(0, size - FOLLOW_START_BYTES)
+    f.seek(start)
+    data = f.read(size - start)
+    if start:
+      data = data[data.find('\n') + 1:]  # from the start of a line
+      start = size - len(data)
+    end = data.rfind('\n') + 1  # the rest of the line comes later
+
+    note = ''
+    if start:
+      note = ' from byte %d' % start
+    html = '%s<i>Following <code>%s</code>%s</i></p>\n%s' % (
+        FOLLOW_PREFIX, cgi.escape(os.path.basename(input_path), quote=True),
+        note, _FollowChunk(data[:end], file_type == 'ansi'))
+    html_path = os.path.join(out_dir, '%d.html' % num)
+    _WriteFile(html_path, html)
+
+    stopped = []
+    with self.lock:
+      while len(self.followed) >= self.max_followed:
+        _, old = self.followed.popitem(last=False)
+        stopped.append(old)
+      self.followed[os.path.realpath(input_path)] = _Followed(
+          f, num, html_path, start + end, file_type == 'ansi', on_stop)
+      if not self.thread:
+        self.thread = threading.Thread(target=self._Run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+    for old in stopped:
+      self._Stopped(old, 'more than %d files are followed' % self.max_followed)
+
+    info = {'num': num, 'fileType': file_type, 'following': True,
+            'rendered': time.time(), 'size': len(html)}
+    return info, '%d.html\n' % num
+
+  def _Stopped(self, fl, reason):
+    """Note why a file isn't followed anymore.  Call without the lock."""
+    log('Stopped following part %d: %s', fl.num, reason)
+    with fl.lock:
+      fl.stopped = True
+      fl.f.close()
+      with open(fl.html_path, 'a') as out:
+        out.write(FOLLOW_CHUNK % ('<i>Stopped following: %s</i>' % reason))
+    with self.lock:
+      self.stops += 1
+    fl.on_stop(fl.num)
+
+  def _Update(self, path, fl):
+    """Append what was added to a followed file.
+
+    Returns:
+      Why it can't be followed anymore, or None.
+    """
+    with fl.lock:
+      if fl.stopped:
+        return None
+      return self._Append(path, fl)
+
+  def _Append(self, path, fl):
+    """Call with fl.lock held."""
+    try:
+      st = os.stat(path)
+    except OSError:
+      return 'the file was removed'
+    if st.st_ino != fl.ino or st.st_size < fl.offset:
+      return 'the file was replaced or truncated'
+    if st.st_size == fl.offset:
+      return None
+
+    try:
+      fl.f.seek(fl.offset)
+      data = fl.f.read(min(st.st_size - fl.offset, FOLLOW_MAX_READ))
+    except IOError, e:
+      return str(e)
+    end = data.rfind('\n') + 1
+    if not end:
+      if len(data) < FOLLOW_MAX_READ:
+        return None  # wait for the rest of the line
+      end = len(data)
+    with open(fl.html_path, 'a') as out:
+      out.write(_FollowChunk(data[:end], fl.ansi))
+    fl.offset += end
+    with self.lock:
+      self.appends += 1
+      self.bytes_read += end
+    return None
+
+  def Poll(self):
+    """Append to the parts of the files that grew."""
+    with self.lock:
+      items = self.followed.items()
+    for path, fl in items:
+      reason = self._Update(path, fl)
+      if reason:
+        with self.lock:
+          if self.followed.get(path) is not fl:
+            continue  # stopped in the meantime
+          del self.followed[path]
+        self._Stopped(fl, reason)
+
+  def _Run(self):
+    while True:
+      time.sleep(self.poll_secs)
+      self.Poll()
+      with self.lock:
+        if not self.followed:
+          self.thread = None  # Follow() starts another one
+          return
+
+  def Close(self):
+    """Stop following everything, e.g. when xrender exits."""
+    with self.lock:
+      items = self.followed.values()
+      self.followed.clear()
+    for fl in items:
+      with fl.lock:
+        fl.stopped = True
+        fl.f.close()
+
+  def Stats(self):
+    with self.lock:
+      return {
+          'following': len(self.followed),
+          'maxFollowed': self.max_followed,
+          'appends': self.appends,
+          'bytesRead': self.bytes_read,
+          'stops': self.stops,
+          }
+
+
+# A plugin can write a manifest of this name in its part directory, listing
+# files it renders only when they're first requested.
+DEFERRED_NAME = 'deferred.json'
+
+
+def _ReadManifest(part_dir):
+  """Returns the part's deferred.json, or {} if it has none."""
+  try:
+    with open(os.path.join(part_dir, DEFERRED_NAME)) as f:
+      manifest = json.load(f)
+  except (IOError, ValueError):
+    return {}
+  return manifest if isinstance(manifest, dict) else {}
+
+
+class _Pending(object):
+  """A deferred file that's being rendered."""
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.error = None
+
+
+class DeferredRenders(object):
+  """Render the expensive files of a part when they're first requested.
+
+  A plugin writes its cheap preview eagerly, and declares the rest in
+  <output>/deferred.json:
+
+    {"fileType": "csv", "input": "foo.csv", "files": ["full.html"]}
+
+  where input is a file it copied into the part directory.  To render one of
+  the files, RenderDeferred(input_path, name, out_path) in the plugin's
+  render.py is called in this process, or else its executable is run as
+
+    render --deferred <name> <input> <out_path>
+
+  in the part directory.  The file is moved into place when it's done, and
+  from then on it's served from disk like any other.  Concurrent requests for
+  the same file wait for a single render.
+  """
+
+  def __init__(self, res=None, python_plugins=None):
+    self.res = res or Resources()
+    self.python_plugins = python_plugins or PythonPlugins()
+    self.pending = {}  # path -> _Pending
+    self.lock = threading.Lock()  # protects pending and the stats
+
+    self.renders = 0
+    self.waits = 0
+    self.failures = 0
+
+  def Render(self, path):
+    """Render the file at path if it's deferred and doesn't exist yet.
+
+    Returns:
+      None, or an error message if the plugin failed to render it.
+    """
+    with self.lock:
+      p = self.pending.get(path)
+      first = p is None
+      if first:
+        if os.path.exists(path):
+          return None
+        p = self.pending[path] = _Pending()
+      else:
+        self.waits += 1
+
+    if first:
+      try:
+        self._Render(path)
+      except Error, e:
+        p.error = str(e)
+      finally:
+        with self.lock:
+          del self.pending[path]
+        p.event.set()
+    else:
+      p.event.wait()
+    return p.error
+
+  def RenderAll(self, part_dir):
+    """Render all the deferred files of a part, e.g. before publishing it.
+
+    Raises:
+      Error if the plugin failed to render one.
+    """
+    for name in _ReadManifest(part_dir).get('files', []):
+      error = self.Render(os.path.join(part_dir, os.path.basename(name)))
+      if error:
+        raise Error(error)
+
+  def _Render(self, path):
+    part_dir, name = os.path.split(path)
+    manifest = _ReadManifest(part_dir)
+    if name not in manifest.get('files', []):
+      return  # e.g. a 404
+
+    file_type = manifest.get('fileType')
+    plugin_bin = self.res.GetPluginBin(file_type) if file_type else None
+    if not plugin_bin:
+      raise Error('No plugin to render %s' % path)
+    # Only files in the part directory
+    input_path = os.path.join(part_dir, os.path.basename(manifest['input']))
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    start_time = time.time()
+    func = self.python_plugins.Get(plugin_bin, 'RenderDeferred')
+    try:
+      if func:
+        func(input_path, name, tmp)
+      else:
+        argv = [plugin_bin, '--deferred', name, input_path, tmp]
+        log('argv: %s cwd %s', argv, part_dir)
+        # Nothing on stdout is part of the protocol.
+        exit_code = subprocess.call(argv, cwd=part_dir, stdout=sys.stderr)
+        if exit_code != 0:
+          raise Error('%s exited with code %d' % (plugin_bin, exit_code))
+      os.rename(tmp, path)
+    except Exception, e:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+      with self.lock:
+        self.failures += 1
+      log('ERROR: rendering %s: %s', path, e)
+      raise Error('Error rendering %s: %s' % (name, e))
+
+    log('Rendered %s in %.3fs', path, time.time() - start_time)
+    with self.lock:
+      self.renders += 1
+
+  def Stats(self):
+    with self.lock:
+      return {
+          'rendering': len(self.pending),
+          'renders': self.renders,
+          'waits': self.waits,
+          'failures': self.failures,
+          }
+
+
+def PluginDispatchLoop(in_dir, out_dir, announce=None, pool=None,
+                       render_cache=None, in_process=True, coprocesses=None,
+                       budget=None, announce_start=None, followers=None,
+                       announce_follow=None):
   """
   Coroutine that passes its input to a rendering plugin.
+
+  The input is a filename, or a message (see ParseMessage).  A message is
+  either a dict, or a line in the header's format, like
+  27:{"follow": "/var/log/syslog"} to follow a file (see Followers).
+
+  Args:
+    in_dir: directory that input filenames are relative to
+    out_dir: the session directory that parts are written to
+    announce: If set, announce(info) is called for every part written, with a
+      dict of metadata: num, size, fileType, plugin, elapsed, and rendered (a
+      timestamp).  Otherwise, the plugins' output is printed on stdout, after
+      a header with the counter.
+    pool: If set, a RenderPool to render on.  Part numbers are still assigned
+      in the order filenames arrive, and parts are announced in that order.
+    render_cache: If set, a RenderCache.  A file that was rendered before by
+      the same plugin is copied from it, and the plugin isn't run.
+    in_process: Call plugins with a render.py in this process (see
+      PythonPlugins).  If False, always run the executable.
+    coprocesses: If set, a Coprocesses instance that runs persistent plugins.
+    budget: If set, a TimeBudget.  Slow parts get a placeholder, which is
+      announced again when the real part replaces it.  Later parts only flow
+      past a slow one with a pool.
+    announce_start: If set, announce_start(num, path) is called when a plugin
+      that streams its output (see STREAMING_NAME) starts writing part num, to
+      path relative to out_dir.  Otherwise, a line like
+      {"started": 3, "path": "3.html"} is printed, in the header's format.
+      The part isn't done until it's announced.
+    followers: If set, a Followers instance, and files can be followed.
+    announce_follow: If set, announce_follow(num, path) is called before a
+      followed part is announced, with the path of the part relative to
+      out_dir, and announce_follow(num, None) when it stops growing.
+      Otherwise, lines like {"following": 3, "path": "3.html"} and
+      {"unfollowed": 3} are printed.
   """
 
   # TODO:
@@ -157,6 +1501,7 @@ def PluginDispatchLoop(in_dir, out_dir):
 
   spy_client = spy.GetClientFromConfig()
   res = Resources()
+  python_plugins = PythonPlugins() if in_process else None
 
   entries = os.listdir(out_dir)
   nums = []
@@ -174,15 +1519,73 @@ def PluginDispatchLoop(in_dir, out_dir):
   log('counter initialized to %d', counter)
 
   # e.g. we are about to write "1"
-  header = json.dumps({'stream': 'netstring', 'nextPart': counter})
-
-  # Print it on a single line.  Also allow netstring parsing.  Minimal
-  # JSON/netstring header is: 2:{}\n.
-  sys.stdout.write(tnet.dump_line(header))
+  # The session lets a server with many sessions tell which one this is.
+  session = os.path.basename(os.path.normpath(out_dir))
+  header = json.dumps({'stream': 'netstring', 'nextPart': counter,
+                       'session': session})
+
+  if not announce:
+    # Print it on a single line.  Also allow netstring parsing.  Minimal
+    # JSON/netstring header is: 2:{}\n.
+    sys.stdout.write(tnet.dump_line(header))
+
+  # Parts are emitted in order, but streams start on any worker.
+  stdout_lock = threading.Lock()
+
+  def Emit(result):
+    info, stdout = result
+    if announce:
+      announce(info)
+    else:
+      with stdout_lock:
+        sys.stdout.write(stdout)
+        sys.stdout.flush()
+
+  def PrintMessage(d):
+    line = json.dumps(dict(d, session=session))
+    with stdout_lock:
+      sys.stdout.write(tnet.dump_line(line))
+      sys.stdout.flush()
+
+  def Start(num, path):
+    if announce_start:
+      announce_start(num, path)
+    elif not announce:
+      PrintMessage({'started': num, 'path': path})
+
+  def Follow(num, path):
+    if announce_follow:
+      announce_follow(num, path)
+    elif not announce:
+      if path:
+        PrintMessage({'following': num, 'path': path})
+      else:
+        PrintMessage({'unfollowed': num})
+
+  in_order = _InOrder(counter, Emit)
 
   while True:
     # NOTE: This is a coroutine.
-    filename = yield
+    item = yield
+
+    file_type = None
+    options = {}
+    if isinstance(item, dict) or MESSAGE_RE.match(item):
+      try:
+        if not isinstance(item, dict):
+          item = json.loads(item[item.index(':')+1:])
+        filename, file_type, options = ParseMessage(item)
+      except (ValueError, Error), e:
+        log('Ignored invalid message %r: %s', item, e)
+        continue
+    else:
+      filename = item
+
+    follow = options.get('follow', False)
+    if follow and not followers:
+      log('Not following %s; rendering it once', filename)
+      follow = False
+
     # TODO: If file contains punctuation, escape it to be BOTH shell and HTML
     # safe, and then MOVE It to ~/webpipe/safe-name
 
@@ -194,21 +1597,35 @@ def PluginDispatchLoop(in_dir, out_dir):
       log('Skipping directory %s (for now)', input_path)
       continue
 
-    # TODO: handle errors
+    # Check that it can be opened, but don't read it; it could be huge.
     try:
       with open(input_path) as f:
-        contents = f.read()
+        input_size = os.fstat(f.fileno()).st_size
     except IOError, e:
       # e.g. file doesn't exist.  Just log and ignore for now.
       # Someone could type 'wp show nonexistent'.
       log('%s', e)
       continue
 
-    file_type = GetFileType(filename)
+    file_type = file_type or GetFileType(filename)
     log('file type: %s', file_type)
 
-    out_html_filename = '%d.html' % counter
-    out_html_path = os.path.join(out_dir, out_html_filename)
+    if follow:
+      if followers.IsFollowing(input_path):
+        log('Already following %s', input_path)
+        continue
+      num = counter
+      try:
+        result = followers.Follow(
+            input_path, file_type, num, out_dir,
+            on_stop=lambda num: Follow(num, None))
+      except IOError, e:
+        log('%s', e)
+        continue
+      counter += 1
+      Follow(num, '%d.html' % num)
+      in_order.Done(num, result)
+      continue
 
     # Order of resolution:
     #
@@ -219,77 +1636,108 @@ def PluginDispatchLoop(in_dir, out_dir):
 
     # The DEFAULT plugin should handle everything
     plugin_bin = res.GetPluginBin(file_type) or res.GetPluginBin('DEFAULT')
-    if plugin_bin:
-
-      # protocol is:
-      # render <input> <output>
-      #
-      # output is just "3".  You are allowed to create the file 3.html, and
-      # optionally the *directory* 3.
-      #
-      # You must print all the files you create to stdout, and output nothing
-      # else.
-      #
-      # Other tools may output stuff on stdout.  You should redirect them to
-      # stderr with: 1>&2.  stderr could show up in debug output on the web
-      # page (probably only if the exit code is 1?)
-      #
-      # In the error case, xrender.py should write 3.html, along with a log
-      # file?  The html should preview it, but only if it's long.  Use the .log
-      # viewer.
-      #
-      # NOTE: In the future, we could pass $WEBPIPE_ACTION if we want a
-      # different type of rendering?
-
-      argv = [plugin_bin, input_path, str(counter)]
-      log('argv: %s cwd %s', argv, out_dir)
-
-      subprocess_exc = None  # record
-      start_time = time.time()
+    if not plugin_bin:
+      log('No renderer for %r and no DEFAULT; ignored', filename)
+      continue
+
+    # Reserve the part number now, in arrival order.
+    num = counter
+    counter += 1
+
+    # OnPlaceholder runs on the watchdog thread, so it names the job to
+    # release.
+    job = _Job() if pool else None
+
+    def Render(plugin_bin=plugin_bin, input_path=input_path,
+               file_type=file_type, num=num, input_size=input_size, job=job):
+      placeholders = []
+
+      def OnPlaceholder(info, stdout):
+        placeholders.append(num)
+        in_order.Done(num, (info, stdout))
+        if pool:
+          # This worker is stuck on a slow file; let another take new ones.
+          pool.AddWorker(job)
+
       try:
-        exit_code = subprocess.call(argv, cwd=out_dir)
-      except OSError, e:
-        subprocess_exc = e
-        log('%s', e)
-        # NOTE: should we be consistent and print in the HTML window?
-        continue
+        result = _RenderPart(plugin_bin, input_path, file_type, num, out_dir,
+                             spy_client, render_cache=render_cache,
+                             python_plugins=python_plugins,
+                             coprocesses=coprocesses, budget=budget,
+                             on_placeholder=OnPlaceholder,
+                             on_start=lambda path: Start(num, path),
+                             input_size=input_size)
+      except Exception, e:
+        # The number is reserved, so the part has to be announced, or no
+        # later part would be.
+        log('ERROR: rendering part %d raised %s', num, e)
+        result = _ErrorPart(num, file_type, out_dir, 'ERROR: %s' % e)
+        if placeholders:
+          result[0]['upgrade'] = True
+      if result[0].get('upgrade'):
+        in_order.Replace(num, result)
+      else:
+        in_order.Done(num, result)
+
+    if pool:
+      # e.g. 'dot', for per-plugin limits
+      plugin_name = os.path.basename(os.path.dirname(plugin_bin))
+      pool.Submit(plugin_name, Render, job=job)
+    else:
+      Render()
 
-      elapsed = time.time() - start_time
 
-      if exit_code != 0:
-        log('ERROR: %s exited with code %d', argv, exit_code)
-        with open(out_html_path, 'w') as f:
-          # TODO:
-          # - make a nicer template.  
-          # - show stderr
-          f.write('ERROR: %s exited with code %d' % (argv, exit_code))
-        counter += 1
-        continue
+# A message rather than a filename, in the same format as the header we print,
+# e.g. 27:{"follow": "/tmp/build.log"}
+MESSAGE_RE = re.compile(r'\d+:\{')
 
-      # BUG: These aren't send in error case!   Fix that.
+# An explicit file type names a plugin, like csv or tar.gz.
+TYPE_RE = re.compile(r'[a-zA-Z0-9_\-][a-zA-Z0-9_.\-]*$')
 
-      # Record how long rendering plugin takes.
-      d = {'pluginPath': plugin_bin, 'exitCode': exit_code, 'elapsed': elapsed}
-      if subprocess_exc:
-        d['subprocessExc'] = str(subprocess_exc)
-      spy_client.SendRecord('xrender-plugin', d)
+# option name -> type of its value
+MESSAGE_OPTIONS = {'follow': bool}
 
-      # Check that the plugin actually create the file.
-      if not os.path.exists(out_html_path):
-        log('Plugin error: %r not created', out_html_path)
-        with open(out_html_path, 'w') as f:
-          f.write('Plugin error: %r not created' % out_html_path)
 
-        # TODO: Remove this counter duplication.  Failing here would make it
-        # hard to develop plugins.
-        counter += 1
-        continue
+def ParseMessage(message):
+  """Check a message that says what to render.
 
-    else:
-      log('No renderer for %r and no DEFAULT; ignored', filename)
-      continue
+  It's a dict like
 
-    counter += 1
+    {"path": "/tmp/foo.log", "type": "txt", "options": {"follow": true}}
+
+  where type and options are optional.  {"follow": path} is short for
+  following path.
+
+  Returns:
+    The path, the file type or None, and a dict of options.
+
+  Raises:
+    Error if the message is invalid.
+  """
+  if not isinstance(message, dict):
+    raise Error('Expected a dict, got %r' % (message,))
+  if 'follow' in message:
+    message = {'path': message['follow'], 'options': {'follow': True}}
+
+  path = message.get('path')
+  if not isinstance(path, basestring) or not path:
+    raise Error('Expected a path')
+
+  file_type = message.get('type')
+  if file_type is not None:
+    if not isinstance(file_type, basestring) or not TYPE_RE.match(file_type):
+      raise Error('Invalid type %r' % (file_type,))
+
+  options = message.get('options') or {}
+  if not isinstance(options, dict):
+    raise Error('Expected options to be a dict')
+  for name, value in options.iteritems():
+    if name not in MESSAGE_OPTIONS:
+      raise Error('Unknown option %r' % (name,))
+    if not isinstance(value, MESSAGE_OPTIONS[name]):
+      raise Error('Invalid value for option %r: %r' % (name, value))
+
+  return path, file_type, options
 
 
 def Lines(f, target):
@@ -310,57 +1758,310 @@ def Lines(f, target):
       break
 
 
-# Max 1 megabyte.  We close it anyway.
-BUF_SIZE = 1 << 20
+DEFAULT_RENDER_CACHE_MB = 256
+
+def GetRenderCacheDir():
+  return os.path.join(util.GetUserDir(), 'render-cache')
+
+
+BUF_SIZE = 64 << 10
+
+# Clients served at once.  More wait in the listen backlog.
+MAX_INGEST_CLIENTS = 16
+INGEST_BACKLOG = 64
+
+# A message is a path, a type, and a few options.
+MAX_MESSAGE_BYTES = 64 << 10
+
+# A client that sends lines rather than messages is done when it's sent a
+# whole line and nothing else for this long.
+LINES_IDLE_SECS = 0.1
+
+# A client that sends nothing for this long is dropped, so stalled clients
+# can't hold all MAX_INGEST_CLIENTS slots.
+INGEST_IDLE_SECS = 30
+
+# The length prefix of a tnet value
+FRAME_RE = re.compile(r'(\d{1,10}):')
+
+
+def _IsFramed(buf):
+  """Does buf start with a tnet value?  None if it's too early to tell."""
+  m = re.match(r'\d*', buf)
+  n = m.end()
+  if n == len(buf):
+    return None if n <= 10 else False
+  return 0 < n <= 10 and buf[n] == ':'
 
-# TODO: Should this be moved to "util" so other stages can use it?
-def TcpServer(port, target):
+
+def _SplitFrames(buf):
+  """Split the complete tnet values off the front of buf.
+
+  Returns:
+    A list of their encodings, and the rest of buf.
+
+  Raises:
+    Error if buf doesn't start with a tnet value.
   """
-  Listen on a port, and read (small) values send from different clients, and
-  deliver them to the given coroutine.
+  frames = []
+  pos = 0
+  while pos < len(buf):
+    m = FRAME_RE.match(buf, pos)
+    if not m:
+      if _IsFramed(buf[pos:]) is None:
+        break  # the length is still coming
+      raise Error('Expected a tnet value at byte %d' % pos)
+    n = int(m.group(1))
+    if n > MAX_MESSAGE_BYTES:
+      raise Error('Message of %d bytes is too big' % n)
+    end = m.end() + n + 1  # the payload and its type
+    if end > len(buf):
+      break
+    frames.append(buf[pos:end])
+    pos = end
+  return frames, buf[pos:]
+
+
+class IngestServer(object):
+  """Receives files to render from many clients at once.
 
   This basically replaces "nc -k -l 8000 </dev/null", which is not portable
   across machines (especially OS X).
+
+  Each connection is served on its own thread.  The client sends tnet dicts
+  (see ParseMessage), and gets a tnet string back for each one, in order:
+  "ok" once it's been handed to the target, or "error: <reason>", e.g. if the
+  file doesn't exist.  Handing it over blocks while the render queue is full
+  (see RenderPool), so a client that waits for its acks is slowed down rather
+  than dropped.  Messages that arrive together are handed over together, and
+  acked in one write.  The empty string (0:,) ends the connection.  (See
+  send-files in wp.sh.)
+
+  A client can also send lines, like "echo /tmp/foo.txt | nc localhost 8988".
+  Each line is a filename, and there are no acks.
   """
-  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  # When we die, let other processes use port immediately.
-  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-  sock.bind(('', port))
-  sock.listen(1)  # backlog of 1; meant to be used on localhost
-  log('Listening on port %d', port)
 
-  target.next()  # "prime" coroutine
+  def __init__(self, port, target, in_dir=None,
+               max_clients=MAX_INGEST_CLIENTS):
+    """
+    Args:
+      port: port to listen on, or 0 for any free one (see self.port)
+      target: coroutine to send messages and filenames to
+      in_dir: directory that relative paths are in.  If given, a message for
+        a file that doesn't exist gets an error rather than "ok".
+    """
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # When we die, let other processes use port immediately.
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind(('', port))
+    self.sock.listen(INGEST_BACKLOG)
+    self.port = self.sock.getsockname()[1]
+
+    self.target = target
+    self.in_dir = in_dir
+    self.lock = threading.Lock()  # the target takes one item at a time
+    self.slots = threading.Semaphore(max_clients)
+    self.stopped = False
+
+  def Serve(self):
+    """Accept connections until the target stops, or Close() is called."""
+    log('Listening on port %d', self.port)
+    with self.lock:
+      self.target.next()  # "prime" coroutine
+
+    while not self.stopped:
+      self.slots.acquire()
+      try:
+        client, addr = self.sock.accept()
+      except socket.error, e:
+        self.slots.release()
+        if self.stopped:
+          break
+        log('accept: %s', e)
+        continue
+      t = threading.Thread(target=self._Serve, args=(client, addr))
+      t.setDaemon(True)
+      t.start()
 
-  while True:
-    client, addr = sock.accept()
-    log('Connection from %s', addr)
+  def Close(self):
+    self.stopped = True
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)  # wakes up accept()
+    except socket.error:
+      pass
+    self.sock.close()
 
-    # The payload is a line right now.  Should we loop until we actually get a
-    # newline?  Could test a trickle.
-    line = client.recv(BUF_SIZE)
-    client.close()
-    if not line:
-      break
+  def _Serve(self, client, addr):
+    log('Connection from %s', addr)
+    try:
+      self._Handle(client)
+    except (socket.error, Error), e:
+      log('Connection from %s: %s', addr, e)
+    finally:
+      client.close()
+      self.slots.release()
+
+  def _Handle(self, client):
+    buf = ''
+    framed = None
+    client.settimeout(INGEST_IDLE_SECS)
+    while True:
+      try:
+        chunk = client.recv(BUF_SIZE)
+      except socket.timeout:
+        if framed is not False:
+          raise Error('Nothing received for %d seconds' % INGEST_IDLE_SECS)
+        chunk = ''  # a line client that's done
+      if not chunk:
+        if framed is False and buf.strip():
+          self._SendLines(buf)
+        return
+      buf += chunk
+
+      if framed is None:
+        framed = _IsFramed(buf)
+        if framed is None:
+          continue
+      if not framed:
+        if buf.endswith('\n'):
+          # The client may not close its end, so stop if nothing follows.
+          client.settimeout(LINES_IDLE_SECS)
+        if len(buf) > MAX_MESSAGE_BYTES:
+          raise Error('Line too long')
+        continue
 
-    filename = line.strip()
+      frames, buf = _SplitFrames(buf)
+      acks, end = self._Submit(frames)
+      if acks:
+        client.sendall(''.join(acks))
+      if end:
+        return
+
+  def _Send(self, item):
+    """Hand an item to the target.  Call with the lock held."""
+    if self.stopped:
+      raise Error('Server stopped')
     try:
-      target.send(filename)
+      self.target.send(item)
     except StopIteration:
-      break
+      self.Close()
+      raise Error('Server stopped')
+
+  def _SendLines(self, buf):
+    with self.lock:
+      for line in buf.splitlines():
+        filename = line.strip()
+        if filename:
+          self._Send(filename)
+
+  def _CheckPath(self, path):
+    """Raise Error unless path is a file the target can render."""
+    if self.in_dir is None:
+      return
+    if not os.path.isfile(os.path.join(self.in_dir, path)):
+      raise Error('No such file: %s' % path)
+
+  def _Submit(self, frames):
+    """Hand a batch of messages to the target.
+
+    Returns:
+      A list of acks, and whether the client is done.
+    """
+    items = []  # (message, error)
+    end = False
+    for frame in frames:
+      try:
+        value = tnet.load(cStringIO.StringIO(frame))
+      except (ValueError, EOFError), e:
+        items.append((None, 'invalid tnet: %s' % e))
+        continue
+      if value == '':
+        end = True
+        break
+      try:
+        path, _, _ = ParseMessage(value)
+        self._CheckPath(path)
+      except Error, e:
+        items.append((None, str(e)))
+        continue
+      items.append((value, None))
+
+    acks = []
+    with self.lock:
+      for message, error in items:
+        if error:
+          log('Invalid message: %s', error)
+          acks.append(TnetString('error: %s' % error))
+          continue
+        self._Send(message)
+        acks.append(TnetString('ok'))
+    return acks, end
 
 
 def main(argv):
   """Returns an exit code."""
   port = None
+  num_jobs = 1
+  limits = {}
+  cache_mb = DEFAULT_RENDER_CACHE_MB
+  in_process = True
+  max_coprocesses = DEFAULT_MAX_COPROCESSES
+  placeholder_secs = DEFAULT_PLACEHOLDER_SECS
+  timeout_specs = []
+  max_followed = DEFAULT_MAX_FOLLOWED
 
   # Just use simple getopt for now.  This isn't exposed to the UI really.
-  opts, argv = getopt.getopt(argv, 'p:')
+  #
+  # -j 4: render up to 4 files at once
+  # -l dot=1: but only 1 with the dot plugin
+  # -c 0: disable the render cache
+  # -e: always exec plugins, even ones with a render.py
+  # -k 0: don't keep persistent plugins running
+  # -w 2: publish a placeholder for parts that take longer than 2 seconds
+  # -t 30 -t dot=120: kill renders after 30 seconds, or 120 for dot
+  # -f 0: don't follow files; render them once
+  opts, argv = getopt.getopt(argv, 'p:j:l:c:ek:w:t:f:')
   for name, value in opts:
     if name == '-p':
       try:
         port = int(value)
       except ValueError:
         raise Error('Invalid port %r' % value)
+    elif name == '-j':
+      try:
+        num_jobs = int(value)
+      except ValueError:
+        raise Error('Invalid number of jobs %r' % value)
+    elif name == '-l':
+      plugin, _, limit = value.partition('=')
+      try:
+        limits[plugin] = int(limit)
+      except ValueError:
+        raise Error('Invalid limit %r (expected e.g. dot=1)' % value)
+    elif name == '-c':
+      try:
+        cache_mb = int(value)
+      except ValueError:
+        raise Error('Invalid cache size %r' % value)
+    elif name == '-e':
+      in_process = False
+    elif name == '-k':
+      try:
+        max_coprocesses = int(value)
+      except ValueError:
+        raise Error('Invalid number of coprocesses %r' % value)
+    elif name == '-w':
+      try:
+        placeholder_secs = float(value) or None
+      except ValueError:
+        raise Error('Invalid placeholder delay %r' % value)
+    elif name == '-t':
+      timeout_specs.append(value)
+    elif name == '-f':
+      try:
+        max_followed = int(value)
+      except ValueError:
+        raise Error('Invalid number of followed files %r' % value)
     else:
       raise AssertionError
 
@@ -369,17 +2070,42 @@ def main(argv):
   in_dir = argv[0]
   out_dir = argv[1]
 
-  # PluginDispatchLoop is a coroutine.  It takes items to render on stdin.
-  loop = PluginDispatchLoop(in_dir, out_dir)
+  timeout_secs, timeouts = ParseTimeouts(timeout_specs)
+  budget = TimeBudget(placeholder_secs=placeholder_secs,
+                      timeout_secs=timeout_secs, timeouts=timeouts)
 
-  # TODO:
-  # create a tcp server.  reads one connection at a timv 
+  # Even with one job, render on a pool, so later files can get past a slow
+  # one with a placeholder.
+  pool = RenderPool(num_jobs, limits=limits)
+
+  render_cache = None
+  if cache_mb > 0:
+    render_cache = rendercache.RenderCache(GetRenderCacheDir(), cache_mb << 20)
+
+  coprocesses = None
+  if max_coprocesses > 0:
+    coprocesses = Coprocesses(max_live=max_coprocesses)
+
+  followers = None
+  if max_followed > 0:
+    followers = Followers(max_followed=max_followed)
+
+  # PluginDispatchLoop is a coroutine.  It takes items to render on stdin.
+  loop = PluginDispatchLoop(in_dir, out_dir, pool=pool,
+                            render_cache=render_cache, in_process=in_process,
+                            coprocesses=coprocesses, budget=budget,
+                            followers=followers)
 
   if port:
-    TcpServer(port, loop)
+    IngestServer(port, loop, in_dir=in_dir).Serve()
   else:
     Lines(sys.stdin, loop)
 
+  pool.Wait()  # finish what we were given
+  if coprocesses:
+    coprocesses.Close()
+  if followers:
+    followers.Close()
   return 0
 
 
@@ -8,9 +8,19 @@
 xrender_test.py: Tests for xrender.py
 """
 
+import collections
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+import rendercache
 import xrender  # module under test
+from common import spy
 
 CSV = """\
 name,age
@@ -30,6 +40,12 @@ class FunctionsTest(unittest.TestCase):
     self.assertEqual('typescript', xrender.GetFileType('typescript'))
     self.assertEqual('typescript', xrender.GetFileType('/tmp/typescript'))
 
+  def testSizeTier(self):
+    self.assertEqual(('small', 10), xrender.SizeTier(10))
+    self.assertEqual(('large', xrender.SMALL_MAX_BYTES),
+                     xrender.SizeTier(xrender.SMALL_MAX_BYTES + 1))
+    self.assertEqual(('huge', 0), xrender.SizeTier(5 << 30))
+
   def testCleanFilename(self):
     print xrender.CleanFilename('foo-bar_baz')
     print xrender.CleanFilename('foo bar')
@@ -49,21 +65,931 @@ class ResourcesTest(unittest.TestCase):
     print p
 
 
-def Echo():
+class PluginDispatchLoopTest(unittest.TestCase):
+
+  def setUp(self):
+    self.in_dir = tempfile.mkdtemp()
+    self.out_dir = tempfile.mkdtemp()
+    with open(os.path.join(self.in_dir, 'foo.txt'), 'w') as f:
+      f.write('hello\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.in_dir)
+    shutil.rmtree(self.out_dir)
+
+  def testAnnounce(self):
+    parts = []
+    loop = xrender.PluginDispatchLoop(self.in_dir, self.out_dir,
+                                      announce=parts.append)
+    loop.next()  # prime
+    loop.send('foo.txt')
+    loop.send('foo.txt')
+
+    self.assertEqual([1, 2], [p['num'] for p in parts])
+    info = parts[0]
+    self.assertEqual('txt', info['fileType'])
+    self.assertEqual(
+        os.path.getsize(os.path.join(self.out_dir, '1.html')), info['size'])
+    self.assertTrue(info['elapsed'] >= 0)
+    self.assertTrue(info['rendered'] > 0)
+
+  def testLargeInputIsPreviewed(self):
+    with open(os.path.join(self.in_dir, 'foo.html'), 'w') as f:
+      f.write('hello\n')
+    parts = []
+    loop = xrender.PluginDispatchLoop(self.in_dir, self.out_dir,
+                                      announce=parts.append)
+    loop.next()  # prime
+    old = xrender.SMALL_MAX_BYTES
+    xrender.SMALL_MAX_BYTES = 4
+    try:
+      loop.send('foo.html')
+    finally:
+      xrender.SMALL_MAX_BYTES = old
+
+    self.assertEqual('large', parts[0]['sizeTier'])
+    with open(os.path.join(self.out_dir, '1.html')) as f:
+      html = f.read()
+    self.assertTrue('first 4 of 6 bytes' in html, html)
+    self.assertTrue('hell\n' not in html and 'hell' in html, html)
+
+  def testPoolAnnouncesInOrder(self):
+    parts = []
+    pool = xrender.RenderPool(4)
+    loop = xrender.PluginDispatchLoop(self.in_dir, self.out_dir,
+                                      announce=parts.append, pool=pool)
+    loop.next()  # prime
+    for i in xrange(8):
+      loop.send('foo.txt')
+    pool.Wait()
+
+    self.assertEqual(range(1, 9), [p['num'] for p in parts])
+    for i in xrange(1, 9):
+      self.assertTrue(os.path.exists(os.path.join(self.out_dir, '%d.html' % i)))
+
+  def testRenderErrorIsAnnounced(self):
+    parts = []
+    pool = xrender.RenderPool(2)
+    loop = xrender.PluginDispatchLoop(self.in_dir, self.out_dir,
+                                      announce=parts.append, pool=pool)
+    loop.next()  # prime
+
+    old = xrender._RenderPart
+    def _RenderPart(plugin_bin, input_path, file_type, num, *args, **kwargs):
+      if num == 1:
+        raise OSError('No space left on device')
+      return old(plugin_bin, input_path, file_type, num, *args, **kwargs)
+    xrender._RenderPart = _RenderPart
+    try:
+      loop.send('foo.txt')
+      loop.send('foo.txt')
+      pool.Wait()
+    finally:
+      xrender._RenderPart = old
+
+    # The failure doesn't hold up later parts.
+    self.assertEqual([1, 2], [p['num'] for p in parts])
+    self.assertTrue('No space left' in parts[0]['error'])
+    with open(os.path.join(self.out_dir, '1.html')) as f:
+      self.assertTrue('No space left' in f.read())
+
+  def testRenderCache(self):
+    parts = []
+    cache_dir = os.path.join(self.in_dir, 'cache')
+    render_cache = rendercache.RenderCache(cache_dir, 1 << 20)
+    loop = xrender.PluginDispatchLoop(self.in_dir, self.out_dir,
+                                      announce=parts.append,
+                                      render_cache=render_cache)
+    loop.next()  # prime
+    loop.send('foo.txt')
+    loop.send('foo.txt')
+
+    self.assertEqual(None, parts[0].get('cacheHit'))
+    self.assertEqual(True, parts[1]['cacheHit'])
+    with open(os.path.join(self.out_dir, '1.html')) as f:
+      first = f.read()
+    with open(os.path.join(self.out_dir, '2.html')) as f:
+      self.assertEqual(first, f.read())
+    self.assertEqual(1, render_cache.Stats()['hits'])
+
+  def testRenderCacheSkipsLargeInputs(self):
+    parts = []
+    render_cache = rendercache.RenderCache(
+        os.path.join(self.in_dir, 'cache'), 1 << 20)
+    loop = xrender.PluginDispatchLoop(self.in_dir, self.out_dir,
+                                      announce=parts.append,
+                                      render_cache=render_cache)
+    loop.next()  # prime
+    old = xrender.SMALL_MAX_BYTES
+    xrender.SMALL_MAX_BYTES = 4
+    try:
+      loop.send('foo.txt')
+      loop.send('foo.txt')
+    finally:
+      xrender.SMALL_MAX_BYTES = old
+
+    self.assertEqual('large', parts[1]['sizeTier'])
+    self.assertEqual(None, parts[1].get('cacheHit'))
+    stats = render_cache.Stats()
+    self.assertEqual((0, 0), (stats['hits'], stats['misses']))
+
+  def testCsvInProcess(self):
+    with open(os.path.join(self.in_dir, 'foo.csv'), 'w') as f:
+      f.write(CSV)
+    parts = []
+    loop = xrender.PluginDispatchLoop(self.in_dir, self.out_dir,
+                                      announce=parts.append)
+    loop.next()  # prime
+    loop.send('foo.csv')
+
+    info = parts[0]
+    self.assertEqual(True, info['inProcess'])
+    self.assertEqual(None, info.get('error'))
+    with open(os.path.join(self.out_dir, '1.html')) as f:
+      self.assertTrue('&lt;carol&gt;' in f.read())
+    self.assertTrue(os.path.exists(os.path.join(self.out_dir, '1/foo.csv')))
+
+    # The full table is rendered when it's first requested.
+    full_html = os.path.join(self.out_dir, '1/full.html')
+    self.assertFalse(os.path.exists(full_html))
+    deferred = xrender.DeferredRenders()
+    self.assertEqual(None, deferred.Render(full_html))
+    with open(full_html) as f:
+      self.assertTrue('dataTable' in f.read())
+    self.assertEqual(1, deferred.Stats()['renders'])
+
+    # Not rendered again, and undeclared files aren't rendered at all.
+    self.assertEqual(None, deferred.Render(full_html))
+    self.assertEqual(None, deferred.Render(
+        os.path.join(self.out_dir, '1/other.html')))
+    self.assertEqual(1, deferred.Stats()['renders'])
+
+
+  def testCsvLargeIsLinked(self):
+    path = os.path.join(self.in_dir, 'big.csv')
+    with open(path, 'w') as f:
+      f.write('n\n')
+      for i in xrange(1000):
+        f.write('<%d>\n' % i)
+    parts = []
+    loop = xrender.PluginDispatchLoop(self.in_dir, self.out_dir,
+                                      announce=parts.append)
+    loop.next()  # prime
+    old = xrender.SMALL_MAX_BYTES
+    xrender.SMALL_MAX_BYTES = 100
+    try:
+      loop.send('big.csv')
+    finally:
+      xrender.SMALL_MAX_BYTES = old
+
+    self.assertEqual(True, parts[0]['inProcess'])
+    with open(os.path.join(self.out_dir, '1.html')) as f:
+      html = f.read()
+    self.assertTrue('&lt;999&gt;' in html and '990 rows omitted' in html, html)
+    self.assertTrue('full.html' not in html, html)
+    # Not copied, and there's no full table to render.
+    self.assertEqual(path, os.readlink(os.path.join(self.out_dir, '1/big.csv')))
+    self.assertEqual(['big.csv'], os.listdir(os.path.join(self.out_dir, '1')))
+
+  def testTxtPaged(self):
+    with open(os.path.join(self.in_dir, 'big.txt'), 'w') as f:
+      for i in xrange(200000):
+        f.write('<line %d>\n' % i)
+    parts = []
+    loop = xrender.PluginDispatchLoop(self.in_dir, self.out_dir,
+                                      announce=parts.append)
+    loop.next()  # prime
+    loop.send('big.txt')
+
+    info = parts[0]
+    self.assertEqual(True, info['inProcess'])
+    self.assertTrue(info['size'] < 20000, info['size'])  # just the windows
+    with open(os.path.join(self.out_dir, '1.html')) as f:
+      html = f.read()
+    self.assertTrue('&lt;line 0&gt;' in html)
+    self.assertTrue('&lt;line 199999&gt;' in html)
+    self.assertTrue('&lt;line 100000&gt;' not in html)
+    self.assertTrue('"1/lines?start=200"' in html)
+    self.assertEqual(
+        os.path.join(self.in_dir, 'big.txt'),
+        os.readlink(os.path.join(self.out_dir, '1', 'input')))
+
+
+# A plugin that renders its deferred file slowly, and counts how many times.
+DEFERRED_PLUGIN = """\
+#!/bin/sh
+test "$1" = --deferred || exit 1
+echo x >> count
+sleep 0.2
+test -s "$3" || exit 1
+cp "$3" "$4"
+"""
+
+
+class _FakeResources(object):
+
+  def __init__(self, plugin_bin):
+    self.plugin_bin = plugin_bin
+
+  def GetPluginBin(self, file_type):
+    return self.plugin_bin
+
+
+class DeferredRendersTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    plugin_bin = os.path.join(self.tmp, 'render')
+    with open(plugin_bin, 'w') as f:
+      f.write(DEFERRED_PLUGIN)
+    os.chmod(plugin_bin, 0755)
+    self.deferred = xrender.DeferredRenders(res=_FakeResources(plugin_bin))
+
+    self.part_dir = os.path.join(self.tmp, '1')
+    os.mkdir(self.part_dir)
+    with open(os.path.join(self.part_dir, xrender.DEFERRED_NAME), 'w') as f:
+      f.write('{"fileType": "x", "input": "in.txt", "files": ["full.html"]}')
+    self.path = os.path.join(self.part_dir, 'full.html')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _WriteInput(self, text):
+    with open(os.path.join(self.part_dir, 'in.txt'), 'w') as f:
+      f.write(text)
+
+  def testConcurrentRequestsRenderOnce(self):
+    self._WriteInput('full\n')
+    errors = []
+    threads = [
+        threading.Thread(target=lambda: errors.append(
+            self.deferred.Render(self.path)))
+        for _ in xrange(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join(5)
+
+    self.assertEqual([None] * 4, errors)
+    with open(self.path) as f:
+      self.assertEqual('full\n', f.read())
+    with open(os.path.join(self.part_dir, 'count')) as f:
+      self.assertEqual(1, len(f.readlines()))
+    stats = self.deferred.Stats()
+    self.assertEqual(1, stats['renders'])
+    self.assertEqual(0, stats['rendering'])
+
+  def testFailure(self):
+    self._WriteInput('')  # the plugin fails on empty input
+    error = self.deferred.Render(self.path)
+    self.assertTrue('exited with code 1' in error, error)
+    self.assertFalse(os.path.exists(self.path))
+    self.assertEqual(['count', 'deferred.json', 'in.txt'],
+                     sorted(os.listdir(self.part_dir)))  # no temp file
+    self.assertRaises(xrender.Error, self.deferred.RenderAll, self.part_dir)
+
+    self._WriteInput('ok\n')
+    self.deferred.RenderAll(self.part_dir)
+    self.assertTrue(os.path.exists(self.path))
+
+
+class PythonPluginTierTest(unittest.TestCase):
+
+  def setUp(self):
+    self.in_dir = tempfile.mkdtemp()
+    self.out_dir = tempfile.mkdtemp()
+    with open(os.path.join(self.in_dir, 'foo.txt'), 'w') as f:
+      f.write('hello\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.in_dir)
+    shutil.rmtree(self.out_dir)
+
+  def testTxtUsesTier(self):
+    parts = []
+    loop = xrender.PluginDispatchLoop(self.in_dir, self.out_dir,
+                                      announce=parts.append)
+    loop.next()  # prime
+    loop.send('foo.txt')
+    old = xrender.SMALL_MAX_BYTES
+    xrender.SMALL_MAX_BYTES = 4
+    try:
+      loop.send('foo.txt')
+    finally:
+      xrender.SMALL_MAX_BYTES = old
+
+    self.assertEqual([True, True], [p['inProcess'] for p in parts])
+    # Shown in full, then paged, by the threshold in xrender
+    self.assertFalse(os.path.exists(os.path.join(self.out_dir, '1')))
+    self.assertTrue(os.path.islink(os.path.join(self.out_dir, '2', 'input')))
+
+
+class PythonPluginsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.plugin_dir = tempfile.mkdtemp()
+    self.plugin_bin = os.path.join(self.plugin_dir, 'render')
+
+  def tearDown(self):
+    shutil.rmtree(self.plugin_dir)
+
+  def testGet(self):
+    p = xrender.PythonPlugins()
+    self.assertEqual(None, p.Get(self.plugin_bin))  # no render.py
+
+    with open(self.plugin_bin + '.py', 'w') as f:
+      f.write('def Render(input_path, output, out_dir, tier=None):\n  return [1]\n')
+    render = p.Get(self.plugin_bin)
+    self.assertEqual([1], render('in', '1', '.'))
+    self.assertTrue(render is p.Get(self.plugin_bin))  # loaded once
+
+    # Reloaded when it changes
+    with open(self.plugin_bin + '.py', 'w') as f:
+      f.write('def Render(input_path, output, out_dir, tier=None):\n  return [2]\n')
+    os.utime(self.plugin_bin + '.py', (0, 12345))
+    self.assertEqual([2], p.Get(self.plugin_bin)('in', '1', '.'))
+
+  def testImportError(self):
+    with open(self.plugin_bin + '.py', 'w') as f:
+      f.write('import nonexistent_module\n')
+    self.assertEqual(None, xrender.PythonPlugins().Get(self.plugin_bin))
+
+
+# A persistent plugin.  It puts its PID in the output, exits on files named
+# 'crash', and reports an error for files named 'bad'.
+COPROCESS = """\
+#!%s -S
+import os
+import sys
+
+import tnet
+
+def Str(s):
+  return '%%d:%%s,' %% (len(s), s)
+
+def Reply(key, value):
+  payload = Str(key) + value
+  sys.stdout.write('%%d:%%s}' %% (len(payload), payload))
+  sys.stdout.flush()
+
+while True:
+  try:
+    req = tnet.load(sys.stdin)
+  except EOFError:
+    break
+  name = os.path.basename(req['input'])
+  if name == 'crash':
+    sys.exit(1)
+  if name == 'bad':
+    Reply('error', Str('bad input'))
+    continue
+  html = req['output'] + '.html'
+  with open(os.path.join(req['outDir'], html), 'w') as f:
+    f.write(str(os.getpid()))
+  files = Str(html)
+  Reply('files', '%%d:%%s]' %% (len(files), files))
+""" % sys.executable
+
+
+class CoprocessesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.out_dir = os.path.join(self.tmp, 'out')
+    os.mkdir(self.out_dir)
+    self.plugin_bins = []
+    for name in ('a', 'b'):
+      plugin_dir = os.path.join(self.tmp, name)
+      os.mkdir(plugin_dir)
+      coproc_bin = os.path.join(plugin_dir, 'coprocess')
+      with open(coproc_bin, 'w') as f:
+        f.write(COPROCESS)
+      os.chmod(coproc_bin, 0755)
+      self.plugin_bins.append(os.path.join(plugin_dir, 'render'))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _Render(self, c, plugin_bin, input_name, num):
+    coproc_bin = c.GetBin(plugin_bin)
+    reply = c.Render(coproc_bin, os.path.join(self.tmp, input_name), str(num),
+                     self.out_dir)
+    return reply
+
+  def _Pid(self, num):
+    with open(os.path.join(self.out_dir, '%d.html' % num)) as f:
+      return f.read()
+
+  def testReusesProcess(self):
+    c = xrender.Coprocesses()
+    self.assertEqual(None, c.GetBin(os.path.join(self.tmp, 'render')))
+
+    self.assertEqual({'files': ['1.html']},
+                     self._Render(c, self.plugin_bins[0], 'x', 1))
+    self._Render(c, self.plugin_bins[0], 'x', 2)
+    self.assertEqual(self._Pid(1), self._Pid(2))
+    self.assertEqual({'error': 'bad input'},
+                     self._Render(c, self.plugin_bins[0], 'bad', 3))
+
+    stats = c.Stats()
+    self.assertEqual(1, stats['starts'])
+    self.assertEqual(1, stats['idle'])
+    c.Close()
+    self.assertEqual(0, c.Stats()['live'])
+
+  def testRestartOnCrash(self):
+    c = xrender.Coprocesses()
+    self._Render(c, self.plugin_bins[0], 'x', 1)
+    self.assertRaises(xrender.Error, self._Render, c, self.plugin_bins[0],
+                      'crash', 2)
+    self._Render(c, self.plugin_bins[0], 'x', 3)
+    self.assertNotEqual(self._Pid(1), self._Pid(3))
+
+    stats = c.Stats()
+    self.assertEqual(2, stats['crashes'])
+    self.assertEqual(1, stats['live'])
+    c.Close()
+
+  def testCapAndIdleShutdown(self):
+    c = xrender.Coprocesses(max_live=1, idle_secs=0.2)
+    self._Render(c, self.plugin_bins[0], 'x', 1)
+    self._Render(c, self.plugin_bins[1], 'x', 2)  # stops the first one
+    self.assertEqual(2, c.Stats()['starts'])
+    self.assertEqual(1, c.Stats()['live'])
+
+    time.sleep(0.5)
+    stats = c.Stats()
+    self.assertEqual(0, stats['live'])
+    self.assertEqual(1, stats['idleStops'])
+
+  def testRenderPart(self):
+    c = xrender.Coprocesses()
+    info, stdout = xrender._RenderPart(
+        self.plugin_bins[0], os.path.join(self.tmp, 'x'), 'x', 1, self.out_dir,
+        spy.NullUsageReporter(), coprocesses=c)
+    self.assertEqual(True, info['coprocess'])
+    self.assertEqual('1.html\n', stdout)
+    c.Close()
+
+
+class TimeBudgetTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.out_dir = os.path.join(self.tmp, 'out')
+    os.mkdir(self.out_dir)
+    self.input_path = os.path.join(self.tmp, 'in.txt')
+    with open(self.input_path, 'w') as f:
+      f.write('hi\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _Plugin(self, secs):
+    plugin_dir = os.path.join(self.tmp, 'slow')
+    os.mkdir(plugin_dir)
+    plugin_bin = os.path.join(plugin_dir, 'render')
+    with open(plugin_bin, 'w') as f:
+      # Appends, like plugins/R does
+      f.write('#!/bin/sh\nsleep %s\necho real >>$2.html\necho $2.html\n'
+              % secs)
+    os.chmod(plugin_bin, 0755)
+    return plugin_bin
+
+  def _Read(self, num):
+    with open(os.path.join(self.out_dir, '%d.html' % num)) as f:
+      return f.read()
+
+  def testPlaceholder(self):
+    placeholders = []
+    def OnPlaceholder(info, stdout):
+      placeholders.append((info, stdout, self._Read(1)))
+
+    budget = xrender.TimeBudget(placeholder_secs=0.1)
+    info, stdout = xrender._RenderPart(
+        self._Plugin(0.5), self.input_path, 'txt', 1, self.out_dir,
+        spy.NullUsageReporter(), budget=budget, on_placeholder=OnPlaceholder)
+
+    self.assertEqual(1, len(placeholders))
+    p_info, p_stdout, p_html = placeholders[0]
+    self.assertEqual(True, p_info['placeholder'])
+    self.assertEqual('1.html\n', p_stdout)
+    self.assertTrue(p_html.startswith(xrender.PLACEHOLDER_PREFIX))
+
+    self.assertEqual(True, info['upgrade'])
+    self.assertEqual('1.html\n', stdout)
+    self.assertEqual('real\n', self._Read(1))
+    self.assertEqual(['1.html'], os.listdir(self.out_dir))  # no staging dir
+
+  def testPlaceholderFreesPluginSlot(self):
+    plugin_bin = self._Plugin(0)
+    with open(plugin_bin, 'w') as f:
+      f.write('#!/bin/sh\nif grep -q slow $1; then sleep 1.5; fi\n'
+              'echo real >>$2.html\necho $2.html\n')
+    for name in ('slow.txt', 'fast.txt'):
+      with open(os.path.join(self.tmp, name), 'w') as f:
+        f.write(name + '\n')
+
+    parts = []
+    def Announce(info):
+      parts.append((info['num'], bool(info.get('placeholder')), time.time()))
+
+    pool = xrender.RenderPool(1)  # the slow plugin can use one thread
+    budget = xrender.TimeBudget(placeholder_secs=0.2)
+    loop = xrender.PluginDispatchLoop(self.tmp, self.out_dir,
+                                      announce=Announce, pool=pool,
+                                      in_process=False, budget=budget)
+    old = xrender.Resources
+    xrender.Resources = lambda: _FakeResources(plugin_bin)
+    try:
+      loop.next()  # prime
+    finally:
+      xrender.Resources = old
+    start = time.time()
+    loop.send('slow.txt')
+    loop.send('fast.txt')
+    pool.Wait()
+
+    self.assertEqual([(1, True), (2, False), (1, False)],
+                     [(num, p) for num, p, _ in parts])
+    # Part 2 didn't wait for part 1 to finish.
+    self.assertTrue(parts[1][2] - start < 1.0, parts)
+    self.assertEqual(0, pool.running['slow'])
+
+  def testFastRenderHasNoPlaceholder(self):
+    placeholders = []
+    budget = xrender.TimeBudget(placeholder_secs=1.0)
+    info, _ = xrender._RenderPart(
+        self._Plugin(0), self.input_path, 'txt', 1, self.out_dir,
+        spy.NullUsageReporter(), budget=budget,
+        on_placeholder=lambda *args: placeholders.append(args))
+    self.assertEqual([], placeholders)
+    self.assertEqual(None, info.get('upgrade'))
+    self.assertEqual('real\n', self._Read(1))
+
+  def testTimeout(self):
+    budget = xrender.TimeBudget(placeholder_secs=None, timeout_secs=10,
+                                timeouts={'slow': 0.2})
+    start = time.time()
+    info, stdout = xrender._RenderPart(
+        self._Plugin(10), self.input_path, 'txt', 1, self.out_dir,
+        spy.NullUsageReporter(), budget=budget)
+    self.assertTrue(time.time() - start < 5)  # the sleep was killed too
+    self.assertEqual('timeout', info['error'])
+    self.assertTrue('timed out' in self._Read(1))
+    self.assertEqual(['1.html'], os.listdir(self.out_dir))
+
+  def testStreaming(self):
+    plugin_bin = self._Plugin(0)
+    started = []
+    budget = xrender.TimeBudget(placeholder_secs=None)
+    xrender._RenderPart(plugin_bin, self.input_path, 'txt', 1, self.out_dir,
+                        spy.NullUsageReporter(), budget=budget,
+                        on_start=started.append)
+    self.assertEqual([], started)  # the plugin doesn't say it streams
+
+    open(os.path.join(os.path.dirname(plugin_bin), 'streaming'), 'w').close()
+    xrender._RenderPart(plugin_bin, self.input_path, 'txt', 2, self.out_dir,
+                        spy.NullUsageReporter(), budget=budget,
+                        on_start=started.append)
+    # It writes in the staging dir.
+    self.assertEqual(['.rendering-2/2.html'], started)
+    self.assertEqual('real\n', self._Read(2))
+
+  def testParseTimeouts(self):
+    self.assertEqual((30.0, {'dot': 120.0, 'R': None}),
+                     xrender.ParseTimeouts(['dot=120', '30', 'R=0']))
+    self.assertRaises(xrender.Error, xrender.ParseTimeouts, ['dot=x'])
+
+  def testWatchdog(self):
+    w = xrender.Watchdog()
+    called = []
+    w.Add(0.05, lambda: called.append(1))
+    entry = w.Add(0.05, lambda: called.append(2))
+    w.Cancel(entry)
+    time.sleep(0.3)
+    self.assertEqual([1], called)
+    self.assertEqual(None, w.thread)  # exited when idle
+
+
+class FollowersTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.log_path = os.path.join(self.tmp, 'build.log')
+    with open(self.log_path, 'w') as f:
+      f.write('one\n')
+    # Poll() is called directly.
+    self.followers = xrender.Followers(max_followed=2, poll_secs=60)
+    self.stopped = []
+
+  def tearDown(self):
+    self.followers.Close()
+    shutil.rmtree(self.tmp)
+
+  def _Append(self, path, text):
+    with open(path, 'a') as f:
+      f.write(text)
+
+  def _Read(self, num):
+    with open(os.path.join(self.tmp, '%d.html' % num)) as f:
+      return f.read()
+
+  def _Follow(self, path, num):
+    return self.followers.Follow(path, 'txt', num, self.tmp,
+                                 self.stopped.append)
+
+  def testAppend(self):
+    info, name = self._Follow(self.log_path, 1)
+    self.assertEqual('1.html\n', name)
+    self.assertTrue(info['following'])
+    self.assertTrue(self.followers.IsFollowing(self.log_path))
+    html = self._Read(1)
+    self.assertTrue(html.startswith(xrender.FOLLOW_PREFIX))
+    self.assertTrue('one\n' in html)
+
+    # Only whole lines are appended, and only once.
+    self._Append(self.log_path, '<two>\nthr')
+    self.followers.Poll()
+    self.followers.Poll()
+    added = self._Read(1)[len(html):]
+    self.assertEqual(xrender.FOLLOW_CHUNK % '&lt;two&gt;\n', added)
+
+    self._Append(self.log_path, 'ee\n')
+    self.followers.Poll()
+    self.assertTrue(self._Read(1).endswith(xrender.FOLLOW_CHUNK % 'three\n'))
+    self.assertEqual(2, self.followers.Stats()['appends'])
+    self.assertEqual(len('<two>\nthree\n'),
+                     self.followers.Stats()['bytesRead'])
+
+  def testStopOnTruncate(self):
+    self._Follow(self.log_path, 1)
+    with open(self.log_path, 'w') as f:
+      f.write('')
+    self.followers.Poll()
+    self.assertEqual([1], self.stopped)
+    self.assertFalse(self.followers.IsFollowing(self.log_path))
+    self.assertTrue('Stopped following' in self._Read(1))
+
+  def testCap(self):
+    paths = []
+    for i in xrange(3):
+      path = os.path.join(self.tmp, 'log%d' % i)
+      self._Append(path, 'x\n')
+      paths.append(path)
+      self._Follow(path, i)
+    # The first one was stopped to make room.
+    self.assertEqual([0], self.stopped)
+    self.assertEqual([False, True, True],
+                     [self.followers.IsFollowing(p) for p in paths])
+    self.assertEqual(2, self.followers.Stats()['following'])
+
+
+class RenderPoolTest(unittest.TestCase):
+
+  def testPerPluginLimit(self):
+    pool = xrender.RenderPool(3, limits={'slow': 1})
+    lock = threading.Lock()
+    running = collections.defaultdict(int)
+    most = collections.defaultdict(int)
+    order = []
+
+    def Job(plugin, secs):
+      def Run():
+        with lock:
+          running[plugin] += 1
+          most[plugin] = max(most[plugin], running[plugin])
+        time.sleep(secs)
+        with lock:
+          running[plugin] -= 1
+          order.append(plugin)
+      return Run
+
+    for _ in xrange(3):
+      pool.Submit('slow', Job('slow', 0.2))
+    for _ in xrange(3):
+      pool.Submit('fast', Job('fast', 0.01))
+    pool.Wait()
+
+    self.assertEqual(1, most['slow'])
+    # The fast ones didn't wait behind the slow ones.
+    self.assertEqual(['fast'] * 3, order[:3])
+
+  def testInOrder(self):
+    emitted = []
+    in_order = xrender._InOrder(5, emitted.append)
+    in_order.Done(6, 'six')
+    in_order.Done(7, 'seven')
+    self.assertEqual([], emitted)
+    in_order.Done(5, 'five')
+    self.assertEqual(['five', 'six', 'seven'], emitted)
+
+  def testReplace(self):
+    emitted = []
+    in_order = xrender._InOrder(1, emitted.append)
+    in_order.Done(2, 'placeholder 2')
+    in_order.Replace(2, 'two')  # before 2 was emitted
+    in_order.Done(1, 'placeholder 1')
+    in_order.Replace(1, 'one')  # after
+    self.assertEqual(['placeholder 1', 'two', 'one'], emitted)
+
+  def testAddWorker(self):
+    pool = xrender.RenderPool(1)
+    release = threading.Event()
+    done = []
+    pool.Submit('slow', release.wait)
+    pool.AddWorker()  # what a placeholder does
+    pool.Submit('fast', lambda: done.append(1))
+    time.sleep(0.2)
+    self.assertEqual([1], done)  # didn't wait for the slow one
+    release.set()
+    pool.Wait()
+
+
+  def testAddWorkerReleasesPluginSlot(self):
+    pool = xrender.RenderPool(1)  # one render per plugin at a time
+    release = threading.Event()
+    done = []
+    job = xrender._Job()
+    pool.Submit('markdown', release.wait, job=job)
+    pool.Submit('markdown', lambda: done.append(1))
+    time.sleep(0.1)
+    self.assertEqual([], done)
+
+    # What a placeholder does, on the watchdog thread
+    t = threading.Thread(target=pool.AddWorker, args=(job,))
+    t.start()
+    t.join(5)
+    time.sleep(0.1)
+    self.assertEqual([1], done)  # didn't wait for the slow one
+    release.set()
+    pool.Wait()
+    self.assertEqual(0, pool.running['markdown'])
+
+  def testMaxQueued(self):
+    pool = xrender.RenderPool(1, max_queued=1)
+    release = threading.Event()
+    pool.Submit('slow', release.wait)
+    time.sleep(0.1)  # running, so the queue is empty
+    pool.Submit('a', lambda: None)
+
+    submitted = []
+    t = threading.Thread(
+        target=lambda: submitted.append(pool.Submit('b', lambda: None)))
+    t.start()
+    time.sleep(0.1)
+    self.assertEqual([], submitted)  # blocked on the full queue
+    release.set()
+    t.join(5)
+    self.assertEqual([None], submitted)
+    pool.Wait()
+
+
+def Collect(items):
   while True:
-    filename = yield
-    if not filename:
-      break
-    print filename
+    items.append((yield))
+
+
+class MessagesTest(unittest.TestCase):
+
+  def testParseMessage(self):
+    self.assertEqual(('/tmp/a', None, {}),
+                     xrender.ParseMessage({'path': '/tmp/a'}))
+    self.assertEqual(('/tmp/a', 'tar.gz', {'follow': True}),
+                     xrender.ParseMessage({'path': '/tmp/a', 'type': 'tar.gz',
+                                           'options': {'follow': True}}))
+    self.assertEqual(('/tmp/a', None, {'follow': True}),
+                     xrender.ParseMessage({'follow': '/tmp/a'}))
+    for bad in ['/tmp/a', {}, {'path': '/tmp/a', 'type': '../x'},
+                {'path': '/tmp/a', 'options': {'follow': 'yes'}},
+                {'path': '/tmp/a', 'options': {'color': True}}]:
+      self.assertRaises(xrender.Error, xrender.ParseMessage, bad)
+
+  def testSplitFrames(self):
+    self.assertEqual((['3:abc,', '0:}'], '5:ab'),
+                     xrender._SplitFrames('3:abc,0:}5:ab'))
+    self.assertEqual(([], '12'), xrender._SplitFrames('12'))
+    self.assertRaises(xrender.Error, xrender._SplitFrames, '3:abc,/tmp')
+
+  def testIsFramed(self):
+    self.assertEqual(True, xrender._IsFramed('12:'))
+    self.assertEqual(None, xrender._IsFramed('12'))
+    self.assertEqual(False, xrender._IsFramed('2014-01-01.log\n'))
+    self.assertEqual(False, xrender._IsFramed('/tmp/a\n'))
+
+  def testDispatchLoopTakesMessages(self):
+    in_dir = tempfile.mkdtemp()
+    out_dir = tempfile.mkdtemp()
+    try:
+      with open(os.path.join(in_dir, 'foo.txt'), 'w') as f:
+        f.write('<b>hi</b>\n')
+      parts = []
+      loop = xrender.PluginDispatchLoop(in_dir, out_dir,
+                                        announce=parts.append)
+      loop.next()  # prime
+      loop.send({'path': 'foo.txt', 'type': 'html'})
+      loop.send({'path': 'foo.txt', 'type': '../../x'})  # ignored
+      self.assertEqual(['html'], [p['fileType'] for p in parts])
+    finally:
+      shutil.rmtree(in_dir)
+      shutil.rmtree(out_dir)
+
+
+def _Message(path, **fields):
+  fields['path'] = path
+  return xrender.TnetDict(fields)
+
+
+class IngestServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.items = []
+    self.server = xrender.IngestServer(0, Collect(self.items))
+    t = threading.Thread(target=self.server.Serve)
+    t.setDaemon(True)
+    t.start()
+
+  def tearDown(self):
+    self.server.Close()
+
+  def _Connect(self):
+    return socket.create_connection(('localhost', self.server.port))
+
+  def _ReadAll(self, sock):
+    chunks = []
+    while True:
+      chunk = sock.recv(4096)
+      if not chunk:
+        return ''.join(chunks)
+      chunks.append(chunk)
+
+  def testAcks(self):
+    sock = self._Connect()
+    # Split in the middle of a message
+    data = (_Message('/tmp/a') + _Message('/tmp/b', type='csv') +
+            '3:abc,' + _Message('/tmp/c') + '0:,')
+    sock.sendall(data[:10])
+    time.sleep(0.05)
+    sock.sendall(data[10:])
+    acks = self._ReadAll(sock)
+    sock.close()
+
+    self.assertEqual('2:ok,2:ok,', acks[:10])
+    self.assertTrue(acks[10:].startswith(
+        '%d:error: Expected a dict' % len("error: Expected a dict, got 'abc'")))
+    self.assertTrue(acks.endswith('2:ok,'))
+    self.assertEqual(['/tmp/a', '/tmp/b', '/tmp/c'],
+                     [m['path'] for m in self.items])
+    self.assertEqual('csv', self.items[1]['type'])
+
+  def testConcurrentClients(self):
+    socks = [self._Connect() for _ in xrange(20)]
+    for i, sock in enumerate(socks):
+      sock.sendall(_Message('/tmp/%d' % i) + '0:,')
+    for sock in socks:
+      self.assertEqual('2:ok,', self._ReadAll(sock))
+      sock.close()
+    self.assertEqual(sorted('/tmp/%d' % i for i in xrange(20)),
+                     sorted(m['path'] for m in self.items))
+
+  def testMissingFile(self):
+    in_dir = tempfile.mkdtemp(prefix='ingest_test')
+    try:
+      open(os.path.join(in_dir, 'a.txt'), 'w').close()
+      self.server.Close()
+      self.server = xrender.IngestServer(0, Collect(self.items), in_dir=in_dir)
+      t = threading.Thread(target=self.server.Serve)
+      t.setDaemon(True)
+      t.start()
 
+      sock = self._Connect()
+      sock.sendall(_Message('a.txt') + _Message('b.txt') + '0:,')
+      acks = self._ReadAll(sock)
+      sock.close()
+      error = 'error: No such file: b.txt'
+      self.assertEqual('2:ok,%d:%s,' % (len(error), error), acks)
+      self.assertEqual(['a.txt'], [m['path'] for m in self.items])
+    finally:
+      shutil.rmtree(in_dir)
 
-class TcpServerTest(unittest.TestCase):
+  def testIdleClientIsDropped(self):
+    saved = xrender.INGEST_IDLE_SECS
+    xrender.INGEST_IDLE_SECS = 0.1
+    try:
+      sock = self._Connect()
+      sock.sendall(_Message('/tmp/a'))  # and never ends the connection
+      self.assertEqual('2:ok,', self._ReadAll(sock))  # closed by the server
+      sock.close()
+    finally:
+      xrender.INGEST_IDLE_SECS = saved
 
-  def testServer(self):
-    e = Echo()
-    # This is a 'manual' test; it listens.
-    return
-    xrender.TcpServer(8002, e)
+  def testLines(self):
+    sock = self._Connect()
+    # Like nc, which doesn't close its end.
+    sock.sendall('/tmp/a\n2014-01-01.log\n')
+    self.assertEqual('', self._ReadAll(sock))  # closed, with no acks
+    sock.close()
+    self.assertEqual(['/tmp/a', '2014-01-01.log'], self.items)
 
 
 if __name__ == '__main__':
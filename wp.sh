@@ -175,6 +175,26 @@ run() {
     | serve serve $session
 }
 
+# Like run, but render and serve in a single process, without the pipe.
+run-daemon() {
+  local sessionName=${1:-}
+
+  local stamp=$(date +%Y-%m-%d)
+  if test -z "$sessionName"; then
+    sessionName=$stamp
+  else
+    # Special syntax: + prepends the current date.
+    sessionName=$(echo $sessionName | sed s/+/$stamp-/)
+  fi
+
+  local session=~/webpipe/s/$sessionName
+  mkdir -p $session
+
+  export PYTHONUNBUFFERED=1
+
+  serve daemon $session --input-dir $INPUT_DIR --listen-port 8988
+}
+
 # Like run, but just test latency.
 noop() {
   local sessionName=${1:-}
@@ -203,6 +223,91 @@ nc-send() {
   nc localhost $port
 }
 
+# Minimal TNET encoder, like tnetEncodeFile in wp-stub.sh.
+tnet-string() {
+  local LC_ALL=C  # so ${#s} is the length in bytes
+  local s=$1
+  echo -n "${#s}:$s,"
+}
+
+tnet-dict() {
+  local LC_ALL=C
+  local payload=$1
+  echo -n "${#payload}:$payload}"
+}
+
+# Send files to be rendered, as messages to the server on port 8988 (see
+# IngestServer in webpipe/xrender.py).  It acks each one with "ok" or
+# "error: <reason>".  Errors are printed, and the status is 1 if any file
+# wasn't accepted.
+#
+# Usage: send-files <type> <follow> <file>...
+#   type: file type, or empty to infer it from the extension
+#   follow: 1 to follow the files as they grow
+send-files() {
+  local type=$1
+  local follow=$2
+  shift 2
+
+  local filename
+  {
+    for filename in "$@"; do
+      if test "${filename:0:1}" != /; then
+        # relative path, make it absolute.
+        filename="$PWD/$filename"
+      fi
+      local fields="$(tnet-string path)$(tnet-string "$filename")"
+      if test -n "$type"; then
+        fields="$fields$(tnet-string type)$(tnet-string "$type")"
+      fi
+      if test "$follow" = 1; then
+        fields="$fields$(tnet-string options)$(tnet-dict "$(tnet-string follow)4:true!")"
+      fi
+      tnet-dict "$fields"
+    done
+    echo -n '0:,'  # done; the server closes the connection
+  } | nc-send 8988 | check-acks $#
+}
+
+# Read tnet string acks on stdin, and print the errors.  Fails if any ack is
+# an error, or if there are fewer than expected.
+#
+# Usage: check-acks <expected count>
+check-acks() {
+  local expected=$1
+  local LC_ALL=C  # lengths are in bytes
+  local acks
+  acks=$(cat; echo x)  # keep trailing newlines
+  acks=${acks%x}
+
+  local num_acks=0
+  local status=0
+  local len payload
+  while test -n "$acks"; do
+    len=${acks%%:*}
+    case $len in
+      ''|*[!0-9]*)
+        log "Invalid ack from server: $acks"
+        return 1
+        ;;
+    esac
+    acks=${acks#*:}
+    payload=${acks:0:$len}
+    acks=${acks:$len+1}  # and the comma
+    num_acks=$((num_acks + 1))
+    if test "$payload" != ok; then
+      log "$payload"
+      status=1
+    fi
+  done
+
+  if test $num_acks -lt $expected; then
+    log "Only $num_acks of $expected files were acknowledged"
+    status=1
+  fi
+  return $status
+}
+
 # Show a file, specifying file type first.
 #
 # $ wp show-as txt NOTES
@@ -220,19 +325,11 @@ show-as() {
     fi
     local tempfile=$INPUT_DIR/sink/$$.$ext
     cat > $tempfile
-    echo $tempfile | nc-send 8988
+    send-files "$ext" 0 $tempfile
+    return
   fi
 
-  # TODO: respect $ext here.  Need to send it as a TNET message I suppose.
-
-  for filename in "$@"; do
-    if test ${filename:0:1} = /; then
-      echo "$filename" | nc-send 8988
-    else
-      # relative path, make it absolute.
-      echo "$PWD/$filename" | nc-send 8988
-    fi
-  done
+  send-files "$ext" 0 "$@"
 }
 
 as() {
@@ -250,6 +347,13 @@ show() {
   show-as '' "$@"
 }
 
+# Show a file that's growing, like a log, and append to it as it grows.
+#
+# $ wp follow build.log
+follow() {
+  send-files '' 1 "$@"
+}
+
 publish() {
   $THIS_DIR/webpipe/publish.py "$@"
 }
@@ -335,7 +439,7 @@ fi
 
 case $1 in 
   # generally public ones
-  help|init|run|noop|run-recv|package-dir|publish|show|show-as|as|stub-path|scp-stub|version)
+  help|init|run|run-daemon|noop|run-recv|package-dir|publish|show|show-as|as|follow|stub-path|scp-stub|version)
     "$@"
     ;;
   ssh)